@@ -8,11 +8,17 @@ class NewsletterModelAdmin(admin.ModelAdmin):
     list_display = ('number', 'period', 'date', 'date_created', 'reviewed', 'pending', )
     list_filter = ('period', 'reviewed', 'pending', )
     ordering = ('-date', )
-    search_fields = ('text_content', 'html_content', )
+    # compressed contents are only found by their summary
+    search_fields = ('summary', 'text_content', 'html_content', )
 
     def has_add_permission(self, request):
         return False
 
+    def queryset(self, request):
+        # the contents are only read by the change form, when they're needed
+        queryset = super(NewsletterModelAdmin, self).queryset(request)
+        return queryset.defer('text_content', 'html_content')
+
 
 class NewsletterSubscriptionModelAdmin(admin.ModelAdmin):
     date_hierarchy = 'subscription_date'
@@ -21,3 +27,38 @@ class NewsletterSubscriptionModelAdmin(admin.ModelAdmin):
     ordering = ('-subscription_date', )
     radio_fields = {'period': admin.HORIZONTAL}
     search_fields = ('email', )
+
+
+class NewsletterSendingRunModelAdmin(admin.ModelAdmin):
+    date_hierarchy = 'started'
+    list_display = ('newsletter', 'started', 'finished', 'sent', 'failed', 'retryable', )
+    ordering = ('-started', )
+
+    def has_add_permission(self, request):
+        return False
+
+
+class NewsletterSendJobModelAdmin(admin.ModelAdmin):
+    list_display = ('newsletter', 'created', 'started', 'finished', 'owner', 'lease_expires',
+                    'total', 'error', )
+    ordering = ('-created', )
+
+    def has_add_permission(self, request):
+        return False
+
+
+class NewsletterSendingChunkModelAdmin(admin.ModelAdmin):
+    list_display = ('newsletter', 'number', 'first', 'last', 'owner', 'lease_expires', 'done', )
+    list_filter = ('done', )
+
+    def has_add_permission(self, request):
+        return False
+
+
+class QueuedEmailModelAdmin(admin.ModelAdmin):
+    list_display = ('subject', 'recipients', 'created', 'next_attempt', 'attempts', 'error', )
+    ordering = ('-created', )
+    search_fields = ('recipients', )
+
+    def has_add_permission(self, request):
+        return False
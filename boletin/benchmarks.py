@@ -0,0 +1,297 @@
+# -*- coding: utf-8 -*-
+"""Micro-benchmarks for the hot paths of newsletter generation and sending.
+
+Run them inside a configured project::
+
+    DJANGO_SETTINGS_MODULE=project.settings python -m boletin.benchmarks
+
+Every benchmark returns a dictionary with its measures.
+
+The tools for the scale benchmarks of the ``benchmarknewsletters`` command
+(synthetic datasets, query counting and timing of phases) are here too.
+"""
+import datetime
+import resource
+import time
+
+from django.utils import simplejson
+
+
+def timed(function, count):
+    """Call ``function(i)`` for i in range(count), returning calls/sec."""
+    start = time.time()
+    for i in xrange(count):
+        function(i)
+    elapsed = time.time() - start
+    return elapsed and count / elapsed or 0
+
+
+def synthetic_newsletter(paragraphs=20):
+    from boletin.models import Newsletter, WEEKLY
+    text = u'Lorem ipsum dolor sit amet, consectetur adipiscing elit, ñandú. ' * 10
+    return Newsletter(number=1, period=WEEKLY, date=datetime.date.today(),
+                      text_content=u'\n\n'.join([text] * paragraphs),
+                      html_content=u''.join([u'<p>%s</p>' % text] * paragraphs))
+
+
+def message_serialization(count=500):
+    """Messages serialized per second, building an EmailMultiAlternatives
+    for each recipient versus using a NewsletterMessageTemplate."""
+    from boletin.sending import NewsletterMessageTemplate, newsletter_message
+    newsletter = synthetic_newsletter()
+    template = NewsletterMessageTemplate(newsletter)
+    email = 'user%d@example.com'
+    return {
+        'messages': count,
+        'size': len(template.render(email % 0)),
+        'per_recipient_rate': timed(
+            lambda i: newsletter_message(newsletter, email % i).message().as_string(), count),
+        'template_rate': timed(
+            lambda i: template.message(email % i).message().as_string(), count),
+    }
+
+
+def personalization(count=500):
+    """Personalized messages serialized per second, rendering the templates
+    and encoding the message for each recipient versus splicing the values
+    in a NewsletterMessageTemplate, and contents per second of both ways."""
+    from django.template import Context, Template
+    from boletin.models import NewsletterSubscription
+    from boletin.personalization import Recipient, fill
+    from boletin.sending import NewsletterMessageTemplate, newsletter_message
+    newsletter = synthetic_newsletter()
+    footer = u'Sent to {{ recipient.email }} ({{ recipient.period }}), ' \
+             u'unsubscribe at {{ recipient.unsubscribe_url }}'
+    text = Template(newsletter.text_content + footer)
+    html = Template(newsletter.html_content + u'<p>%s</p>' % footer)
+    newsletter.text_content = text.render(Context({'recipient': Recipient()}))
+    newsletter.html_content = html.render(Context({'recipient': Recipient()}))
+    template = NewsletterMessageTemplate(newsletter)
+    subscribers = [NewsletterSubscription(id=i, email='user%d@example.com' % i,
+                                          period=newsletter.period)
+                   for i in xrange(count)]
+
+    def render(i):
+        context = Context({'recipient': template.values(subscribers[i])[0]})
+        return text.render(context), html.render(context)
+
+    def splice(i):
+        values = template.values(subscribers[i])
+        fill(template.text_compiled, values[0])
+        fill(template.html_compiled, values[1])
+
+    return {
+        'recipients': count,
+        'render_rate': timed(render, count),
+        'splice_rate': timed(splice, count),
+        'render_message_rate': timed(lambda i: newsletter_message(
+            newsletter, subscribers[i].email, *render(i)).message().as_string(), count // 10),
+        'splice_message_rate': timed(lambda i: template.message(
+            subscribers[i].email, subscribers[i]).message().as_string(), count),
+    }
+
+
+class SyntheticItem(object):
+    """Content object like the ones returned by generator functions."""
+
+    def __init__(self, i):
+        self.title = u'Noticia número %d sobre salud y bienestar' % i
+        self.body = u'<p>%s</p>' % (u'Cuerpo de la noticia con <b>marcas</b> &amp; entidades. ' * 10)
+        self.creation_date = datetime.datetime(2009, 6, 1, 12, 0)
+
+    def __unicode__(self):
+        return self.title
+
+    def get_absolute_url(self):
+        from django.template.defaultfilters import slugify
+        return u'/news/%s/' % slugify(self.title)
+
+
+def newsletter_rendering(count=2000, repeat=3):
+    """Newsletters rendered per second (both the text and the HTML
+    templates) with ``count`` objects, loading the templates and looking up
+    the objects for each template versus using the template cache and a
+    prepared context."""
+    from django.contrib.sites.models import Site
+    from django.template import Context, loader
+    from boletin.personalization import Recipient
+    from boletin.rendering import get_template, prepare_content
+    objects = [SyntheticItem(i) for i in xrange(count)]
+    base = {'number': 1, 'period': u'Monthly', 'site': Site(domain='example.com', name='Example'),
+            'from': datetime.date(2009, 6, 1), 'to': datetime.date(2009, 6, 30),
+            'recipient': Recipient()}
+
+    def uncached(i):
+        context = Context(dict(base, objects=objects))
+        loader.get_template('boletin/newsletter_email.txt').render(context)
+        loader.get_template('boletin/newsletter_email.html').render(context)
+
+    def cached(i):
+        context = dict(base)
+        context.update(prepare_content({'objects': objects}))
+        context = Context(context)
+        get_template('boletin/newsletter_email.txt').render(context)
+        get_template('boletin/newsletter_email.html').render(context)
+
+    return {
+        'objects': count,
+        'uncached_rate': timed(uncached, repeat),
+        'cached_rate': timed(cached, repeat),
+    }
+
+
+def html_to_text(count=2000):
+    """Object bodies converted to plain text per second by the chained
+    filters of the text template and by the ``html2text`` filter, with
+    different bodies and with a body repeated (cached)."""
+    from django.template.defaultfilters import striptags, truncatewords_html, wordwrap
+    from boletin.templatetags import stringfilters
+    body = SyntheticItem(0).body
+
+    def chained(i):
+        return wordwrap(stringfilters.entity2unicode(striptags(
+            truncatewords_html(u'%d %s' % (i, body), 25))), 80)
+
+    def single(i):
+        stringfilters._html2text_cache.clear()
+        return stringfilters.html2text(u'%d %s' % (i, body))
+
+    return {
+        'bodies': count,
+        'chained_rate': timed(chained, count),
+        'html2text_rate': timed(single, count),
+        'html2text_cached_rate': timed(lambda i: stringfilters.html2text(body), count),
+    }
+
+
+def peak_memory():
+    """Peak resident memory of the process so far, in kilobytes."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class CountingCursor(object):
+    """Database cursor which counts the statements it executes."""
+
+    def __init__(self, cursor, counter):
+        self.cursor = cursor
+        self.counter = counter
+
+    def execute(self, sql, params=()):
+        self.counter.queries += 1
+        return self.cursor.execute(sql, params)
+
+    def executemany(self, sql, param_list):
+        self.counter.queries += 1
+        return self.cursor.executemany(sql, param_list)
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+
+class Phases(object):
+    """Measure the phases of a benchmark: time, database queries, peak
+    memory and, for the phases which process ``count`` items, throughput.
+
+    Queries are counted by giving the connection a counting cursor instead
+    of the debug one, which would keep every query in memory.
+    """
+
+    def __init__(self):
+        from django.conf import settings
+        from django.db import connection
+        self.results = {}
+        self.queries = 0
+        self.old_debug = settings.DEBUG
+        settings.DEBUG = True
+        connection.make_debug_cursor = lambda cursor: CountingCursor(cursor, self)
+
+    def close(self):
+        from django.conf import settings
+        from django.db import connection
+        settings.DEBUG = self.old_debug
+        del connection.make_debug_cursor
+
+    def run(self, name, function, *args, **kwargs):
+        """Run ``function``, which returns the number of items it processed
+        or ``None``, as the phase ``name``."""
+        queries = self.queries
+        start = time.time()
+        count = function(*args, **kwargs)
+        elapsed = time.time() - start
+        result = self.results[name] = {
+            'seconds': elapsed,
+            'queries': self.queries - queries,
+            'peak_memory_kb': peak_memory(),
+        }
+        if count is not None:
+            result['count'] = count
+            result['rate'] = elapsed and count / elapsed or 0
+        return result
+
+
+def create_subscriptions(count, period, batch_size=5000):
+    """Insert ``count`` confirmed subscriptions of ``period``, subscribed a
+    year ago, returning their number."""
+    from boletin.db import bulk_insert
+    from boletin.models import NewsletterSubscription
+    date = datetime.datetime.now() - datetime.timedelta(days=365)
+    start = NewsletterSubscription.objects.count()
+    for first in xrange(start, start + count, batch_size):
+        last = min(first + batch_size, start + count)
+        bulk_insert(NewsletterSubscription,
+                    ('email', 'period', 'subscription_date', 'hashkey', 'confirmed'),
+                    [(u'user%d@example.com' % i, period, date, u'', True)
+                     for i in xrange(first, last)])
+    return count
+
+
+def create_history(newsletters, period, batch_size=5000):
+    """Create ``newsletters`` past newsletters of ``period`` already sent
+    to every subscription, returning the number of sendings."""
+    from boletin.db import bulk_insert
+    from boletin.models import (Newsletter, NewsletterSending, NewsletterSendingRun,
+                                NewsletterSubscription)
+    ids = list(NewsletterSubscription.objects.filter(period=period).values_list('id', flat=True))
+    sent = datetime.datetime.now() - datetime.timedelta(days=1)
+    count = 0
+    for n in xrange(newsletters):
+        newsletter = Newsletter.objects.create(period=period, text_content=u'Old',
+            html_content=u'<p>Old</p>', date=datetime.date(2000, 1, 1) + datetime.timedelta(days=n),
+            pending=False, reviewed=True)
+        for first in xrange(0, len(ids), batch_size):
+            bulk_insert(NewsletterSending, ('newsletter_id', 'subscription_id', 'date'),
+                        [(newsletter.id, id, sent) for id in ids[first:first + batch_size]])
+        NewsletterSendingRun.objects.create(newsletter=newsletter, finished=sent, sent=len(ids))
+        count += len(ids)
+    return count
+
+
+def synthetic_content(count):
+    """Generator function returning ``count`` synthetic objects."""
+    def generate_content(from_date, to_date):
+        return {'objects': [SyntheticItem(i) for i in xrange(count)]}
+    return generate_content
+
+
+BENCHMARKS = (
+    ('message_serialization', message_serialization),
+    ('personalization', personalization),
+    ('newsletter_rendering', newsletter_rendering),
+    ('html_to_text', html_to_text),
+)
+
+
+def run(names=None):
+    results = {}
+    for name, benchmark in BENCHMARKS:
+        if not names or name in names:
+            results[name] = benchmark()
+    return results
+
+
+if __name__ == '__main__':
+    import sys
+    print simplejson.dumps(run(sys.argv[1:]), indent=2)
@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+import base64
+import threading
+import zlib
+
+from django.conf import settings
+from django.db import connection, models, transaction
+from django.db.models import signals
+
+from boletin.metrics import Timer, incr
+
+COMPRESSED_PREFIX = 'zlib:'
+
+
+def get_compress_content():
+    return getattr(settings, 'NEWSLETTER_COMPRESS_CONTENT', False)
+
+
+def bulk_insert(model, field_names, rows):
+    """Insert many rows of ``model`` with a single ``executemany`` call.
+
+    ``rows`` is a sequence of tuples with the values for ``field_names``, in
+    the same order (use the ``attname``, like ``newsletter_id``, for foreign
+    keys). Values are prepared for the database by their fields, but the
+    model ``save`` method is not called and no signals are sent.
+
+    Inside a managed transaction the transaction is marked as dirty, so it is
+    committed with the rest of the block.
+    """
+    opts = model._meta
+    by_attname = dict([(field.attname, field) for field in opts.fields])
+    fields = [by_attname[name] for name in field_names]
+    qn = connection.ops.quote_name
+    sql = 'INSERT INTO %s (%s) VALUES (%s)' % (
+        qn(opts.db_table),
+        ', '.join([qn(field.column) for field in fields]),
+        ', '.join(['%s'] * len(fields)))
+    params = [[field.get_db_prep_save(value) for field, value in zip(fields, row)]
+              for row in rows]
+    if not params:
+        return
+    timer = Timer('db.insert')
+    cursor = connection.cursor()
+    cursor.executemany(sql, params)
+    timer.stop()
+    incr('db.inserted_rows', len(params))
+    if transaction.is_managed():
+        transaction.set_dirty()
+    else:
+        transaction.commit_unless_managed()
+
+
+def keyset_iterator(queryset, chunk_size=1000, after=None):
+    """Iterate over a queryset in chunks of ``chunk_size`` objects ordered
+    by primary key, starting after the primary key ``after``.
+
+    Every chunk is a new query filtered by the last primary key seen
+    (keyset pagination), so unlike a plain iteration over the queryset
+    neither the database nor Django have to hold all the results, and later
+    chunks are as cheap as the first ones. Objects added or deleted while
+    iterating may or may not be seen.
+    """
+    queryset = queryset.order_by('pk')
+    while True:
+        chunk = queryset
+        if after is not None:
+            chunk = chunk.filter(pk__gt=after)
+        timer = Timer('db.select')
+        chunk = list(chunk[:chunk_size])
+        timer.stop()
+        for obj in chunk:
+            yield obj
+        if len(chunk) < chunk_size:
+            break
+        after = chunk[-1].pk
+
+
+def compress(value):
+    """Compress a text for a CompressedTextField column, unless it's not
+    worth it.
+
+    >>> compress(u'x' * 100)
+    u'zlib:eJyrqKA9AABAGy7h'
+    >>> compress(u'short')
+    u'short'
+
+    """
+    compressed = COMPRESSED_PREFIX + base64.b64encode(zlib.compress(value.encode('utf-8')))
+    # texts which look compressed are always compressed
+    if len(compressed) < len(value) or value.startswith(COMPRESSED_PREFIX):
+        return unicode(compressed)
+    return value
+
+
+def decompress(value):
+    if value.startswith(COMPRESSED_PREFIX):
+        return zlib.decompress(base64.b64decode(value[len(COMPRESSED_PREFIX):])).decode('utf-8')
+    return value
+
+
+class Compressed(object):
+    """A text read from a CompressedTextField, still compressed."""
+
+    def __init__(self, value):
+        self.value = value
+
+
+class CompressedContent(object):
+    """Descriptor which decompresses the value of a CompressedTextField the
+    first time it's read.
+
+    Only values loaded from the database can be compressed: assigned texts
+    are kept as they are, even if they look compressed.
+    """
+
+    def __init__(self, attname):
+        self.attname = attname
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        value = instance.__dict__.get(self.attname)
+        if isinstance(value, Compressed):
+            value = instance.__dict__[self.attname] = decompress(value.value)
+        return value
+
+    def __set__(self, instance, value):
+        instance.__dict__[self.attname] = value
+
+
+_loading = threading.local()
+
+
+def is_loaded(sender, args):
+    """Tell if an instance of ``sender`` is being built from a database row.
+    Querysets pass the values of the row as positional arguments, or as
+    keyword arguments to the classes of deferred models, which are never
+    built by hand."""
+    return bool(args) or getattr(sender, '_deferred', False)
+
+
+def start_init(sender, args, **kwargs):
+    _loading.value = bool(getattr(sender, '_compressed_fields', None)) \
+                     and is_loaded(sender, args)
+
+
+def finish_init(sender, instance, **kwargs):
+    """Keep the compressed values of an instance loaded from the database
+    to be decompressed when they are read."""
+    if not getattr(_loading, 'value', False):
+        return
+    _loading.value = False
+    for attname in sender._compressed_fields:
+        value = instance.__dict__.get(attname)
+        if isinstance(value, basestring) and value.startswith(COMPRESSED_PREFIX):
+            instance.__dict__[attname] = Compressed(value)
+
+
+class CompressedTextField(models.TextField):
+    """TextField stored compressed with zlib and base64 encoded, when that
+    makes it shorter and ``NEWSLETTER_COMPRESS_CONTENT`` is on.
+
+    Values are decompressed when they are first read, not when they are
+    loaded, and uncompressed values in the column are read as they are.
+    Lookups other than ``exact`` and ``isnull`` don't work on compressed
+    values.
+    """
+
+    def contribute_to_class(self, cls, name):
+        super(CompressedTextField, self).contribute_to_class(cls, name)
+        setattr(cls, self.attname, CompressedContent(self.attname))
+        # inherited by the classes of deferred models, which are other senders
+        cls._compressed_fields = getattr(cls, '_compressed_fields', ()) + (self.attname, )
+        signals.pre_init.connect(start_init, dispatch_uid='boletin.db.start_init')
+        signals.post_init.connect(finish_init, dispatch_uid='boletin.db.finish_init')
+
+    def get_db_prep_value(self, value):
+        value = super(CompressedTextField, self).get_db_prep_value(value)
+        # texts which look compressed are compressed even with the setting
+        # off, to be read back as they were
+        if value and (get_compress_content() or value.startswith(COMPRESSED_PREFIX)):
+            value = compress(value)
+        return value
+
+
+def keyset_values(queryset, fields, chunk_size=1000):
+    """Like ``keyset_iterator``, but yielding tuples with the primary key and
+    the values of ``fields``, without building model instances."""
+    queryset = queryset.order_by('pk')
+    after = None
+    while True:
+        chunk = queryset
+        if after is not None:
+            chunk = chunk.filter(pk__gt=after)
+        chunk = list(chunk.values_list('pk', *fields)[:chunk_size])
+        for row in chunk:
+            yield row
+        if len(chunk) < chunk_size:
+            break
+        after = chunk[-1][0]
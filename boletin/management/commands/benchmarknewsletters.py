@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+import sys
+from cStringIO import StringIO
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import NoArgsCommand
+from django.db import connection
+from django.utils import simplejson
+
+
+class Command(NoArgsCommand):
+    option_list = NoArgsCommand.option_list + (
+        make_option('--subscriptions', '-s', default=10000, dest='subscriptions', type='int',
+            help='Number of synthetic subscriptions.'),
+        make_option('--history', default=5, dest='history', type='int',
+            help='Number of past newsletters already sent to every subscription.'),
+        make_option('--objects', default=1000, dest='objects', type='int',
+            help='Number of objects returned by the synthetic generator function.'),
+        make_option('--batch-size', '-b', default=None, dest='batch_size', type='int',
+            help='Number of messages sent through each SMTP connection.'),
+        make_option('--sessions', default=None, dest='sessions', type='int',
+            help='Send with this number of concurrent SMTP sessions.'),
+        make_option('--output', '-o', default=None, dest='output',
+            help='Write the results to this file instead of the standard output.'),
+    )
+    help = u"Benchmark the generation and sending of a newsletter with synthetic data " \
+           u"in a test database, printing the results as JSON."
+
+    def handle_noargs(self, **options):
+        from boletin import benchmarks, smtpsink, version
+        from boletin.management.commands.createnewsletter import Command as CreateNewsletter, get_dates
+        from boletin.models import Newsletter, WEEKLY
+
+        subscriptions = options.get('subscriptions')
+        history = options.get('history')
+        objects = options.get('objects')
+        verbosity = int(options.get('verbosity', 1))
+
+        old_name = settings.DATABASE_NAME
+        old_email = (settings.EMAIL_HOST, settings.EMAIL_PORT)
+        # the benchmark never touches the project's data
+        connection.creation.create_test_db(verbosity=0)
+        server = smtpsink.start()
+        settings.EMAIL_HOST, settings.EMAIL_PORT = 'localhost', server.port
+        phases = benchmarks.Phases()
+        stdout = sys.stdout
+        try:
+            def log(message):
+                if verbosity > 1:
+                    print >> stdout, message
+
+            log("Creating %d subscriptions." % subscriptions)
+            phases.run('create_subscriptions', benchmarks.create_subscriptions,
+                       subscriptions, WEEKLY)
+            log("Creating %d sent newsletters." % history)
+            phases.run('create_history', benchmarks.create_history, history, WEEKLY)
+
+            sys.stdout = StringIO()
+            generate_content = benchmarks.synthetic_content(objects)
+
+            def create():
+                from_date, to_date = get_dates(WEEKLY)
+                CreateNewsletter().create(WEEKLY, from_date, to_date,
+                                          generate_content(from_date, to_date))
+                return objects
+            log("Generating a newsletter with %d objects." % objects)
+            phases.run('generate', create)
+            newsletter = Newsletter.objects.latest()
+            newsletter.reviewed = newsletter.pending = True
+            newsletter.save()
+
+            def send():
+                call_command('sendnewsletter', newsletter=newsletter.id, unreviewed=True,
+                             batch_size=options.get('batch_size'),
+                             sessions=options.get('sessions'))
+                return server.received
+            log("Sending it to %d subscribers." % subscriptions)
+            phases.run('send', send)
+            phases.run('show', call_command, 'shownewsletters', json=True)
+        finally:
+            sys.stdout = stdout
+            phases.close()
+            smtpsink.stop(server)
+            settings.EMAIL_HOST, settings.EMAIL_PORT = old_email
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        results = {
+            'version': version,
+            'database': settings.DATABASE_ENGINE,
+            'parameters': {
+                'subscriptions': subscriptions,
+                'history': history,
+                'objects': objects,
+                'batch_size': options.get('batch_size'),
+                'sessions': options.get('sessions'),
+            },
+            'phases': phases.results,
+        }
+        output = simplejson.dumps(results, indent=2)
+        if options.get('output'):
+            open(options['output'], 'w').write(output)
+        else:
+            print output
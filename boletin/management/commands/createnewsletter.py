@@ -6,8 +6,12 @@ from django.conf import settings
 from django.contrib.sites.models import Site
 from django.core.mail import send_mail
 from django.core.management.base import CommandError, NoArgsCommand
-from django.template import loader, Context
-from django.template.loader import render_to_string
+from django.db.models.query import QuerySet
+from django.template import Context
+
+from boletin import metrics
+from boletin.rendering import (SCALARS, Stream, get_template, prepare_content,
+                               render_to_string)
 
 
 def get_dates(period, today=None):
@@ -59,6 +63,79 @@ def get_dates(period, today=None):
     return (from_date, to_date)
 
 
+def get_due_periods(today=None):
+    """Periods whose newsletter should be created today: daily ones every
+    day, weekly ones on Mondays and monthly ones on the first day of the
+    month, if they are in ``NEWSLETTER_PERIODS``."""
+    from boletin.models import DAILY, WEEKLY, MONTHLY
+
+    today = today or datetime.date.today()
+    periods = [DAILY]
+    if today.weekday() == 0:
+        periods.append(WEEKLY)
+    if today.day == 1:
+        periods.append(MONTHLY)
+    allowed = getattr(settings, 'NEWSLETTER_PERIODS', None)
+    return [period for period in periods if allowed is None or period in allowed]
+
+
+def as_datetime(value):
+    if not isinstance(value, datetime.datetime):
+        value = datetime.datetime(value.year, value.month, value.day)
+    return value
+
+
+def is_lazy(value):
+    return isinstance(value, (QuerySet, Stream))
+
+
+def is_sequence(value):
+    """Whether ``value`` is an iterable of content objects, which isn't read
+    lazily and must be evaluated to be read again."""
+    return hasattr(value, '__iter__') and not isinstance(value, SCALARS + (dict, )) \
+           and not is_lazy(value)
+
+
+def slice_content(content, from_date, to_date, attribute):
+    """Keep the items of every content value whose ``attribute`` falls
+    between ``from_date`` and ``to_date``.
+
+    Querysets are filtered in the database when ``attribute`` is one of
+    their fields, and streams while they are read, so both stay lazy. Other
+    values, like single objects or strings, are kept as they are.
+
+    >>> class Item(object):
+    ...     def __init__(self, day): self.date = datetime.date(2009, 6, day)
+    >>> content = {'objects': [Item(1), Item(7), Item(8)], 'title': u'News'}
+    >>> sliced = slice_content(content, datetime.date(2009, 6, 1),
+    ...                        datetime.datetime(2009, 6, 7, 23, 59, 59), 'date')
+    >>> [item.date.day for item in sliced['objects']]
+    [1, 7]
+    >>> sliced['title']
+    u'News'
+
+    """
+    from_date, to_date = as_datetime(from_date), as_datetime(to_date)
+
+    def window(items):
+        return (item for item in items
+                if from_date <= as_datetime(getattr(item, attribute)) <= to_date)
+
+    sliced = {}
+    for key, items in content.iteritems():
+        if isinstance(items, QuerySet) and \
+                attribute in [field.name for field in items.model._meta.fields]:
+            sliced[key] = items.filter(**{'%s__range' % attribute: (from_date, to_date)})
+        elif is_lazy(items):
+            # stays lazy, every template reads the items again
+            sliced[key] = Stream(lambda items=items: window(Stream(items)))
+        elif is_sequence(items):
+            sliced[key] = list(window(items))
+        else:
+            sliced[key] = items
+    return sliced
+
+
 class Command(NoArgsCommand):
     option_list = NoArgsCommand.option_list + (
         make_option('--daily', '-d', default=False, dest='daily',
@@ -71,18 +148,26 @@ class Command(NoArgsCommand):
             action='store_true', help="Print the newsletter."),
         make_option('--regenerate', '-r', default=False, dest='regenerate',
             action='store_true', help="Regenerate newsletter."),
+        make_option('--all-due', '-a', default=False, dest='all_due',
+            action='store_true', help="Every newsletter due today."),
     )
     help = u"Generate newsletter."
 
     def handle_noargs(self, **options):
-        from boletin.models import Newsletter, DAILY, WEEKLY, MONTHLY, PERIOD
+        from boletin.models import DAILY, WEEKLY, MONTHLY
 
         daily = options.get('daily')
         weekly = options.get('weekly')
         monthly = options.get('monthly')
+        all_due = options.get('all_due')
         do_print = options.get('print')
         regenerate = options.get('regenerate')
 
+        if all_due:
+            if daily or weekly or monthly:
+                raise CommandError("Don't use --all-due with --daily, --weekly or --monthly.")
+            self.create_due(regenerate, do_print)
+            return
         if not daily and not weekly and not monthly:
             raise CommandError("Provide one of --daily, --weekly and --monthly.")
         if (daily and weekly) or (weekly and monthly) or (daily and monthly):
@@ -94,14 +179,50 @@ class Command(NoArgsCommand):
             period = WEEKLY
         if monthly:
             period = MONTHLY
-        period_name = dict(PERIOD)[period]
         from_date, to_date = get_dates(period)
 
         # generate content
         function = self.import_generator_function()
         content = function(from_date, to_date)
-        # sanitize content removing empty values
-        content = dict([(k, v) for k, v in content.iteritems() if v])
+        self.create(period, from_date, to_date, content, regenerate, do_print)
+
+    def create_due(self, regenerate=False, do_print=False):
+        """Create every newsletter due today.
+
+        The generator function is called only once, for the widest window,
+        and its content is sliced for the other periods by the
+        ``NEWSLETTER_CONTENT_DATE_ATTRIBUTE`` of its items. Without that
+        setting the generator is called for every period.
+        """
+        from boletin.models import PERIOD
+
+        windows = [(period, get_dates(period)) for period in get_due_periods()]
+        function = self.import_generator_function()
+        attribute = getattr(settings, 'NEWSLETTER_CONTENT_DATE_ATTRIBUTE', None)
+        if attribute and len(windows) > 1:
+            from_date = min([as_datetime(dates[0]) for period, dates in windows])
+            to_date = max([as_datetime(dates[1]) for period, dates in windows])
+            content = function(from_date, to_date)
+            # read once and sliced for every period, except lazy values
+            content = dict(content)
+            for key, items in content.items():
+                if is_sequence(items):
+                    content[key] = list(items)
+        for period, (from_date, to_date) in windows:
+            print "Creating %s newsletter." % dict(PERIOD)[period].lower()
+            if attribute and len(windows) > 1:
+                period_content = slice_content(content, from_date, to_date, attribute)
+            else:
+                period_content = function(from_date, to_date)
+            self.create(period, from_date, to_date, period_content, regenerate, do_print)
+
+    def create(self, period, from_date, to_date, content, regenerate=False, do_print=False):
+        from boletin.models import Newsletter, PERIOD
+        from boletin.personalization import Recipient
+
+        period_name = dict(PERIOD)[period]
+        # sanitize content removing empty values, lazy values are only peeked
+        content = dict([(k, v) for k, v in prepare_content(content).iteritems() if v])
         if not content:
             print "No content, no newsletter."
             return
@@ -109,27 +230,38 @@ class Command(NoArgsCommand):
         site = Site.objects.get_current()
         # create the newsletter
         old_pending = False
+        old_number = None
         try:
             newsletter = Newsletter.objects.get(date=from_date, period=period)
             if regenerate:
                 old_pending = newsletter.pending
+                old_number = newsletter.number
                 newsletter.delete()
                 raise Newsletter.DoesNotExist
             else:
                 print "Already generated."
         except Newsletter.DoesNotExist:
-            number = Newsletter.next_number(period)
+            # a regenerated newsletter keeps its number
+            number = old_number or Newsletter.next_number(period)
             email_context = {
                 'number': number,
                 'period': period_name,
                 'from': from_date,
                 'to': to_date,
                 'site': site,
+                'recipient': Recipient(),
             }
+            # both templates share the lookups done on the content, except
+            # the streamed one, which each template reads again
             email_context.update(content)
             email_context = Context(email_context)
-            message_text = loader.get_template('boletin/newsletter_email.txt').render(email_context)
-            message_html = loader.get_template('boletin/newsletter_email.html').render(email_context)
+            timer = metrics.Timer('render.text')
+            message_text = get_template('boletin/newsletter_email.txt').render(email_context)
+            timer.stop()
+            timer = metrics.Timer('render.html')
+            message_html = get_template('boletin/newsletter_email.html').render(email_context)
+            timer.stop()
+            metrics.incr('newsletters.created')
             newsletter = Newsletter.objects.create(text_content=message_text,
                                                    html_content=message_html,
                                                    number=number,
@@ -152,6 +284,7 @@ class Command(NoArgsCommand):
                           body,
                           settings.NEWSLETTER_EMAIL,
                           [settings.NEWSLETTER_REVIEWER_EMAIL, ])
+        metrics.flush()
         if do_print:
             print newsletter.text_content
 
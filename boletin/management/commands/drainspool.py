@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+import datetime
+import os
+import time
+from optparse import make_option
+
+from django.core.mail import mail_admins
+from django.core.management.base import CommandError, NoArgsCommand
+
+from boletin import metrics
+
+
+class Command(NoArgsCommand):
+    option_list = NoArgsCommand.option_list + (
+        make_option('--newsletter', '-n', default=None, dest='newsletter', type='int',
+            help='Deliver the spool of the newsletter with the given ID.'),
+        make_option('--spool-dir', default=None, dest='spool_dir',
+            help='Directory of the spool.'),
+        make_option('--batch-size', '-b', default=None, dest='batch_size', type='int',
+            help='Number of messages sent through each SMTP connection.'),
+        make_option('--rate', default=None, dest='rate', type='float',
+            help='Maximum number of messages sent per second.'),
+        make_option('--status', default=False, dest='status', action='store_true',
+            help='Show the progress of the spools without delivering anything.'),
+    )
+    help = u"Deliver the newsletter messages written to the spool by sendnewsletter --spool."
+
+    def handle_noargs(self, **options):
+        from boletin.models import (Newsletter, NewsletterSending,
+                                    NewsletterSendingRun, NewsletterSubscription)
+        from boletin.ratelimit import RateLimiter
+        from boletin.sending import SendingRecorder, batches, get_batch_size
+        from boletin.spool import Spool, SpoolMailer, get_spool_dir
+
+        newsletter_id = options.get('newsletter')
+        spool_dir = options.get('spool_dir') or get_spool_dir()
+        batch_size = options.get('batch_size') or get_batch_size()
+        rate = options.get('rate')
+        status = options.get('status')
+        if not spool_dir:
+            raise CommandError("Give a --spool-dir or set NEWSLETTER_SPOOL_DIR.")
+
+        if newsletter_id:
+            ids = [newsletter_id]
+        elif os.path.isdir(spool_dir):
+            ids = [int(name) for name in os.listdir(spool_dir) if name.isdigit()]
+        else:
+            ids = []
+        newsletters = Newsletter.objects.filter(id__in=ids)
+
+        for newsletter in newsletters:
+            spool = Spool.for_newsletter(newsletter, spool_dir)
+            if not spool.exists():
+                print "Newsletter #%s has no spool." % newsletter.number
+                continue
+            done, total = spool.progress()
+            print "%s newsletter #%s: %d of %d messages delivered (%.1f%%)%s." % (
+                newsletter.get_period_display(), newsletter.number, done, total,
+                100.0 * done / total if total else 100.0,
+                not spool.is_complete() and ', still spooling' or '')
+            if status:
+                continue
+
+            run = NewsletterSendingRun.objects.create(newsletter=newsletter)
+            recorder = SendingRecorder(newsletter, run=run)
+            mailer = SpoolMailer(newsletter, limiter=RateLimiter.from_settings(rate))
+            start = time.time()
+            delivered = dropped = 0
+            try:
+                try:
+                    for segment in spool.segments():
+                        position = spool.done(segment)
+                        for batch in batches(spool.pending(segment), batch_size):
+                            # skip the messages delivered before a crash
+                            sent = set(NewsletterSending.objects.filter(newsletter=newsletter,
+                                subscription__in=[m.id for m in batch]).values_list('subscription', flat=True))
+                            pending = [m for m in batch if m.id not in sent]
+                            # drop the subscriptions deleted or unconfirmed since spooling
+                            subscribed = set(NewsletterSubscription.objects.filter(confirmed=True,
+                                id__in=[m.id for m in pending]).values_list('id', flat=True))
+                            batch = [m for m in pending if m.id in subscribed]
+                            if len(batch) < len(pending):
+                                dropped += len(pending) - len(batch)
+                                metrics.incr('spool.dropped', len(pending) - len(batch))
+                            for message, error in batch and mailer.send_batch(batch) or []:
+                                recorder.add(message, error)
+                                if error is not None:
+                                    print "Error sending to &lt;%s&gt;: %s" % (message.email, error)
+                            recorder.flush()
+                            position += len(sent) + len(pending)
+                            spool.set_done(segment, position)
+                            done += len(sent) + len(pending)
+                            delivered += len(batch)
+                            elapsed = time.time() - start
+                            print "Delivered %d of %d messages (%.1f%%, %.1f messages/sec)." % (
+                                done, total, 100.0 * done / total, elapsed and delivered / elapsed or 0)
+                except Exception, e:
+                    mail_admins('Error delivering the spool of newsletter #%s' % newsletter.number, e)
+                    raise CommandError("Error delivering the spool of newsletter #%s: %s" % (
+                        newsletter.number, e))
+            finally:
+                run.finished = datetime.datetime.now()
+                run.save()
+                metrics.flush()
+            done, total = spool.progress()
+            if spool.is_complete() and done == total:
+                newsletter.pending = run.retryable > 0
+                newsletter.save()
+                spool.remove()
+                print "Spool delivered, %d messages failed, %d will be retried with sendnewsletter --resume." % (
+                    run.failed, run.retryable)
+            if dropped:
+                print "%d messages dropped, their subscriptions were removed or unconfirmed." % dropped
+
+        if not newsletters:
+            print "No spools to deliver"
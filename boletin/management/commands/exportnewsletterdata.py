@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+import csv
+import datetime
+import gzip
+import sys
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import simplejson
+
+DEFAULT_CHUNK_SIZE = 1000
+
+# exported columns, with their lookups, and the ones filtered by the options
+EXPORTS = {
+    'subscriptions': {
+        'columns': (('email', 'email'), ('period', 'period'),
+                    ('subscription_date', 'subscription_date'), ('confirmed', 'confirmed')),
+        'period': 'period',
+        'confirmed': 'confirmed',
+        'date': 'subscription_date',
+    },
+    'sendings': {
+        'columns': (('newsletter_id', 'newsletter'), ('period', 'newsletter__period'),
+                    ('number', 'newsletter__number'), ('subscription_id', 'subscription'),
+                    ('email', 'subscription__email'), ('date', 'date')),
+        'period': 'newsletter__period',
+        'confirmed': 'subscription__confirmed',
+        'date': 'date',
+    },
+}
+
+
+def parse_date(value):
+    try:
+        return datetime.datetime.strptime(value, '%Y-%m-%d')
+    except ValueError:
+        raise CommandError("Dates must be given as YYYY-MM-DD: %s" % value)
+
+
+def format_value(value):
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    return value
+
+
+class CSVWriter(object):
+
+    def __init__(self, output, columns):
+        self.writer = csv.writer(output)
+        self.writer.writerow(columns)
+
+    def write(self, row):
+        self.writer.writerow([isinstance(value, unicode) and value.encode('utf-8') or value
+                              for value in map(format_value, row)])
+
+
+class JSONLinesWriter(object):
+
+    def __init__(self, output, columns):
+        self.output = output
+        self.columns = columns
+
+    def write(self, row):
+        self.output.write(simplejson.dumps(dict(zip(self.columns, map(format_value, row)))))
+        self.output.write('\n')
+
+
+WRITERS = {'csv': CSVWriter, 'jsonl': JSONLinesWriter}
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--format', '-f', default='csv', dest='format', choices=WRITERS.keys(),
+            help='Output format: csv or jsonl (JSON Lines).'),
+        make_option('--output', '-o', default=None, dest='output',
+            help='Write to this file instead of the standard output.'),
+        make_option('--gzip', '-z', default=False, dest='gzip', action='store_true',
+            help='Compress the output with gzip.'),
+        make_option('--period', '-p', default=None, dest='period',
+            help='Export only this period: D, W or M.'),
+        make_option('--confirmed', default=None, dest='confirmed', action='store_true',
+            help='Export only confirmed subscriptions.'),
+        make_option('--unconfirmed', default=None, dest='confirmed', action='store_false',
+            help='Export only unconfirmed subscriptions.'),
+        make_option('--since', default=None, dest='since',
+            help='Export only rows from this date on (YYYY-MM-DD).'),
+        make_option('--until', default=None, dest='until',
+            help='Export only rows before this date (YYYY-MM-DD).'),
+        make_option('--chunk-size', default=DEFAULT_CHUNK_SIZE, dest='chunk_size', type='int',
+            help='Number of rows read from the database at once.'),
+    )
+    help = u"Export subscriptions or sendings as CSV or JSON Lines."
+    args = 'subscriptions|sendings'
+
+    def handle(self, *args, **options):
+        from boletin.db import keyset_values
+        from boletin.models import NewsletterSending, NewsletterSubscription
+
+        if len(args) != 1 or args[0] not in EXPORTS:
+            raise CommandError("Give what to export: subscriptions or sendings.")
+        export = EXPORTS[args[0]]
+        if args[0] == 'subscriptions':
+            queryset = NewsletterSubscription.objects.all()
+        else:
+            queryset = NewsletterSending.objects.all()
+        if options.get('period'):
+            queryset = queryset.filter(**{export['period']: options['period']})
+        if options.get('confirmed') is not None:
+            queryset = queryset.filter(**{export['confirmed']: options['confirmed']})
+        if options.get('since'):
+            queryset = queryset.filter(**{export['date'] + '__gte': parse_date(options['since'])})
+        if options.get('until'):
+            queryset = queryset.filter(**{export['date'] + '__lt': parse_date(options['until'])})
+
+        if options.get('output'):
+            output = open(options['output'], 'wb')
+        else:
+            output = sys.stdout
+        stream = output
+        if options.get('gzip'):
+            stream = gzip.GzipFile(fileobj=output, mode='wb')
+
+        start = time.time()
+        count = 0
+        try:
+            columns = [column for column, lookup in export['columns']]
+            lookups = [lookup for column, lookup in export['columns']]
+            writer = WRITERS[options.get('format')](stream, ['id'] + columns)
+            for row in keyset_values(queryset, lookups, options.get('chunk_size')):
+                writer.write(row)
+                count += 1
+        finally:
+            if stream is not output:
+                stream.close()
+            if output is not sys.stdout:
+                output.close()
+        if output is not sys.stdout:
+            elapsed = time.time() - start
+            print "Exported %d %s in %.1fs." % (count, args[0], elapsed)
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+import csv
+import datetime
+import itertools
+import time
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import IntegrityError, transaction
+from django.forms.fields import email_re
+
+DEFAULT_BATCH_SIZE = 1000
+
+
+def read_rows(csv_file, start_line=0, delimiter=','):
+    """Yield ``(line number, email, period)`` for the rows of a CSV file with
+    the email in the first column and, optionally, the period in the second
+    one, starting after the line ``start_line``. Rows which are not valid
+    UTF-8 are yielded as ``(line number, None, None)``.
+
+    >>> from cStringIO import StringIO
+    >>> list(read_rows(StringIO('a@host.net,D\\nb@host.net\\n\\nc@host.net,W\\n'), 1))
+    [(2, u'b@host.net', None), (4, u'c@host.net', u'W')]
+    >>> list(read_rows(StringIO('\\xf1and\\xfa@host.net,W\\n')))
+    [(1, None, None)]
+
+    """
+    reader = csv.reader(csv_file, delimiter=delimiter)
+    for row in itertools.islice(reader, start_line, None):
+        start_line += 1
+        if not row or not row[0].strip():
+            continue
+        try:
+            email = row[0].strip().decode('utf-8')
+            period = len(row) > 1 and row[1].strip().decode('utf-8') or None
+        except UnicodeDecodeError:
+            email = period = None
+        yield start_line, email, period
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--period', '-p', default=None, dest='period',
+            help='Period of the rows without one: D, W or M.'),
+        make_option('--confirmed', '-c', default=False, dest='confirmed',
+            action='store_true', help='Import the subscriptions as confirmed.'),
+        make_option('--batch-size', '-b', default=DEFAULT_BATCH_SIZE, dest='batch_size',
+            type='int', help='Number of rows inserted at once.'),
+        make_option('--start-line', '-s', default=0, dest='start_line', type='int',
+            help='Skip this many lines, to resume an interrupted import.'),
+        make_option('--delimiter', '-d', default=',', dest='delimiter',
+            help='Field delimiter of the CSV file.'),
+    )
+    help = u"Import subscriptions from a CSV file with an email and, optionally, a period in each row."
+    args = '<csv file>'
+
+    def handle(self, *args, **options):
+        from boletin.sending import batches
+
+        if len(args) != 1:
+            raise CommandError("Give the CSV file to import.")
+        default_period = options.get('period')
+        confirmed = options.get('confirmed')
+        batch_size = options.get('batch_size')
+        start_line = options.get('start_line')
+        verbosity = int(options.get('verbosity', 1))
+        periods = getattr(settings, 'NEWSLETTER_PERIODS', ['W'])
+        if default_period is not None and default_period not in periods:
+            raise CommandError("Period %s is not in NEWSLETTER_PERIODS." % default_period)
+
+        try:
+            csv_file = open(args[0], 'rb')
+        except IOError, e:
+            raise CommandError("Can't open %s: %s" % (args[0], e))
+
+        self.imported = self.invalid = self.duplicated = 0
+        line = start_line
+        start = time.time()
+        try:
+            rows = read_rows(csv_file, start_line, options.get('delimiter'))
+            for batch in batches(rows, batch_size):
+                subscriptions = {}
+                for line, email, period in batch:
+                    if email is None:
+                        self.invalid += 1
+                        if verbosity > 1:
+                            print "Line %d: invalid row, it is not UTF-8" % line
+                        continue
+                    period = period or default_period
+                    if not email_re.match(email) or len(email) > 75 or period not in periods:
+                        self.invalid += 1
+                        if verbosity > 1:
+                            print "Line %d: invalid row %s,%s" % (line, email, period)
+                    elif email in subscriptions:
+                        self.duplicated += 1
+                    else:
+                        subscriptions[email] = period
+                self.insert(subscriptions, confirmed)
+                if verbosity > 1:
+                    print "Line %d: %d imported" % (line, self.imported)
+        finally:
+            csv_file.close()
+
+        elapsed = time.time() - start
+        print "Imported %d subscriptions (%d invalid, %d already subscribed) in %.1fs, " \
+              "%.0f rows/sec. Last line read: %d." % (
+            self.imported, self.invalid, self.duplicated, elapsed,
+            elapsed and (line - start_line) / elapsed or 0, line)
+
+    def insert(self, subscriptions, confirmed, retries=1):
+        """Insert the subscriptions, a dictionary of periods by email,
+        skipping the emails which are already subscribed."""
+        from boletin.models import NewsletterSubscription, random_keys
+
+        existing = NewsletterSubscription.objects.filter(
+            email__in=subscriptions.keys()).values_list('email', flat=True)
+        for email in existing:
+            del subscriptions[email]
+            self.duplicated += 1
+        if not subscriptions:
+            return
+        now = datetime.datetime.now()
+        if confirmed:
+            keys = [u''] * len(subscriptions)
+        else:
+            keys = random_keys(len(subscriptions))
+        rows = [(email, period, now, key, confirmed)
+                for (email, period), key in zip(subscriptions.iteritems(), keys)]
+        try:
+            self._insert(rows)
+        except IntegrityError:
+            # subscribed while importing
+            if not retries:
+                raise
+            self.insert(subscriptions, confirmed, retries - 1)
+        else:
+            self.imported += len(rows)
+
+    @transaction.commit_on_success
+    def _insert(self, rows):
+        from boletin.db import bulk_insert
+        from boletin.models import NewsletterSubscription
+        bulk_insert(NewsletterSubscription,
+                    ('email', 'period', 'subscription_date', 'hashkey', 'confirmed'), rows)
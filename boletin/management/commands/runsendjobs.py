@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+import datetime
+import time
+from optparse import make_option
+
+from django.core.management.base import CommandError, NoArgsCommand
+
+
+class Command(NoArgsCommand):
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch-size', '-b', default=None, dest='batch_size', type='int',
+            help='Number of messages sent through each SMTP connection.'),
+        make_option('--workers', '-w', default=1, dest='workers', type='int',
+            help='Number of threads sending in parallel, each one with its own SMTP connection.'),
+        make_option('--sessions', '-s', default=None, dest='sessions', type='int',
+            help='Stream subscribers to up to this number of concurrent SMTP sessions.'),
+        make_option('--rate', default=None, dest='rate', type='float',
+            help='Maximum number of messages sent per second.'),
+        make_option('--loop', '-l', default=False, dest='loop', action='store_true',
+            help='Keep running, looking for new jobs every --interval seconds.'),
+        make_option('--interval', '-i', default=5, dest='interval', type='float',
+            help='Seconds between looks for new jobs with --loop.'),
+        make_option('--lease', default=None, dest='lease', type='int',
+            help='Seconds a running job is reserved for this process.'),
+    )
+    help = u"Run the newsletter sendings queued from the admin."
+
+    def handle_noargs(self, **options):
+        from boletin.models import NewsletterSendJob
+        from boletin.sending import get_lease, get_worker_id
+
+        loop = options.get('loop')
+        interval = options.get('interval')
+        lease = options.get('lease') or get_lease()
+        owner = get_worker_id()
+
+        while True:
+            for job in NewsletterSendJob.objects.get_queued():
+                if not NewsletterSendJob.objects.claim(job, owner, lease):
+                    continue
+                print "Sending newsletter #%s to %d subscribers." % (job.newsletter.number,
+                                                                     job.total)
+                self.run(job, lease, options)
+                progress = job.progress()
+                print "Sent %d messages, %d failed (%.1f messages/sec)." % (
+                    progress['sent'], progress['failed'], progress['rate'])
+                if job.error:
+                    print job.error
+            if not loop:
+                break
+            time.sleep(interval)
+
+    def run(self, job, lease, options):
+        """Send the newsletter of ``job``, resuming an interrupted sending
+        if there is one, and renewing the lease of the job as it goes."""
+        from boletin.management.commands.sendnewsletter import Command as SendNewsletter
+
+        def heartbeat():
+            if not job.renew(lease):
+                raise CommandError("The job was taken for dead, its lease expired.")
+
+        newsletter = job.newsletter
+        try:
+            if not newsletter.pending:
+                job.error = "This newsletter has already been sent"
+            elif not newsletter.reviewed:
+                job.error = "This newsletter hasn't been reviewed"
+            else:
+                # not call_command, which exits on errors instead of raising them
+                try:
+                    SendNewsletter().handle(newsletter=newsletter.id, resume=True,
+                                            batch_size=options.get('batch_size'),
+                                            workers=options.get('workers'),
+                                            sessions=options.get('sessions'),
+                                            rate=options.get('rate'),
+                                            heartbeat=heartbeat)
+                except CommandError, e:
+                    job.error = unicode(e)
+        finally:
+            job.finished = datetime.datetime.now()
+            job.save()
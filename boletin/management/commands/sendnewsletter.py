@@ -1,25 +1,12 @@
 # -*- coding: utf-8 -*-
+import datetime
+import time
 from optparse import make_option
 
-from django.conf import settings
-from django.core.mail import EmailMultiAlternatives, SMTPConnection, mail_admins
+from django.core.mail import mail_admins
 from django.core.management.base import CommandError, NoArgsCommand
 
-
-def send_mail(subject, message_txt, message_html, sender, recipients):
-    """Similar to django's send_mass_mail, but use EmailMultiAlternatives
-    for email messages.
-
-    Also, avoid creating a list with all the messages, use an iterator instead.
-    """
-    connection = SMTPConnection(fail_silently=False)
-
-    def messages_iterator():
-        for recipient in recipients:
-            email = EmailMultiAlternatives(subject, message_txt, sender, recipient)
-            email.attach_alternative(message_html, 'text/html')
-            yield email
-    return connection.send_messages(messages_iterator())
+from boletin import metrics
 
 
 class Command(NoArgsCommand):
@@ -28,15 +15,62 @@ class Command(NoArgsCommand):
             help='Send the newsletter with the given ID.'),
         make_option('--force-unreviewed', '-f', default=False, dest='unreviewed',
             action='store_true', help='Send unreviewed newsletters.'),
+        make_option('--batch-size', '-b', default=None, dest='batch_size', type='int',
+            help='Number of messages sent through each SMTP connection.'),
+        make_option('--workers', '-w', default=1, dest='workers', type='int',
+            help='Number of threads sending in parallel, each one with its own SMTP connection.'),
+        make_option('--sessions', '-s', default=None, dest='sessions', type='int',
+            help='Stream subscribers to up to this number of concurrent SMTP sessions.'),
+        make_option('--flush-size', default=None, dest='flush_size', type='int',
+            help='Number of sendings stored in the database at once.'),
+        make_option('--rate', default=None, dest='rate', type='float',
+            help='Maximum number of messages sent per second.'),
+        make_option('--resume', '-r', default=False, dest='resume',
+            action='store_true', help='Resume the last interrupted sending run.'),
+        make_option('--claim', '-c', default=False, dest='claim',
+            action='store_true', help='Claim chunks of subscribers, cooperating with other hosts.'),
+        make_option('--chunk-size', default=None, dest='chunk_size', type='int',
+            help='Number of subscribers in each claimed chunk.'),
+        make_option('--lease', default=None, dest='lease', type='int',
+            help='Seconds a claimed chunk is reserved for this process.'),
+        make_option('--spool', default=False, dest='spool', action='store_true',
+            help='Write the messages to the spool, to be delivered by drainspool.'),
+        make_option('--spool-dir', default=None, dest='spool_dir',
+            help='Directory of the spool.'),
     )
     help = u"Send newsletter to subscribers."
+    heartbeat = None
 
     def handle_noargs(self, **options):
         from boletin.models import (Newsletter, NewsletterSubscription,
-                                    NewsletterSending)
+                                    NewsletterSendingRun, NewsletterSendingChunk)
+        from boletin.ratelimit import RateLimiter
+        from boletin.sending import (DeliveryError, Sender, SendingRecorder,
+                                     ParallelSender, StreamingSender,
+                                     get_batch_size, get_chunk_size, get_lease,
+                                     get_worker_id)
+        from boletin.spool import Spool, get_spool_dir
 
         newsletter_id = options.get('newsletter')
         send_unreviewed = options.get('unreviewed')
+        batch_size = options.get('batch_size') or get_batch_size()
+        workers = options.get('workers') or 1
+        sessions = options.get('sessions')
+        flush_size = options.get('flush_size')
+        resume = options.get('resume')
+        rate = options.get('rate')
+        claim = options.get('claim')
+        chunk_size = options.get('chunk_size') or get_chunk_size()
+        lease = options.get('lease') or get_lease()
+        spool = options.get('spool')
+        spool_dir = options.get('spool_dir') or get_spool_dir()
+        # called for every result by runsendjobs, to tell it's alive
+        self.heartbeat = options.get('heartbeat')
+        if spool and not spool_dir:
+            raise CommandError("Give a --spool-dir or set NEWSLETTER_SPOOL_DIR.")
+        if claim and resume:
+            raise CommandError("--claim and --resume can't be used together, "
+                               "claimed chunks are resumed by any worker.")
 
         newsletters = Newsletter.objects.get_pending()
         if newsletter_id:
@@ -45,27 +79,98 @@ class Command(NoArgsCommand):
             newsletters = newsletters.filter(reviewed=True)
 
         for newsletter in newsletters:
-            subscribers = NewsletterSubscription.objects.get_pending_sendings(newsletter=newsletter)
+            if spool:
+                self.print_pending(newsletter)
+                self.spool(Spool.for_newsletter(newsletter, spool_dir), newsletter,
+                           NewsletterSubscription.objects.iter_pending_sendings)
+                continue
 
-            # actual sending of emails
-            print "Sending %s newsletter #%s to %d subscribers." % (newsletter.get_period_display().lower(),
-                                                                    newsletter.number,
-                                                                    subscribers.count())
-            subject = '[Saludinnova] Boletín de noticias #%d' % newsletter.number
-            from_email = settings.NEWSLETTER_EMAIL
+            run = None
+            if resume:
+                try:
+                    run = NewsletterSendingRun.objects.get_resumable(newsletter)
+                except NewsletterSendingRun.DoesNotExist:
+                    print "No sending run to resume, starting a new one."
+            if run is None:
+                self.print_pending(newsletter)
+                run = NewsletterSendingRun.objects.create(newsletter=newsletter)
+                retries = []
+            else:
+                # the pending subscribers are not counted, they are the
+                # ones after the checkpoint
+                print "Resuming sending run from subscription #%d, %d sent, %d to be retried." % (
+                    run.checkpoint, run.sent, run.retryable)
+                retries = run.get_retries()
+
+            limiter = RateLimiter.from_settings(rate)
+            if sessions:
+                sender = StreamingSender(newsletter, sessions, batch_size, limiter)
+            elif workers > 1:
+                sender = ParallelSender(newsletter, workers, batch_size, limiter)
+            else:
+                sender = Sender(newsletter, batch_size, limiter)
+            recorder = SendingRecorder(newsletter, flush_size, run)
+            start = time.time()
             try:
-                for subscriber in subscribers:
-                    email = EmailMultiAlternatives(subject, newsletter.text_content, from_email, [subscriber.email])
-                    email.attach_alternative(newsletter.html_content, 'text/html')
-                    email.send()
-                    NewsletterSending.objects.create(subscription=subscriber, newsletter=newsletter)
-                    print "Sent to &lt;%s&gt;" % subscriber.email
+                if claim:
+                    owner = get_worker_id()
+                    print "Split in %d chunks." % NewsletterSendingChunk.objects.create_chunks(
+                        newsletter, chunk_size)
+                    while True:
+                        chunk = NewsletterSendingChunk.objects.claim(newsletter, owner, lease)
+                        if chunk is None:
+                            break
+                        print "Claimed chunk #%d." % chunk.number
+                        self.send(sender, recorder,
+                                  sender.send(chunk.iter_pending_sendings(lease)),
+                                  checkpoint=False)
+                        if sender.errors:
+                            break
+                        if not chunk.finish():
+                            print "Lease of chunk #%d expired." % chunk.number
+                else:
+                    # the retry list goes first, and out of the pending ones:
+                    # its subscribers may be after the checkpoint
+                    if retries:
+                        self.send(sender, recorder, sender.send(retries), checkpoint=False)
+                    if not sender.errors:
+                        retried = set([subscriber.id for subscriber in retries])
+                        pending = lambda subscribers: (subscriber for subscriber in subscribers
+                                                       if subscriber.id not in retried)
+                        if isinstance(sender, ParallelSender):
+                            # a range of ids for each worker, read as it's sent
+                            parts = NewsletterSubscription.objects.split_pending_sendings(
+                                newsletter, workers, after=run.checkpoint or None)
+                            results = sender.send_parts([pending(part) for part in parts])
+                        else:
+                            results = sender.send(pending(
+                                NewsletterSubscription.objects.iter_pending_sendings(
+                                    newsletter=newsletter, after=run.checkpoint or None)))
+                        self.send(sender, recorder, results)
+                if sender.errors:
+                    raise DeliveryError('\n'.join([str(e) for e in sender.errors]))
             except Exception, e:
                 mail_admins('Error sending newsletter #%s' % newsletter.number, e)
+                metrics.flush()
                 raise CommandError("Error sending newsletter!")
-            else:
-                newsletter.pending = False
+            run.finished = datetime.datetime.now()
+            run.save()
+            if not claim:
+                newsletter.pending = run.retryable > 0
+                newsletter.save()
+            elif NewsletterSendingChunk.objects.all_done(newsletter):
+                newsletter.pending = NewsletterSendingRun.objects.filter(
+                    newsletter=newsletter, retryable__gt=0).count() > 0
                 newsletter.save()
+            else:
+                print "Chunks claimed by other workers are still being sent."
+            elapsed = time.time() - start
+            print "Sent %d messages in %.2f seconds (%.1f messages/sec)." % (
+                recorder.recorded, elapsed, elapsed and recorder.recorded / elapsed or 0)
+            if run.failed or run.retryable:
+                print "%d messages failed, %d will be retried with --resume." % (
+                    run.failed, run.retryable)
+            metrics.flush()
 
         if not newsletters:
             if newsletter_id:
@@ -80,3 +185,42 @@ class Command(NoArgsCommand):
                         print "This newsletter hasn't been reviewed"
             else:
                 print "No newsletters to send"
+
+    def print_pending(self, newsletter):
+        from boletin.models import NewsletterSubscription
+        pending = NewsletterSubscription.objects.get_pending_sendings(newsletter=newsletter)
+        print "Sending %s newsletter #%s to %d subscribers." % (newsletter.get_period_display().lower(),
+                                                                newsletter.number,
+                                                                pending.count())
+
+    def spool(self, spool, newsletter, iter_pending_sendings):
+        """Write the pending messages of ``newsletter`` to ``spool``, after
+        the ones already written. The newsletter is no longer pending:
+        drainspool records the sendings as it delivers them."""
+        from boletin.sending import NewsletterMessageTemplate
+        start = time.time()
+        written = spool.write(NewsletterMessageTemplate(newsletter),
+                              iter_pending_sendings(newsletter=newsletter,
+                                                    after=spool.checkpoint() or None))
+        spool.finish()
+        metrics.flush()
+        newsletter.pending = False
+        newsletter.save()
+        elapsed = time.time() - start
+        print "Spooled %d messages to %s in %.2f seconds (%.1f messages/sec)." % (
+            written, spool.path, elapsed, elapsed and written / elapsed or 0)
+
+    def send(self, sender, recorder, results, checkpoint=True):
+        """Store the ``results`` of sending with ``sender`` with ``recorder``,
+        moving its checkpoint forward if ``checkpoint``."""
+        try:
+            for subscriber, error in results:
+                recorder.add(subscriber, error, checkpoint and sender.checkpoint or None)
+                if self.heartbeat is not None:
+                    self.heartbeat()
+                if error is None:
+                    print "Sent to &lt;%s&gt;" % subscriber.email
+                else:
+                    print "Error sending to &lt;%s&gt;: %s" % (subscriber.email, error)
+        finally:
+            recorder.flush(checkpoint and sender.checkpoint or None)
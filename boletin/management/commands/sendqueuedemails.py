@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+import time
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+
+class Command(NoArgsCommand):
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch-size', '-b', default=None, dest='batch_size', type='int',
+            help='Number of emails sent through each SMTP connection.'),
+        make_option('--max-attempts', default=None, dest='max_attempts', type='int',
+            help='Give up on emails which failed this many times.'),
+        make_option('--loop', '-l', default=False, dest='loop', action='store_true',
+            help='Keep running, looking for new emails every --interval seconds.'),
+        make_option('--interval', '-i', default=5, dest='interval', type='float',
+            help='Seconds between looks for new emails with --loop.'),
+    )
+    help = u"Send the emails queued by the subscription views."
+
+    def handle_noargs(self, **options):
+        from boletin.outbox import OutboxSender
+        from boletin.sending import get_batch_size
+
+        batch_size = options.get('batch_size') or get_batch_size()
+        max_attempts = options.get('max_attempts')
+        loop = options.get('loop')
+        interval = options.get('interval')
+
+        while True:
+            sender = OutboxSender(batch_size, max_attempts)
+            sender.run()
+            if sender.sent or sender.failed or sender.given_up or not loop:
+                print "Sent %d emails, %d to be retried, %d given up." % (
+                    sender.sent, sender.failed, sender.given_up)
+            if not loop:
+                break
+            time.sleep(interval)
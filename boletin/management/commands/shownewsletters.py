@@ -2,12 +2,22 @@
 from optparse import make_option
 
 from django.core.management.base import NoArgsCommand
+from django.utils import simplejson
+
+DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+def format_date(value, format=DATETIME_FORMAT):
+    return value and value.strftime(format) or None
 
 
 class Command(NoArgsCommand):
     option_list = NoArgsCommand.option_list + (
         make_option('--only-pending', '-p', default=False, dest='only_pending',
             action='store_true', help="Show only newsletters with pending sendings."),
+        make_option('--json', default=False, dest='json',
+            action='store_true', help="Print the newsletters as JSON. Pending sendings are "
+                                      "estimated as subscribers less messages sent."),
     )
     help = u"Show newsletters."
 
@@ -16,14 +26,31 @@ class Command(NoArgsCommand):
 
         only_pending = options.get('only_pending')
 
+        newsletters = Newsletter.objects.with_stats()
         if only_pending:
-            newsletters = Newsletter.objects.get_pending()
-        else:
-            newsletters = Newsletter.objects.all()
+            newsletters = newsletters.filter(pending=True)
+        newsletters = list(newsletters.order_by('period', 'date', 'id'))
+        for newsletter in newsletters:
+            newsletter['sent'] = newsletter['sent'] or 0
+            # an estimate, removed subscriptions stay in the sent counters
+            newsletter['pending_sendings'] = max(newsletter['subscribers'] - newsletter['sent'], 0)
+
+        if options.get('json'):
+            for newsletter in newsletters:
+                newsletter['date'] = format_date(newsletter['date'], '%Y-%m-%d')
+                newsletter['date_created'] = format_date(newsletter['date_created'])
+                newsletter['last_sent'] = format_date(newsletter['last_sent'])
+            print simplejson.dumps(newsletters)
+            return
 
         for period_code, period_name in PERIOD:
             print u"%s newsletters" % period_name
-            for newsletter in newsletters.filter(period=period_code):
-                pending_string = newsletter.is_pending() and '(*) ' or '    '
-                print "%s%3d. Newsletter #%s" % (pending_string, newsletter.id, newsletter.number)
+            for newsletter in newsletters:
+                if newsletter['period'] != period_code:
+                    continue
+                pending_string = newsletter['pending'] and '(*) ' or '    '
+                print "%s%3d. Newsletter #%s: sent %d, pending %d, last sent %s" % (
+                    pending_string, newsletter['id'], newsletter['number'],
+                    newsletter['sent'], newsletter['pending_sendings'],
+                    format_date(newsletter['last_sent']) or 'never')
             print
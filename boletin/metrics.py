@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+"""Counters and latency histograms of the generation and sending of
+newsletters.
+
+The hot paths measure themselves with ``incr`` and ``Timer``: database
+queries (``db.*``), template rendering (``render.*``), MIME building
+(``mime.*``) and SMTP transactions (``smtp.*``). Measures are accumulated in
+memory by the process ``Metrics`` registry, and every
+``NEWSLETTER_METRICS_INTERVAL`` seconds, and at the end of the commands, a
+snapshot is handed to the sink of ``NEWSLETTER_METRICS_SINK`` and sent with
+the ``metrics_flushed`` signal.
+
+The default sink, ``FileSink``, writes the snapshot as JSON to
+``NEWSLETTER_METRICS_FILE``, if it's set, so the progress of a long sending
+can be followed with ``cat``::
+
+    {"started": "2009-06-01 09:00:00", "updated": "2009-06-01 10:20:00",
+     "counters": {"smtp.sent": 52000, ...},
+     "timings": {"smtp.send": {"count": 52000, "sum": 4120.5, "max": 2.3,
+                               "mean": 0.079, "buckets": [[0.001, 0], ...]}}}
+
+"""
+import bisect
+import datetime
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+from django.dispatch import Signal
+from django.utils import simplejson
+
+DEFAULT_SINK = 'boletin.metrics.FileSink'
+DEFAULT_INTERVAL = 10
+
+# upper bounds of the buckets of the histograms, in seconds
+BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10)
+
+metrics_flushed = Signal(providing_args=['snapshot'])
+
+logger = logging.getLogger('boletin.metrics')
+
+
+def get_metrics_sink():
+    return getattr(settings, 'NEWSLETTER_METRICS_SINK', DEFAULT_SINK)
+
+
+def get_metrics_file():
+    return getattr(settings, 'NEWSLETTER_METRICS_FILE', None)
+
+
+def get_metrics_interval():
+    return getattr(settings, 'NEWSLETTER_METRICS_INTERVAL', DEFAULT_INTERVAL)
+
+
+class Histogram(object):
+    """Distribution of latencies, in seconds, over fixed buckets."""
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def as_dict(self):
+        """The histogram, with the number of values up to every bound
+        (the last bound, ``None``, stands for infinity).
+
+        >>> histogram = Histogram(buckets=(0.1, 1))
+        >>> for value in (0.05, 0.5, 0.7, 3):
+        ...     histogram.add(value)
+        >>> histogram.as_dict()['buckets']
+        [[0.1, 1], [1, 2], [None, 1]]
+
+        """
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'max': self.max,
+            'mean': self.count and self.sum / self.count or 0.0,
+            'buckets': [[bound, count] for bound, count
+                        in zip(list(self.buckets) + [None], self.counts)],
+        }
+
+
+class Timer(object):
+    """Measure the time until ``stop`` is called as a sample of ``name``::
+
+        timer = Timer('smtp.send')
+        try:
+            connection.send_messages(messages)
+        finally:
+            timer.stop()
+
+    """
+
+    def __init__(self, name, metrics=None):
+        self.name = name
+        self.metrics = metrics
+        self.start = time.time()
+
+    def stop(self):
+        elapsed = time.time() - self.start
+        (self.metrics or get_metrics()).timing(self.name, elapsed)
+        return elapsed
+
+
+class Metrics(object):
+    """Registry of counters and histograms, shared by the threads of a
+    process.
+
+    Every ``interval`` seconds the next measure flushes a snapshot to
+    ``sink``, any object with a ``write(snapshot)`` method. Snapshots are
+    cumulative, from the creation of the registry or its last ``reset``.
+    """
+
+    def __init__(self, sink=None, interval=DEFAULT_INTERVAL, clock=time.time):
+        self.sink = sink
+        self.interval = interval
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.lock.acquire()
+        try:
+            self.counters = {}
+            self.histograms = {}
+            self.started = datetime.datetime.now()
+            self.next_flush = self.clock() + self.interval
+        finally:
+            self.lock.release()
+
+    def incr(self, name, value=1):
+        self.lock.acquire()
+        try:
+            self.counters[name] = self.counters.get(name, 0) + value
+        finally:
+            self.lock.release()
+        self.maybe_flush()
+
+    def timing(self, name, seconds):
+        self.lock.acquire()
+        try:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.add(seconds)
+        finally:
+            self.lock.release()
+        self.maybe_flush()
+
+    def timer(self, name):
+        return Timer(name, self)
+
+    def snapshot(self):
+        self.lock.acquire()
+        try:
+            return {
+                'started': self.started.strftime('%Y-%m-%d %H:%M:%S'),
+                'updated': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                'pid': os.getpid(),
+                'counters': dict(self.counters),
+                'timings': dict([(name, histogram.as_dict()) for name, histogram
+                                 in self.histograms.iteritems()]),
+            }
+        finally:
+            self.lock.release()
+
+    def maybe_flush(self):
+        if self.clock() < self.next_flush:
+            return
+        self.lock.acquire()
+        try:
+            due = self.clock() >= self.next_flush
+            if due:
+                self.next_flush = self.clock() + self.interval
+        finally:
+            self.lock.release()
+        if due:
+            self.flush()
+
+    def flush(self):
+        """Hand a snapshot to the sink and the ``metrics_flushed`` signal.
+
+        Errors of the sink and the receivers are logged and ignored: the
+        stats are not worth stopping a sending, they are written again the
+        next time.
+        """
+        self.flush_lock.acquire()
+        try:
+            self.next_flush = self.clock() + self.interval
+            snapshot = self.snapshot()
+            if self.sink is not None:
+                try:
+                    self.sink.write(snapshot)
+                except Exception:
+                    logger.exception("Error writing the metrics to %r", self.sink)
+            for receiver, error in metrics_flushed.send_robust(sender=self, snapshot=snapshot):
+                if isinstance(error, Exception):
+                    logger.error("Error sending the metrics to %r: %s", receiver, error)
+            return snapshot
+        finally:
+            self.flush_lock.release()
+
+
+class FileSink(object):
+    """Write every snapshot as JSON to a file, replacing the previous one.
+    Nothing is written without a ``path`` or ``NEWSLETTER_METRICS_FILE``.
+
+    ``%(pid)s`` in the path is replaced by the id of the process, to keep
+    the stats of several workers apart.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or get_metrics_file()
+
+    def write(self, snapshot):
+        if not self.path:
+            return
+        path = self.path % {'pid': snapshot['pid']}
+        # a private temporary file in the same directory, renamed over the
+        # previous one: readers never see a half written file
+        fd, tmp = tempfile.mkstemp(prefix='.metrics-', dir=os.path.dirname(path) or '.')
+        try:
+            output = os.fdopen(fd, 'w')
+            try:
+                simplejson.dump(snapshot, output, indent=2, sort_keys=True)
+            finally:
+                output.close()
+            os.chmod(tmp, 0644)
+            os.rename(tmp, path)
+        except:
+            os.remove(tmp)
+            raise
+
+
+_metrics = None
+
+
+def get_metrics():
+    """The ``Metrics`` registry of the process, with the sink of
+    ``NEWSLETTER_METRICS_SINK`` (``None`` to keep the measures only in
+    memory)."""
+    global _metrics
+    if _metrics is None:
+        sink = get_metrics_sink()
+        if sink:
+            module_path, class_name = sink.rsplit('.', 1)
+            module = __import__(module_path, {}, {}, [class_name])
+            sink = getattr(module, class_name)()
+        _metrics = Metrics(sink, get_metrics_interval())
+    return _metrics
+
+
+def incr(name, value=1):
+    get_metrics().incr(name, value)
+
+
+def flush():
+    get_metrics().flush()
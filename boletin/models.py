@@ -1,11 +1,16 @@
 # -*- coding: utf-8 -*-
+import datetime
+import math
 import random
 import string
 
-from django.db import models
+from django.conf import settings
+from django.db import DatabaseError, IntegrityError, connection, models, transaction
 from django.utils.translation import ugettext
 from django.utils.translation import ugettext_lazy as _
 
+from boletin.db import CompressedTextField
+
 DAILY = 'D'
 WEEKLY = 'W'
 MONTHLY = 'M'
@@ -17,11 +22,81 @@ PERIOD = (
 )
 
 
+HASHKEY_ALPHABET = [c for c in string.letters + string.digits if ord(c) < 128]
+
+
+def random_keys(count, length=30):
+    """Generate ``count`` random hash keys at once, each one from a single
+    random number.
+
+    >>> [len(key) for key in random_keys(3)]
+    [30, 30, 30]
+
+    """
+    base = len(HASHKEY_ALPHABET)
+    bits = int(math.ceil(length * math.log(base, 2)))
+    keys = []
+    for n in xrange(count):
+        number = random.getrandbits(bits)
+        key = []
+        for x in xrange(length):
+            number, digit = divmod(number, base)
+            key.append(HASHKEY_ALPHABET[digit])
+        keys.append(''.join(key))
+    return keys
+
+
+def summarize(text):
+    if len(text) > 50:
+        return u'%s...' % text[:47]
+    else:
+        return text
+
+
 class NewsletterManager(models.Manager):
 
     def get_pending(self):
         return self.get_query_set().filter(pending=True)
 
+    def listing(self):
+        """Newsletters without their contents, for listing them."""
+        return self.get_query_set().defer('text_content', 'html_content')
+
+    def with_stats(self):
+        """Dictionaries with the fields of the newsletters, without their
+        contents, and their delivery statistics, all in one grouped query.
+        Sendings are not counted, their numbers come from the counters of
+        the sending runs:
+
+        * ``sent``: number of messages sent.
+        * ``last_sent``: date and time the last sending run finished, or
+          ``None``.
+        * ``subscribers``: number of confirmed subscriptions which should
+          get the newsletter, those of its period subscribed before it was
+          created. ``subscribers - sent`` is an estimate of the pending
+          sendings: subscriptions removed after getting the newsletter are
+          counted in ``sent`` but no longer in ``subscribers``.
+
+        """
+        qn = connection.ops.quote_name
+        subscription_opts = NewsletterSubscription._meta
+        subscribers = 'SELECT COUNT(*) FROM %(subscription)s' \
+                      ' WHERE %(subscription)s.%(period)s = %(newsletter)s.%(period)s' \
+                      ' AND %(subscription)s.%(confirmed)s = %%s' \
+                      ' AND %(subscription)s.%(subscription_date)s <= %(newsletter)s.%(date_created)s' % {
+            'subscription': qn(subscription_opts.db_table),
+            'newsletter': qn(self.model._meta.db_table),
+            'period': qn('period'),
+            'confirmed': qn(subscription_opts.get_field('confirmed').column),
+            'subscription_date': qn(subscription_opts.get_field('subscription_date').column),
+            'date_created': qn(self.model._meta.get_field('date_created').column),
+        }
+        return self.get_query_set().extra(
+            select={'subscribers': subscribers}, select_params=(True, ),
+        ).values('id', 'number', 'period', 'date', 'date_created', 'reviewed', 'pending',
+                 'subscribers').annotate(sent=models.Sum('newslettersendingrun__sent'),
+                                         last_sent=models.Max('newslettersendingrun__finished'))
+
 
 class Newsletter(models.Model):
     """A newsletter with HTML and plain text content.
@@ -49,8 +124,9 @@ class Newsletter(models.Model):
     """
     number = models.PositiveIntegerField(_(u'number'))
     period = models.CharField(_(u'periodicity'), choices=PERIOD, max_length=1)
-    text_content = models.TextField(_(u'text content'))
-    html_content = models.TextField(_(u'html content'))
+    text_content = CompressedTextField(_(u'text content'))
+    html_content = CompressedTextField(_(u'html content'))
+    summary = models.CharField(_(u'summary'), max_length=50, blank=True, editable=False)
     date_created = models.DateTimeField(_(u'date created'), auto_now_add=True)
     date = models.DateField(_(u'first day'))
     reviewed = models.BooleanField(_('reviewed?'), default=False)
@@ -66,38 +142,143 @@ class Newsletter(models.Model):
         verbose_name_plural = _(u'newsletters')
 
     def __unicode__(self):
-        if len(self.text_content) > 50:
-            return '%s...' % self.text_content[:47]
-        else:
-            return self.text_content
+        # newsletters saved before the summary existed don't have it
+        return self.summary or summarize(self.text_content)
 
     def save(self, *args, **kwargs):
         if not self.number:
             self.number = Newsletter.next_number(self.period)
+        self.summary = summarize(self.text_content)
         super(Newsletter, self).save(*args, **kwargs)
 
     @classmethod
     def next_number(cls, period):
-        """Compute the number for the next newsletter."""
-        try:
-            number = cls._default_manager.filter(period=period).values('number').order_by('-number')[0]['number']+1
-        except IndexError:
-            number = 1
-        return number
+        """Take the number for the next newsletter of ``period``. Numbers
+        are never handed out twice, even to concurrent processes."""
+        return NewsletterSequence.objects.next_value(period)
 
     def is_pending(self):
         return self.pending
 
 
+class NewsletterSequenceManager(models.Manager):
+
+    @transaction.commit_on_success
+    def next_value(self, period):
+        """Increment the sequence of ``period`` and return its new value.
+
+        The increment is an ``UPDATE``, which locks the row of the sequence
+        until the transaction ends, so concurrent callers wait for each other.
+        On PostgreSQL the value is returned by the same statement with
+        ``RETURNING``. The sequence is committed at once, so numbers taken by
+        failed transactions are not reused.
+        """
+        while True:
+            value = self._increment(period)
+            if value is not None:
+                return value
+            # first number of the period, after any newsletter created
+            # before the sequences existed
+            numbers = Newsletter.objects.filter(period=period).order_by(
+                '-number').values_list('number', flat=True)[:1]
+            value = numbers and numbers[0] + 1 or 1
+            sid = transaction.savepoint()
+            try:
+                self.create(period=period, last=value)
+            except IntegrityError:
+                # another process created it at the same time
+                transaction.savepoint_rollback(sid)
+            else:
+                transaction.savepoint_commit(sid)
+                return value
+
+    def _increment(self, period):
+        if settings.DATABASE_ENGINE.startswith('postgresql'):
+            qn = connection.ops.quote_name
+            cursor = connection.cursor()
+            cursor.execute('UPDATE %(table)s SET %(last)s = %(last)s + 1'
+                           ' WHERE %(period)s = %%s RETURNING %(last)s' % {
+                'table': qn(self.model._meta.db_table),
+                'last': qn('last'),
+                'period': qn('period'),
+            }, [period])
+            transaction.set_dirty()
+            row = cursor.fetchone()
+            return row and row[0] or None
+        sequence = self.get_query_set().filter(period=period)
+        if sequence.update(last=models.F('last') + 1):
+            return sequence.values_list('last', flat=True)[0]
+        return None
+
+
+class NewsletterSequence(models.Model):
+    """The last newsletter number taken in a period."""
+    period = models.CharField(_(u'periodicity'), choices=PERIOD, max_length=1, unique=True)
+    last = models.PositiveIntegerField(_(u'last number'), default=0)
+
+    objects = NewsletterSequenceManager()
+
+    class Meta:
+        verbose_name = _(u'newsletter sequence')
+        verbose_name_plural = _(u'newsletter sequences')
+
+    def __unicode__(self):
+        return u'%s: %d' % (self.get_period_display(), self.last)
+
+
 class NewsletterSubscriptionManager(models.Manager):
 
+    def get_recipients(self, newsletter):
+        """Confirmed subscriptions which should get ``newsletter``, those of
+        its period subscribed before it was created, sent or not."""
+        return self.get_query_set().filter(period=newsletter.period,
+                                           confirmed=True,
+                                           subscription_date__lte=newsletter.date_created)
+
     def get_pending_sendings(self, newsletter=None):
+        """Confirmed subscriptions which haven't received the newsletter yet
+        (the latest one by default)."""
         if newsletter is None:
             newsletter = Newsletter.objects.latest()
-        return self.get_query_set().filter(period=newsletter.period,
-                                           confirmed=True,
-                                           subscription_date__lte=newsletter.date_created,
-                                          ).exclude(newslettersending__newsletter=newsletter)
+        qn = connection.ops.quote_name
+        sending_opts = NewsletterSending._meta
+        not_sent = 'NOT EXISTS (SELECT 1 FROM %(sending)s' \
+                   ' WHERE %(sending)s.%(subscription_id)s = %(subscription)s.%(id)s' \
+                   ' AND %(sending)s.%(newsletter_id)s = %%s)' % {
+            'sending': qn(sending_opts.db_table),
+            'subscription_id': qn(sending_opts.get_field('subscription').column),
+            'newsletter_id': qn(sending_opts.get_field('newsletter').column),
+            'subscription': qn(self.model._meta.db_table),
+            'id': qn(self.model._meta.pk.column),
+        }
+        return self.get_recipients(newsletter).extra(where=[not_sent], params=[newsletter.id])
+
+    def iter_pending_sendings(self, newsletter=None, chunk_size=1000, after=None):
+        """Iterate over the pending sendings of a newsletter in chunks of
+        ``chunk_size`` subscriptions, ordered by id and starting after the
+        subscription id ``after``. Memory usage doesn't depend on the number
+        of subscriptions."""
+        from boletin.db import keyset_iterator
+        return keyset_iterator(self.get_pending_sendings(newsletter),
+                               chunk_size=chunk_size, after=after)
+
+    def split_pending_sendings(self, newsletter, parts, chunk_size=1000, after=None):
+        """Split the pending sendings of a newsletter after the subscription
+        id ``after`` in up to ``parts`` iterators over contiguous id ranges,
+        read like ``iter_pending_sendings``. The ranges split the ids of the
+        recipients evenly, so the pending sendings aren't counted."""
+        from boletin.db import keyset_iterator
+        recipients = self.get_recipients(newsletter)
+        if after is not None:
+            recipients = recipients.filter(id__gt=after)
+        bounds = recipients.aggregate(first=models.Min('id'), last=models.Max('id'))
+        if bounds['first'] is None:
+            return []
+        size = max(1, -(-(bounds['last'] - bounds['first'] + 1) // parts))
+        pending = self.get_pending_sendings(newsletter)
+        return [keyset_iterator(pending.filter(id__lte=first + size - 1),
+                                chunk_size=chunk_size, after=first - 1)
+                for first in xrange(bounds['first'], bounds['last'] + 1, size)]
 
 
 class NewsletterSubscription(models.Model):
@@ -105,7 +286,7 @@ class NewsletterSubscription(models.Model):
     email = models.EmailField(_(u'email'), unique=True)
     period = models.CharField(_(u'periodicity'), choices=PERIOD, max_length=1)
     subscription_date = models.DateTimeField(_(u'subscription date'), auto_now_add=True)
-    hashkey = models.CharField(_(u'hash key'), max_length=100)
+    hashkey = models.CharField(_(u'hash key'), max_length=100, db_index=True)
     confirmed = models.BooleanField(_(u'confirmed'), default=False)
 
     objects = NewsletterSubscriptionManager()
@@ -124,8 +305,13 @@ class NewsletterSubscription(models.Model):
         super(NewsletterSubscription, self).save(*args, **kwargs)
 
     def random_key(self):
-        alphabet = [c for c in string.letters + string.digits if ord(c) < 128]
-        return ''.join([random.choice(alphabet) for x in xrange(30)])
+        return random_keys(1)[0]
+
+    def confirmation_token(self, action):
+        """Signed token for the link confirming ``action`` (``subscribe`` or
+        ``unsubscribe``), see ``boletin.tokens``."""
+        from boletin.tokens import make_token
+        return make_token(self.id, action)
 
 
 class NewsletterSending(models.Model):
@@ -133,3 +319,444 @@ class NewsletterSending(models.Model):
     newsletter = models.ForeignKey(Newsletter, verbose_name=_(u'newsletter'))
     subscription = models.ForeignKey(NewsletterSubscription, verbose_name=_(u'subscription'))
     date = models.DateTimeField(_(u'date and time of sending'), auto_now_add=True)
+
+
+class NewsletterSendingRunManager(models.Manager):
+
+    def get_resumable(self, newsletter):
+        """The last run of ``newsletter`` which was interrupted or left
+        messages to be retried."""
+        return self.get_query_set().filter(newsletter=newsletter).filter(
+            models.Q(finished__isnull=True) | models.Q(retryable__gt=0)).latest()
+
+
+class NewsletterSendingRun(models.Model):
+    '''An execution of sendnewsletter for a newsletter.
+
+    Every subscription with an id lower or equal than ``checkpoint`` has
+    already been handled by the run, so an interrupted run can be resumed
+    from there.
+    '''
+    newsletter = models.ForeignKey(Newsletter, verbose_name=_(u'newsletter'))
+    started = models.DateTimeField(_(u'started'), auto_now_add=True)
+    finished = models.DateTimeField(_(u'finished'), null=True, blank=True)
+    checkpoint = models.PositiveIntegerField(_(u'last handled subscription'), default=0)
+    sent = models.PositiveIntegerField(_(u'sent'), default=0)
+    failed = models.PositiveIntegerField(_(u'failed'), default=0)
+    retryable = models.PositiveIntegerField(_(u'to be retried'), default=0)
+
+    objects = NewsletterSendingRunManager()
+
+    class Meta:
+        ordering = ('started', )
+        get_latest_by = 'started'
+        verbose_name = _(u'newsletter sending run')
+        verbose_name_plural = _(u'newsletter sending runs')
+
+    def __unicode__(self):
+        return ugettext('Sending run of %(newsletter)s') % {'newsletter': self.newsletter}
+
+    def get_retries(self):
+        """The subscriptions in the retry list of this run, to be sent again.
+
+        They stay in the list until the result of sending them again is
+        stored by ``SendingRecorder``, so they are retried again if the
+        process dies meanwhile. Subscriptions which were sent or removed
+        since are taken out of the list.
+        """
+        failures = self.failures.filter(retryable=True)
+        ids = list(failures.values_list('subscription', flat=True))
+        subscriptions = list(NewsletterSubscription.objects.get_pending_sendings(
+            self.newsletter).filter(id__in=ids).order_by('id'))
+        done = set(ids) - set([subscription.id for subscription in subscriptions])
+        if done:
+            self.clear_retries(done)
+        return subscriptions
+
+    @transaction.commit_on_success
+    def clear_retries(self, subscription_ids):
+        """Take ``subscription_ids`` out of the retry list."""
+        self.remove_retries(subscription_ids)
+        self.save()
+
+    def remove_retries(self, subscription_ids):
+        """Delete the retryable failures of ``subscription_ids`` and update
+        the counter, without saving the run."""
+        if not self.retryable or not subscription_ids:
+            return
+        failures = self.failures.filter(retryable=True, subscription__in=list(subscription_ids))
+        ids = list(failures.values_list('id', flat=True))
+        if ids:
+            NewsletterSendingFailure.objects.filter(id__in=ids).delete()
+            self.retryable = max(self.retryable - len(ids), 0)
+
+
+class NewsletterSendingFailure(models.Model):
+    '''A subscriber-level sending which was rejected by the SMTP server.
+
+    Failures with temporary errors are retried when the run is resumed.
+    '''
+    run = models.ForeignKey(NewsletterSendingRun, related_name='failures',
+                            verbose_name=_(u'run'))
+    subscription = models.ForeignKey(NewsletterSubscription, verbose_name=_(u'subscription'))
+    error = models.CharField(_(u'error'), max_length=255)
+    retryable = models.BooleanField(_(u'retryable'), default=False)
+    date = models.DateTimeField(_(u'date and time of failure'), auto_now_add=True)
+
+
+class NewsletterSendingChunkManager(models.Manager):
+
+    def create_chunks(self, newsletter, size):
+        """Split the pending sendings of ``newsletter`` in chunks of ``size``
+        subscriptions, unless it already has chunks, returning their number.
+
+        Chunks are ranges of subscription ids, so they don't change while
+        the newsletter is being sent: new subscriptions don't get it.
+        """
+        existing = self.get_query_set().filter(newsletter=newsletter).count()
+        if existing:
+            return existing
+        ids = NewsletterSubscription.objects.get_pending_sendings(
+            newsletter).order_by('id').values_list('id', flat=True)
+        rows = []
+        after = 0
+        while True:
+            chunk = list(ids.filter(id__gt=after)[:size])
+            if not chunk:
+                break
+            rows.append((newsletter.id, len(rows) + 1, chunk[0], chunk[-1], '', False))
+            after = chunk[-1]
+        try:
+            self._insert_chunks(rows)
+        except IntegrityError:
+            # another worker created them at the same time
+            return self.get_query_set().filter(newsletter=newsletter).count()
+        return len(rows)
+
+    @transaction.commit_on_success
+    def _insert_chunks(self, rows):
+        from boletin.db import bulk_insert
+        bulk_insert(self.model, ('newsletter_id', 'number', 'first', 'last', 'owner', 'done'),
+                    rows)
+
+    @transaction.commit_on_success
+    def claim(self, newsletter, owner, lease):
+        """Claim the first chunk of ``newsletter`` which is not done and
+        whose lease, if any, has expired, for ``lease`` seconds. Returns the
+        chunk or ``None`` if there is nothing left to claim.
+
+        Every claim is a conditional update, so two workers never get the
+        same chunk while its lease lasts, in any database. On PostgreSQL the
+        candidate row is locked with ``FOR UPDATE NOWAIT`` and skipped if
+        another worker holds it.
+        """
+        now = datetime.datetime.now()
+        expires = now + datetime.timedelta(seconds=lease)
+        candidates = self.get_query_set().filter(newsletter=newsletter, done=False).filter(
+            models.Q(lease_expires__isnull=True) | models.Q(lease_expires__lt=now))
+        for chunk_id in candidates.order_by('number').values_list('id', flat=True):
+            if settings.DATABASE_ENGINE.startswith('postgresql') \
+                    and not self._lock(chunk_id):
+                continue
+            claimed = candidates.filter(id=chunk_id).update(owner=owner,
+                                                            lease_expires=expires)
+            if claimed:
+                return self.get_query_set().get(id=chunk_id)
+        return None
+
+    def _lock(self, chunk_id):
+        """Lock the row of a chunk until the end of the transaction, or
+        return ``False`` if another transaction has it."""
+        qn = connection.ops.quote_name
+        cursor = connection.cursor()
+        sid = transaction.savepoint()
+        try:
+            cursor.execute('SELECT 1 FROM %s WHERE %s = %%s FOR UPDATE NOWAIT'
+                           % (qn(self.model._meta.db_table), qn('id')), [chunk_id])
+        except DatabaseError:
+            transaction.savepoint_rollback(sid)
+            return False
+        transaction.savepoint_commit(sid)
+        return True
+
+    def all_done(self, newsletter):
+        return not self.get_query_set().filter(newsletter=newsletter, done=False).count()
+
+
+class NewsletterSendingChunk(models.Model):
+    '''A range of subscriptions to send a newsletter to, claimed by a worker.
+
+    Workers on several hosts can send the same newsletter by claiming
+    chunks. A claim is valid until ``lease_expires``: if the worker dies
+    the chunk can be claimed again by another one.
+    '''
+    newsletter = models.ForeignKey(Newsletter, verbose_name=_(u'newsletter'))
+    number = models.PositiveIntegerField(_(u'number'))
+    first = models.PositiveIntegerField(_(u'first subscription'))
+    last = models.PositiveIntegerField(_(u'last subscription'))
+    owner = models.CharField(_(u'owner'), max_length=100, blank=True)
+    lease_expires = models.DateTimeField(_(u'lease expires'), null=True, blank=True)
+    done = models.BooleanField(_(u'done'), default=False)
+
+    objects = NewsletterSendingChunkManager()
+
+    class Meta:
+        ordering = ('newsletter', 'number')
+        unique_together = (('newsletter', 'number'), )
+        verbose_name = _(u'newsletter sending chunk')
+        verbose_name_plural = _(u'newsletter sending chunks')
+
+    def __unicode__(self):
+        return ugettext('Chunk %(number)d of %(newsletter)s') % {
+            'number': self.number, 'newsletter': self.newsletter}
+
+    def _update_if_owned(self, **kwargs):
+        return NewsletterSendingChunk.objects.filter(id=self.id, owner=self.owner,
+                                                     done=False).update(**kwargs)
+
+    def renew(self, lease):
+        """Extend the lease for ``lease`` seconds, returning ``False`` if it
+        was lost to another worker."""
+        self.lease_expires = datetime.datetime.now() + datetime.timedelta(seconds=lease)
+        return bool(self._update_if_owned(lease_expires=self.lease_expires))
+
+    def finish(self):
+        self.done = True
+        return bool(self._update_if_owned(done=True))
+
+    def get_pending_sendings(self):
+        return NewsletterSubscription.objects.get_pending_sendings(
+            self.newsletter).filter(id__gte=self.first, id__lte=self.last)
+
+    def iter_pending_sendings(self, lease, chunk_size=100):
+        """Iterate over the pending sendings of the chunk like
+        ``NewsletterSubscriptionManager.iter_pending_sendings``, renewing the
+        lease once half of it has passed. Stops if the lease was lost."""
+        from boletin.db import keyset_iterator
+        renew = datetime.datetime.now() + datetime.timedelta(seconds=lease / 2.0)
+        for subscription in keyset_iterator(self.get_pending_sendings(), chunk_size):
+            if datetime.datetime.now() >= renew:
+                if not self.renew(lease):
+                    return
+                renew = datetime.datetime.now() + datetime.timedelta(seconds=lease / 2.0)
+            yield subscription
+
+
+class QueuedEmailManager(models.Manager):
+
+    def queue(self, subject, body, from_email, recipient_list):
+        """Queue an email to be sent by the ``sendqueuedemails`` command.
+        It's saved in the current transaction, so it's only sent if the
+        transaction is committed."""
+        return self.create(subject=subject, body=body, from_email=from_email,
+                           recipients=u','.join(recipient_list),
+                           next_attempt=datetime.datetime.now())
+
+    def get_due(self, now=None):
+        """Emails to be sent now, or to be retried, in the order they were
+        queued. Emails which ran out of attempts are never due."""
+        return self.get_query_set().filter(
+            next_attempt__lte=now or datetime.datetime.now()).order_by('id')
+
+    def claim(self, email, lease):
+        """Put off the next attempt of ``email`` for ``lease`` seconds, so no
+        other worker sends it meanwhile. Returns ``False`` if another worker
+        claimed it first."""
+        now = datetime.datetime.now()
+        next_attempt = now + datetime.timedelta(seconds=lease)
+        # still due, datetimes don't survive every backend exactly for an equality
+        claimed = self.get_query_set().filter(id=email.id, next_attempt__lte=now,
+                                              attempts=email.attempts).update(
+                                                  next_attempt=next_attempt)
+        email.next_attempt = next_attempt
+        return bool(claimed)
+
+
+class QueuedEmail(models.Model):
+    '''An email, like the subscription confirmations, waiting to be sent.
+
+    Emails are deleted once they are sent. ``next_attempt`` is ``NULL`` for
+    the ones which failed too many times, along with the last ``error``.
+    '''
+    subject = models.CharField(_(u'subject'), max_length=255)
+    body = models.TextField(_(u'body'))
+    from_email = models.CharField(_(u'from'), max_length=255)
+    recipients = models.TextField(_(u'recipients'))
+    created = models.DateTimeField(_(u'date created'), auto_now_add=True)
+    next_attempt = models.DateTimeField(_(u'next attempt'), null=True, blank=True, db_index=True)
+    attempts = models.PositiveIntegerField(_(u'attempts'), default=0)
+    error = models.CharField(_(u'last error'), max_length=255, blank=True)
+
+    objects = QueuedEmailManager()
+
+    class Meta:
+        ordering = ('created', )
+        verbose_name = _(u'queued email')
+        verbose_name_plural = _(u'queued emails')
+
+    def __unicode__(self):
+        return ugettext('%(subject)s to %(recipients)s') % {
+            'subject': self.subject, 'recipients': self.recipients}
+
+    def recipient_list(self):
+        return self.recipients.split(u',')
+
+    def message(self):
+        from django.core.mail import EmailMessage
+        return EmailMessage(self.subject, self.body, self.from_email, self.recipient_list())
+
+
+class NewsletterSendJobManager(models.Manager):
+
+    def queue(self, newsletter):
+        """Queue the sending of ``newsletter``, to be run by the
+        ``runsendjobs`` command, unless it's already queued or running."""
+        self.expire(newsletter)
+        try:
+            return self.get_query_set().filter(newsletter=newsletter,
+                                               finished__isnull=True).latest()
+        except NewsletterSendJob.DoesNotExist:
+            return self.create(newsletter=newsletter)
+
+    def get_queued(self):
+        """Jobs waiting for a worker, in the order they were queued."""
+        return self.get_query_set().filter(started__isnull=True).order_by('id')
+
+    def get_running(self, newsletter):
+        return self.get_query_set().filter(newsletter=newsletter, started__isnull=False,
+                                           finished__isnull=True)
+
+    def expire(self, newsletter, now=None):
+        """Finish, as failed, the running jobs of ``newsletter`` whose lease
+        expired: their worker died, and the sending can be queued again."""
+        now = now or datetime.datetime.now()
+        return self.get_running(newsletter).filter(lease_expires__lt=now).update(
+            finished=now, error=ugettext('The worker sending it stopped, queue it again.'))
+
+    def claim(self, job, owner, lease):
+        """Mark ``job`` as started by ``owner`` for ``lease`` seconds, taking
+        an estimate of the number of pending subscribers and the counters its
+        progress is relative to. Returns ``False`` if another worker claimed it first, or
+        if another job of the same newsletter is running: both would resume
+        the same sending run.
+
+        The worker has to ``renew`` the lease while it sends, otherwise the
+        job is taken for dead once the lease expires.
+        """
+        self.expire(job.newsletter_id)
+        if self.get_running(job.newsletter_id).exclude(id=job.id):
+            return False
+        # the recipients less the messages sent, without looking for the
+        # pending sendings one by one
+        job.sent_before, job.failed_before = job.run_counters()
+        job.total = max(NewsletterSubscription.objects.get_recipients(
+            job.newsletter).count() - job.sent_before, 0)
+        job.started = datetime.datetime.now()
+        job.lease_expires = job.started + datetime.timedelta(seconds=lease)
+        job.owner = owner
+        claimed = self.get_query_set().filter(id=job.id, started__isnull=True).update(
+            started=job.started, lease_expires=job.lease_expires, owner=owner,
+            total=job.total, sent_before=job.sent_before, failed_before=job.failed_before)
+        if not claimed:
+            return False
+        # jobs of the same newsletter claimed at the same time: both give up
+        # and are claimed again by the next look for queued jobs
+        if self.get_running(job.newsletter_id).exclude(id=job.id):
+            self.get_query_set().filter(id=job.id).update(started=None, lease_expires=None,
+                                                          owner='')
+            job.started = job.lease_expires = None
+            job.owner = ''
+            return False
+        return True
+
+
+class NewsletterSendJob(models.Model):
+    '''A sending of a newsletter requested from the admin, run in the
+    background by the ``runsendjobs`` command.
+
+    The progress is read from the counters of the sending runs of the
+    newsletter, which ``sendnewsletter`` updates as it goes: ``total`` is the
+    number of recipients of the newsletter less the messages already sent
+    when the job started (an estimate: subscriptions removed since they were
+    sent are still counted as sent), and ``sent_before``
+    and ``failed_before`` the counters of the runs at that moment.
+
+    A running job is reserved for its worker until ``lease_expires``: if the
+    worker dies the job fails and the newsletter can be queued again.
+    '''
+    newsletter = models.ForeignKey(Newsletter, verbose_name=_(u'newsletter'))
+    created = models.DateTimeField(_(u'date created'), auto_now_add=True)
+    started = models.DateTimeField(_(u'started'), null=True, blank=True, db_index=True)
+    finished = models.DateTimeField(_(u'finished'), null=True, blank=True)
+    owner = models.CharField(_(u'owner'), max_length=255, blank=True)
+    lease_expires = models.DateTimeField(_(u'lease expires'), null=True, blank=True)
+    total = models.PositiveIntegerField(_(u'total'), default=0)
+    sent_before = models.PositiveIntegerField(_(u'sent before'), default=0)
+    failed_before = models.PositiveIntegerField(_(u'failed before'), default=0)
+    error = models.TextField(_(u'error'), blank=True)
+
+    objects = NewsletterSendJobManager()
+
+    class Meta:
+        ordering = ('created', )
+        get_latest_by = 'created'
+        verbose_name = _(u'newsletter send job')
+        verbose_name_plural = _(u'newsletter send jobs')
+
+    def __unicode__(self):
+        return ugettext('Send job of %(newsletter)s') % {'newsletter': self.newsletter}
+
+    def get_status(self):
+        if self.started is None:
+            return 'queued'
+        if self.finished is None:
+            return 'running'
+        if self.error:
+            return 'failed'
+        return 'finished'
+
+    def renew(self, lease):
+        """Extend the lease for ``lease`` seconds once half of it has passed,
+        returning ``False`` if the job was taken for dead meanwhile."""
+        now = datetime.datetime.now()
+        if self.lease_expires and self.lease_expires - now > datetime.timedelta(seconds=lease / 2.0):
+            return True
+        self.lease_expires = now + datetime.timedelta(seconds=lease)
+        return bool(NewsletterSendJob.objects.filter(id=self.id, owner=self.owner,
+                                                     finished__isnull=True).update(
+                                                         lease_expires=self.lease_expires))
+
+    def run_counters(self):
+        """Sent and failed messages of every run of the newsletter."""
+        counters = NewsletterSendingRun.objects.filter(newsletter=self.newsletter_id).aggregate(
+            sent=models.Sum('sent'), failed=models.Sum('failed'))
+        return counters['sent'] or 0, counters['failed'] or 0
+
+    def progress(self, now=None):
+        """Progress of the job, with two cheap queries: messages sent,
+        failed and remaining, rate in messages per second and estimated
+        seconds to finish (``None`` if unknown)."""
+        sent = failed = 0
+        if self.started is not None:
+            sent, failed = self.run_counters()
+            sent = max(sent - self.sent_before, 0)
+            failed = max(failed - self.failed_before, 0)
+        remaining = max(self.total - sent - failed, 0)
+        rate = eta = None
+        if self.started is not None:
+            elapsed = (self.finished or now or datetime.datetime.now()) - self.started
+            elapsed = elapsed.days * 86400 + elapsed.seconds + elapsed.microseconds / 1e6
+            rate = elapsed and (sent + failed) / elapsed or 0.0
+            if self.finished is not None:
+                eta = 0
+            elif rate:
+                eta = remaining / rate
+        return {
+            'status': self.get_status(),
+            'total': self.total,
+            'sent': sent,
+            'failed': failed,
+            'remaining': remaining,
+            'rate': rate,
+            'eta': eta,
+        }
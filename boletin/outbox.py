@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""Outbox for the emails sent by the views.
+
+The subscription views don't talk to the SMTP server: they queue their
+confirmation emails as QueuedEmail rows in the request transaction, and the
+``sendqueuedemails`` command delivers them in batches, retrying the ones
+which fail with exponential backoff.
+"""
+import datetime
+import smtplib
+
+from django.conf import settings
+from django.core import mail
+from django.core.mail import send_mail as send_mail_now
+from django.utils.encoding import force_unicode
+
+from boletin.models import QueuedEmail
+from boletin.ratelimit import backoff
+from boletin.sending import CONNECTION_ERRORS, batches
+
+DEFAULT_MAX_ATTEMPTS = 5
+RETRY_BACKOFF = 60
+MAX_RETRY_BACKOFF = 3600
+LEASE = 300
+
+
+def get_queue_emails():
+    return getattr(settings, 'NEWSLETTER_QUEUE_EMAILS', True)
+
+
+def get_max_attempts():
+    return getattr(settings, 'NEWSLETTER_EMAIL_MAX_ATTEMPTS', DEFAULT_MAX_ATTEMPTS)
+
+
+def send_mail(subject, body, from_email, recipient_list):
+    """Queue an email, or send it at once if ``NEWSLETTER_QUEUE_EMAILS`` is
+    off."""
+    if get_queue_emails():
+        QueuedEmail.objects.queue(subject, body, from_email, recipient_list)
+    else:
+        send_mail_now(subject, body, from_email, recipient_list, fail_silently=False)
+
+
+class OutboxSender(object):
+    """Deliver the due queued emails in batches, one SMTP connection per
+    batch.
+
+    Every email is claimed before being sent, so several workers can run
+    at once. Failed emails, whatever the error, are retried later, waiting
+    exponentially longer every time, until they have been tried
+    ``max_attempts`` times; the rest of the batch is sent anyway.
+    """
+
+    def __init__(self, batch_size=100, max_attempts=None):
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts or get_max_attempts()
+        self.sent = self.failed = self.given_up = 0
+
+    def run(self):
+        """Deliver every due email, returning how many were sent."""
+        due = list(QueuedEmail.objects.get_due())
+        for batch in batches(due, self.batch_size):
+            self.send_batch(batch)
+        return self.sent
+
+    def send_batch(self, emails):
+        connection = None
+        try:
+            for email in emails:
+                if not QueuedEmail.objects.claim(email, LEASE):
+                    continue
+                try:
+                    if connection is None:
+                        connection = mail.SMTPConnection(fail_silently=False)
+                        connection.open()
+                    connection.send_messages([email.message()])
+                except Exception, e:
+                    # a broken email (a bad header, say) must not hold back
+                    # the rest of the queue
+                    self.fail(email, e)
+                    if isinstance(e, CONNECTION_ERRORS):
+                        # try again with a new connection
+                        self.close(connection)
+                        connection = None
+                else:
+                    email.delete()
+                    self.sent += 1
+        finally:
+            self.close(connection)
+
+    def close(self, connection):
+        if connection is None:
+            return
+        try:
+            connection.close()
+        except CONNECTION_ERRORS + (smtplib.SMTPException, ):
+            pass
+
+    def fail(self, email, error):
+        email.attempts += 1
+        email.error = force_unicode(error, errors='replace')[:255]
+        if email.attempts >= self.max_attempts:
+            email.next_attempt = None
+            self.given_up += 1
+        else:
+            delay = backoff(email.attempts - 1, base=RETRY_BACKOFF, cap=MAX_RETRY_BACKOFF)
+            email.next_attempt = datetime.datetime.now() + datetime.timedelta(seconds=delay)
+            self.failed += 1
+        email.save()
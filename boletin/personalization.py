@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""Per-subscriber content in newsletters.
+
+``createnewsletter`` renders the newsletter templates only once, with a
+``recipient`` variable whose attributes are placeholders::
+
+    You are subscribed as {{ recipient.email }} ({{ recipient.period }}).
+    Unsubscribe: {{ recipient.unsubscribe_url }}
+
+The placeholders are stored in the newsletter contents, and
+``sendnewsletter`` fills them for every subscriber, which costs about the
+same as joining a few strings.
+"""
+import hmac
+import re
+
+from django.conf import settings
+from django.core.urlresolvers import NoReverseMatch, reverse
+from django.utils.hashcompat import sha_constructor
+from django.utils.html import escape
+from django.utils.safestring import mark_safe
+
+SLOTS = ('email', 'period', 'unsubscribe_url')
+PLACEHOLDER = u'{{{%s}}}'
+
+placeholder_re = re.compile(r'\{\{\{(%s)\}\}\}' % '|'.join(SLOTS))
+
+
+class Recipient(object):
+    """Template variable which renders the placeholder of each slot."""
+
+    def __getattr__(self, name):
+        if name not in SLOTS:
+            raise AttributeError(name)
+        return mark_safe(PLACEHOLDER % name)
+
+
+def has_placeholders(content):
+    return placeholder_re.search(content) is not None
+
+
+def compile_content(content):
+    """Split ``content`` in a list alternating literal strings and slot
+    names, starting and ending with a literal.
+
+    >>> compile_content(u'Hi {{{email}}}, bye')
+    [u'Hi ', u'email', u', bye']
+
+    """
+    return placeholder_re.split(content)
+
+
+def fill(compiled, values):
+    """Join a compiled content with the ``values`` of its slots."""
+    parts = list(compiled)
+    parts[1::2] = [values[name] for name in compiled[1::2]]
+    return u''.join(parts)
+
+
+def unsubscribe_token(subscription_id, email):
+    """Signature of the one-click unsubscription link of a subscriber, an
+    HMAC of ``SECRET_KEY`` like the tokens of ``boletin.tokens``."""
+    message = 'boletin-unsubscribe-link-%s-%s' % (subscription_id, email.encode('utf-8'))
+    return hmac.new(settings.SECRET_KEY, message, sha_constructor).hexdigest()[:20]
+
+
+class RecipientValues(object):
+    """Compute the values of the slots for subscribers.
+
+    Everything which doesn't depend on the subscriber, like the base of the
+    unsubscription URL or the period names, is computed only once, so
+    threads can share an instance.
+    """
+
+    def __init__(self, site):
+        from boletin.models import PERIOD
+        self.periods = dict([(k, unicode(v)) for k, v in PERIOD])
+        try:
+            path = reverse('boletin.views.newsletter_unsubscribe', args=(1, 'token'))
+        except NoReverseMatch:
+            self.unsubscribe_format = None
+        else:
+            path = path.replace('%', '%%').replace('/1/token/', '/%d/%s/')
+            self.unsubscribe_format = u'http://%s%s' % (site.domain, path)
+
+    def unsubscribe_url(self, subscriber):
+        if self.unsubscribe_format is None:
+            return u''
+        return self.unsubscribe_format % (subscriber.id,
+            unsubscribe_token(subscriber.id, subscriber.email))
+
+    def __call__(self, subscriber):
+        """Return the values for the text and the HTML content."""
+        values = {
+            'email': subscriber.email,
+            'period': self.periods.get(subscriber.period, u''),
+            'unsubscribe_url': self.unsubscribe_url(subscriber),
+        }
+        return values, dict([(k, escape(v)) for k, v in values.iteritems()])
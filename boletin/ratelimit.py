@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+import random
+import threading
+import time
+
+from django.conf import settings
+
+DEFAULT_BACKOFF = 1.0
+MAX_BACKOFF = 60.0
+MIN_RATE = 0.1
+
+
+def backoff(attempt, base=None, cap=MAX_BACKOFF):
+    """Seconds to wait before the retry number ``attempt`` (starting at 0):
+    exponential backoff with full jitter.
+
+    >>> 0 <= backoff(3, base=1) <= 8
+    True
+
+    """
+    if base is None:
+        base = getattr(settings, 'NEWSLETTER_BACKOFF', DEFAULT_BACKOFF)
+    return random.random() * min(cap, base * 2 ** attempt)
+
+
+def get_domain(email):
+    return email.rsplit('@', 1)[-1].lower()
+
+
+class TokenBucket(object):
+    """Token bucket allowing ``rate`` messages per second, with bursts of up
+    to ``capacity`` messages.
+
+    The rate can be lowered with ``slow_down`` and raised again with
+    ``speed_up``, but never over ``max_rate`` if there is one.
+
+    """
+
+    def __init__(self, rate, max_rate=None, capacity=None, clock=time.time):
+        self.rate = float(rate)
+        self.max_rate = max_rate
+        self.capacity = capacity or max(1.0, self.rate)
+        self.tokens = self.capacity
+        self.clock = clock
+        self.updated = clock()
+
+    def reserve(self):
+        """Take a token, returning the seconds to wait before using it."""
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        if self.tokens >= 0:
+            return 0
+        return -self.tokens / self.rate
+
+    def slow_down(self, factor=0.5, min_rate=MIN_RATE):
+        self.rate = max(min_rate, self.rate * factor)
+        self.tokens = min(self.tokens, 0)
+
+    def speed_up(self, factor=1.05):
+        self.rate = self.rate * factor
+        if self.max_rate is not None:
+            self.rate = min(self.max_rate, self.rate)
+
+
+class RateLimiter(object):
+    """Pace outgoing messages with a global token bucket and one for each
+    recipient domain.
+
+    Rates adapt to the server: a temporary failure halves the rate of the
+    global and the domain buckets, and every accepted message raises them
+    a little, up to the configured rates. When there is no bucket configured,
+    the first temporary failure creates one with half the rate measured so
+    far, which then grows without limit while messages are accepted.
+
+    ``domain_rates`` maps domains to messages per second; the ``'*'`` key
+    applies to every other domain. The limiter is thread safe.
+
+    """
+
+    def __init__(self, rate=None, domain_rates=None, clock=time.time):
+        self.clock = clock
+        self.started = clock()
+        self.sent = 0
+        self.domain_sent = {}
+        self.bucket = rate and TokenBucket(rate, rate, clock=clock) or None
+        self.domain_rates = dict(domain_rates or {})
+        self.default_domain_rate = self.domain_rates.pop('*', None)
+        self.domains = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_settings(cls, rate=None):
+        return cls(rate or getattr(settings, 'NEWSLETTER_RATE', None),
+                   getattr(settings, 'NEWSLETTER_DOMAIN_RATES', None))
+
+    def domain_bucket(self, domain):
+        if domain not in self.domains:
+            rate = self.domain_rates.get(domain, self.default_domain_rate)
+            self.domains[domain] = rate and TokenBucket(rate, rate, clock=self.clock) or None
+        return self.domains[domain]
+
+    def buckets(self, email):
+        return [bucket for bucket in (self.bucket, self.domain_bucket(get_domain(email)))
+                if bucket is not None]
+
+    def delay(self, email):
+        """Reserve the sending of a message to ``email``, returning the
+        seconds to wait before sending it."""
+        self._lock.acquire()
+        try:
+            return max([0] + [bucket.reserve() for bucket in self.buckets(email)])
+        finally:
+            self._lock.release()
+
+    def succeeded(self, email):
+        self._lock.acquire()
+        try:
+            domain = get_domain(email)
+            self.sent += 1
+            self.domain_sent[domain] = self.domain_sent.get(domain, 0) + 1
+            for bucket in self.buckets(email):
+                bucket.speed_up()
+        finally:
+            self._lock.release()
+
+    def throttled(self, email):
+        """The server replied with a temporary failure for ``email``."""
+        self._lock.acquire()
+        try:
+            domain = get_domain(email)
+            elapsed = float(max(self.clock() - self.started, 1))
+            if self.bucket is None:
+                self.bucket = self.measured_bucket(self.sent / elapsed)
+            else:
+                self.bucket.slow_down()
+            if self.domain_bucket(domain) is None:
+                self.domains[domain] = self.measured_bucket(
+                    self.domain_sent.get(domain, 0) / elapsed)
+            else:
+                self.domains[domain].slow_down()
+        finally:
+            self._lock.release()
+
+    def measured_bucket(self, measured_rate):
+        bucket = TokenBucket(max(measured_rate / 2, MIN_RATE), clock=self.clock)
+        bucket.tokens = 0
+        return bucket
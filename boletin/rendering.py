@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+"""Template rendering helpers for newsletters and emails.
+
+Compiled templates are cached per process, and compiled again when their
+file changes. Newsletter contents are prepared once so that the text and the
+HTML templates share the results of the lookups done on every object, except
+lazy contents (querysets and ``Stream`` objects), which are read again by
+every template so that they are never loaded in memory all at once.
+"""
+import datetime
+import decimal
+import os
+
+from django.conf import settings
+from django.db.models.query import QuerySet
+from django.core.exceptions import ImproperlyConfigured
+from django.template import Context, TemplateDoesNotExist
+from django.template.loader import get_template_from_string, make_origin
+from django.utils.importlib import import_module
+
+_loaders = {}
+_templates = {}
+
+SCALARS = (basestring, int, long, float, bool, decimal.Decimal,
+           datetime.date, datetime.time, type(None))
+
+
+def get_loaders():
+    key = tuple(settings.TEMPLATE_LOADERS)
+    if key not in _loaders:
+        loaders = []
+        for path in settings.TEMPLATE_LOADERS:
+            module, attr = path.rsplit('.', 1)
+            try:
+                loader = getattr(import_module(module), attr)
+            except (ImportError, AttributeError), e:
+                raise ImproperlyConfigured('Error importing template source loader %s: "%s"' % (path, e))
+            if loader.is_usable:
+                loaders.append(loader)
+        _loaders[key] = loaders
+    return _loaders[key]
+
+
+def find_template_source(name):
+    """Like ``django.template.loader.find_template_source``, but returning
+    the path of the template and its loader instead of its origin."""
+    for loader in get_loaders():
+        try:
+            source, path = loader(name)
+        except TemplateDoesNotExist:
+            pass
+        else:
+            return source, path, loader
+    raise TemplateDoesNotExist(name)
+
+
+def get_mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except (OSError, TypeError):
+        # not a file, like the templates in eggs, it never changes
+        return None
+
+
+def get_template(name):
+    """Return the compiled template ``name``, from the cache unless its file
+    was modified. Only the template itself is cached, not the ones it
+    extends or includes."""
+    key = (tuple(settings.TEMPLATE_LOADERS), tuple(settings.TEMPLATE_DIRS), name)
+    cached = _templates.get(key)
+    if cached is not None:
+        template, path, mtime = cached
+        if get_mtime(path) == mtime:
+            return template
+    source, path, loader = find_template_source(name)
+    mtime = get_mtime(path)
+    template = get_template_from_string(source, make_origin(path, loader, name, None), name)
+    _templates[key] = (template, path, mtime)
+    return template
+
+
+def render_to_string(name, dictionary=None, context_instance=None):
+    """``django.template.loader.render_to_string`` using the template cache."""
+    dictionary = dictionary or {}
+    if context_instance is None:
+        context_instance = Context(dictionary)
+    else:
+        context_instance.update(dictionary)
+    return get_template(name).render(context_instance)
+
+
+class Memoized(object):
+    """Callable which calls ``function`` only the first time."""
+
+    def __init__(self, function):
+        self.function = function
+        self.alters_data = getattr(function, 'alters_data', False)
+
+    def __call__(self):
+        if not hasattr(self, 'result'):
+            self.result = self.function()
+        return self.result
+
+
+class PreparedObject(object):
+    """Proxy for a content object which remembers the attributes and the
+    results of the methods looked up by the templates. Item lookups,
+    iteration, length and truth are those of the object."""
+
+    def __init__(self, obj):
+        self.__dict__['_obj'] = obj
+
+    def __getattr__(self, name):
+        value = getattr(self._obj, name)
+        if callable(value):
+            value = Memoized(value)
+        self.__dict__[name] = value
+        return value
+
+    def __setattr__(self, name, value):
+        setattr(self._obj, name, value)
+
+    def __unicode__(self):
+        if '_unicode' not in self.__dict__:
+            self.__dict__['_unicode'] = unicode(self._obj)
+        return self._unicode
+
+    def __str__(self):
+        return self.__unicode__().encode('utf-8')
+
+    def __getitem__(self, key):
+        return self._obj[key]
+
+    def __iter__(self):
+        return iter(self._obj)
+
+    def __len__(self):
+        return len(self._obj)
+
+    def __nonzero__(self):
+        return bool(self._obj)
+
+    def __eq__(self, other):
+        if isinstance(other, PreparedObject):
+            other = other._obj
+        return self._obj == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self._obj)
+
+
+def prepare(value):
+    """Wrap the objects of a content value in PreparedObject, going into
+    dictionaries, lists and tuples, and turning querysets and streams into
+    streams of prepared objects. Other iterables are left as they are, they
+    may not be read twice."""
+    if isinstance(value, SCALARS):
+        return value
+    if isinstance(value, dict):
+        return dict([(key, prepare(item)) for key, item in value.iteritems()])
+    if isinstance(value, (list, tuple)):
+        return [prepare(item) for item in value]
+    if isinstance(value, (Stream, QuerySet)):
+        return Stream(value, prepare)
+    if hasattr(value, '__iter__'):
+        return value
+    return PreparedObject(value)
+
+
+class Stream(object):
+    """Lazy content for the newsletter templates.
+
+    ``iterable`` is read again every time the stream is iterated. It can be
+    a queryset, whose results are not cached, a function returning an
+    iterable, or any object which can be iterated more than once. Telling
+    if the stream is empty only reads its first item. Nothing is kept
+    between iterations: ``wrap`` is called on every item read.
+
+    Generator functions can return streams (querysets are turned into
+    streams automatically), and templates should loop over them with the
+    ``{% streamfor %}`` tag of the ``streaming`` library.
+    """
+
+    def __init__(self, iterable, wrap=None):
+        self.iterable = iterable
+        self.wrap = wrap
+
+    def items(self):
+        if isinstance(self.iterable, QuerySet):
+            return self.iterable.iterator()
+        if callable(self.iterable):
+            return iter(self.iterable())
+        return iter(self.iterable)
+
+    def __iter__(self):
+        for item in self.items():
+            if self.wrap is not None:
+                item = self.wrap(item)
+            yield item
+
+    def __nonzero__(self):
+        if isinstance(self.iterable, QuerySet):
+            return bool(self.iterable[:1])
+        if isinstance(self.iterable, Stream):
+            return bool(self.iterable)
+        for item in self.items():
+            return True
+        return False
+
+
+def prepare_content(content):
+    """Prepare the content returned by the generator function to be
+    rendered by several templates.
+
+    Querysets and streams become streams of PreparedObject, which wrap the
+    items again every time they are read, so their lookups are not shared
+    by the templates. Other iterables are evaluated once and their objects,
+    as well as single objects, are wrapped in PreparedObject; dictionaries,
+    lists and tuples are kept, with their items prepared (see ``prepare``).
+    """
+    prepared = {}
+    for key, value in content.iteritems():
+        if hasattr(value, '__iter__') and not isinstance(value, (dict, Stream, QuerySet)):
+            value = list(value)
+        prepared[key] = prepare(value)
+    return prepared
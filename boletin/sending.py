@@ -0,0 +1,678 @@
+# -*- coding: utf-8 -*-
+import collections
+import datetime
+from email import quoprimime
+import itertools
+import os
+import Queue
+import smtplib
+import socket
+import threading
+import time
+
+from django.conf import settings
+from django.core import mail
+from django.core.mail import EmailMultiAlternatives, make_msgid
+from django.db import transaction
+
+from boletin.db import bulk_insert
+from boletin.metrics import Timer, incr
+from boletin.models import NewsletterSending, NewsletterSendingFailure
+from boletin.personalization import (RecipientValues, compile_content, fill,
+                                     has_placeholders)
+from boletin.ratelimit import RateLimiter, backoff
+
+DEFAULT_BATCH_SIZE = 100
+DEFAULT_FLUSH_SIZE = 100
+DEFAULT_CHUNK_SIZE = 1000
+DEFAULT_LEASE = 300
+
+# errors meaning that the SMTP session is gone and has to be opened again
+CONNECTION_ERRORS = (smtplib.SMTPServerDisconnected,
+                     smtplib.SMTPConnectError,
+                     socket.error)
+
+# errors meaning that the server didn't accept one message
+REJECTION_ERRORS = (smtplib.SMTPRecipientsRefused,
+                    smtplib.SMTPSenderRefused,
+                    smtplib.SMTPDataError)
+
+
+class DeliveryError(Exception):
+    """Raised when some of the messages of a newsletter couldn't be sent."""
+
+
+def get_batch_size():
+    return getattr(settings, 'NEWSLETTER_BATCH_SIZE', DEFAULT_BATCH_SIZE)
+
+
+def get_flush_size():
+    return getattr(settings, 'NEWSLETTER_FLUSH_SIZE', DEFAULT_FLUSH_SIZE)
+
+
+def get_chunk_size():
+    return getattr(settings, 'NEWSLETTER_CHUNK_SIZE', DEFAULT_CHUNK_SIZE)
+
+
+def get_lease():
+    return getattr(settings, 'NEWSLETTER_LEASE', DEFAULT_LEASE)
+
+
+def get_worker_id():
+    """Identify this process among the ones claiming chunks."""
+    return '%s:%d' % (socket.gethostname(), os.getpid())
+
+
+def batches(iterable, size):
+    """Split an iterable in lists of at most ``size`` items, without
+    building a list with all of them.
+
+    >>> list(batches(range(5), 2))
+    [[0, 1], [2, 3], [4]]
+
+    """
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def is_transient(error):
+    """Tell if an SMTP error is temporary (4xx reply codes), so the
+    message may be accepted if it is sent later."""
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        codes = [code for code, message in error.recipients.values()]
+    else:
+        codes = [getattr(error, 'smtp_code', 0)]
+    return bool(codes) and min(codes) >= 400 and max(codes) < 500
+
+
+def is_ascii(value):
+    try:
+        value.encode('ascii')
+    except UnicodeError:
+        return False
+    return True
+
+
+def partition(items, parts):
+    """Split a list in ``parts`` contiguous slices of (almost) the same size.
+
+    >>> partition(range(7), 3)
+    [[0, 1, 2], [3, 4, 5], [6]]
+
+    """
+    size = max(1, -(-len(items) // parts))
+    return [items[i:i + size] for i in xrange(0, len(items), size)]
+
+
+def newsletter_message(newsletter, email, text_content=None, html_content=None):
+    """Build the email message of ``newsletter`` for one recipient, with the
+    given contents instead of the newsletter ones if they are personalized."""
+    subject = '[Saludinnova] Boletín de noticias #%d' % newsletter.number
+    message = EmailMultiAlternatives(subject, text_content or newsletter.text_content,
+                                     settings.NEWSLETTER_EMAIL, [email])
+    message.attach_alternative(html_content or newsletter.html_content, 'text/html')
+    return message
+
+
+def qp_encode(value, maxlinelen=75):
+    """Encode a unicode string as a quoted-printable UTF-8 body, with lines
+    short enough to end all of them with a soft line break."""
+    return quoprimime.body_encode(value.encode('utf-8'), maxlinelen=maxlinelen)
+
+
+class PreparedMessage(object):
+    """A message of a NewsletterMessageTemplate for one recipient.
+
+    It quacks like an EmailMessage as far as SMTPConnection is concerned.
+    """
+
+    def __init__(self, template, email, values=None):
+        self.template = template
+        self.to = [email]
+        self.values = values
+        self.from_email = template.from_email
+        self.subject = template.subject
+        if values is None:
+            self.body = template.body
+            self.alternatives = template.alternatives
+        else:
+            self.body = fill(template.text_compiled, values[0])
+            self.alternatives = [(fill(template.html_compiled, values[1]), 'text/html')]
+
+    def recipients(self):
+        return self.to
+
+    def message(self):
+        return self
+
+    def as_string(self):
+        return self.template.render(self.to[0], self.values)
+
+
+class NewsletterMessageTemplate(object):
+    """The email message of a newsletter, encoded only once.
+
+    The bodies (charset and transfer encoding), the multipart boundaries and
+    the common headers are serialized when the template is created, and only
+    the ``To`` and ``Message-ID`` headers are added for every recipient.
+    Templates are read only, so threads can share them.
+
+    Newsletters with placeholders (see ``boletin.personalization``) have
+    their bodies split in slots: the literal parts are encoded as
+    quoted-printable once, and only the values of every recipient are
+    encoded and joined to them with soft line breaks.
+
+    """
+    TEXT_SLOT = 'BOLETINTEXTCONTENT'
+    HTML_SLOT = 'BOLETINHTMLCONTENT'
+
+    def __init__(self, newsletter):
+        timer = Timer('mime.build')
+        self.newsletter = newsletter
+        self.personalized = has_placeholders(newsletter.text_content) or \
+                            has_placeholders(newsletter.html_content)
+        if self.personalized:
+            message = newsletter_message(newsletter, 'recipient@localhost',
+                                         self.TEXT_SLOT, self.HTML_SLOT)
+        else:
+            message = newsletter_message(newsletter, 'recipient@localhost')
+        self.from_email = message.from_email
+        self.subject = message.subject
+        self.body = message.body
+        self.alternatives = message.alternatives
+        mime = message.message()
+        del mime['To']
+        del mime['Message-ID']
+        self.headers, self.content = mime.as_string().split('\n\n', 1)
+        msgid, host = make_msgid()[1:-1].split('@', 1)
+        self.msgid_format = '<%s.%%d@%s>' % (msgid, host.replace('%', ''))
+        self.counter = itertools.count(1)
+        if self.personalized:
+            self.compile(mime)
+        timer.stop()
+
+    def compile(self, mime):
+        from django.contrib.sites.models import Site
+        self.values = RecipientValues(Site.objects.get_current())
+        self.text_compiled = compile_content(self.newsletter.text_content)
+        self.html_compiled = compile_content(self.newsletter.html_content)
+        encodings = [part['Content-Transfer-Encoding'] for part in mime.walk()
+                     if not part.is_multipart()]
+        if encodings != ['quoted-printable'] * 2 or self.content.count(self.TEXT_SLOT) != 1 \
+                or self.content.count(self.HTML_SLOT) != 1:
+            # the bodies can't be spliced, encode the whole message every time
+            self.parts = None
+            return
+        start, rest = self.content.split(self.TEXT_SLOT)
+        middle, end = rest.split(self.HTML_SLOT)
+        self.parts = (start, [qp_encode(part) for part in self.text_compiled[::2]],
+                      middle, [qp_encode(part) for part in self.html_compiled[::2]],
+                      end)
+
+    def splice(self, encoded, compiled, values):
+        parts = []
+        for i, literal in enumerate(encoded):
+            if i:
+                parts.append(qp_encode(values[compiled[2 * i - 1]]))
+            parts.append(literal)
+        return '=\n'.join([part for part in parts if part])
+
+    def render(self, email, values=None):
+        """Return the serialized message for ``email``, with the ``values``
+        of the placeholders for the text and the HTML content."""
+        msgid = self.msgid_format % self.counter.next()
+        if values is None:
+            content = self.content
+        else:
+            start, text, middle, html, end = self.parts
+            content = ''.join([start, self.splice(text, self.text_compiled, values[0]),
+                               middle, self.splice(html, self.html_compiled, values[1]),
+                               end])
+        return '%s\nTo: %s\nMessage-ID: %s\n\n%s' % (self.headers, email,
+                                                     msgid, content)
+
+    def message(self, email, subscriber=None):
+        """Return the message for ``email``, ready to be sent.
+
+        ``subscriber`` gives the values of the placeholders, if any.
+        """
+        values = None
+        if self.personalized and subscriber is not None:
+            values = self.values(subscriber)
+            if self.parts is None:
+                return newsletter_message(self.newsletter, email,
+                                          fill(self.text_compiled, values[0]),
+                                          fill(self.html_compiled, values[1]))
+        if '\n' in email or '\r' in email or not is_ascii(email):
+            # let Django encode or refuse the header
+            if values is None:
+                return newsletter_message(self.newsletter, email)
+            return newsletter_message(self.newsletter, email,
+                                      fill(self.text_compiled, values[0]),
+                                      fill(self.html_compiled, values[1]))
+        return PreparedMessage(self, str(email), values)
+
+
+class NewsletterMailer(object):
+    """Send a newsletter to batches of subscribers, using only one SMTP
+    session for each batch.
+
+    If the server drops the session in the middle of a batch the connection
+    is opened again and the delivery of the current message is retried, up
+    to ``max_reconnects`` times per batch.
+
+    Messages are paced by ``limiter``, if given, which is told about every
+    temporary failure. Messages with temporary failures are retried up to
+    ``max_retries`` times, waiting an exponential backoff with jitter.
+    Messages rejected by the server don't stop the batch, the error is
+    returned along with the subscriber. Only a permanent rejection of the
+    sender, which would happen for every message, is raised.
+
+    """
+    sleep = staticmethod(time.sleep)
+
+    def __init__(self, newsletter, max_reconnects=3, template=None,
+                 limiter=None, max_retries=2):
+        self.newsletter = newsletter
+        self.max_reconnects = max_reconnects
+        self.template = template or NewsletterMessageTemplate(newsletter)
+        self.limiter = limiter
+        self.max_retries = max_retries
+        self.connection = None
+
+    def open(self):
+        timer = Timer('smtp.connect')
+        self.connection = mail.SMTPConnection(fail_silently=False)
+        self.connection.open()
+        timer.stop()
+
+    def close(self):
+        if self.connection is None:
+            return
+        try:
+            self.connection.close()
+        except CONNECTION_ERRORS + (smtplib.SMTPException, ):
+            pass # the session is already broken, nothing else to do
+        self.connection = None
+
+    def message(self, subscriber):
+        return self.template.message(subscriber.email, subscriber)
+
+    def send_batch(self, subscribers):
+        """Send the newsletter to a batch of subscribers, yielding a
+        ``(subscriber, error)`` tuple as soon as the server has replied to
+        every message. ``error`` is None if the message was accepted.
+        """
+        reconnects = 0
+        self.open()
+        try:
+            for subscriber in subscribers:
+                message = self.message(subscriber)
+                retries = 0
+                while True:
+                    if self.limiter is not None:
+                        delay = self.limiter.delay(subscriber.email)
+                        if delay:
+                            self.sleep(delay)
+                    timer = Timer('smtp.send')
+                    try:
+                        try:
+                            self.connection.send_messages([message])
+                        finally:
+                            timer.stop()
+                    except CONNECTION_ERRORS:
+                        if reconnects >= self.max_reconnects:
+                            raise
+                        reconnects += 1
+                        incr('smtp.reconnects')
+                        self.close()
+                        if reconnects > 1:
+                            self.sleep(backoff(reconnects - 2))
+                        self.open()
+                    except REJECTION_ERRORS, e:
+                        if not is_transient(e):
+                            if isinstance(e, smtplib.SMTPSenderRefused):
+                                raise
+                        else:
+                            if self.limiter is not None:
+                                self.limiter.throttled(subscriber.email)
+                            if retries < self.max_retries:
+                                incr('smtp.retries')
+                                self.sleep(backoff(retries))
+                                retries += 1
+                                continue
+                        incr('smtp.rejected')
+                        yield subscriber, e
+                        break
+                    else:
+                        if self.limiter is not None:
+                            self.limiter.succeeded(subscriber.email)
+                        incr('smtp.sent')
+                        yield subscriber, None
+                        break
+        finally:
+            self.close()
+
+
+class SendingRecorder(object):
+    """Buffer the results of the sendings of a newsletter and store them
+    with bulk inserts every ``flush_size`` results, each flush in its own
+    transaction.
+
+    Delivered subscribers get a NewsletterSending, and rejected ones a
+    NewsletterSendingFailure of ``run``. The counters and checkpoint of the
+    run are updated in the same transaction, which also takes the
+    subscribers sent again out of the retry list of the run.
+
+    If the process dies at most ``flush_size`` results are lost, and those
+    subscribers will get the newsletter again in the next run. Call
+    ``flush`` when done to store the remaining ones.
+
+    """
+
+    def __init__(self, newsletter, flush_size=None, run=None):
+        self.newsletter = newsletter
+        self.flush_size = flush_size or get_flush_size()
+        self.run = run
+        self.checkpoint = run and run.checkpoint or 0
+        self.sent = []
+        self.failures = []
+        self.recorded = 0
+
+    def add(self, subscriber, error=None, checkpoint=None):
+        """Add the result of sending the newsletter to ``subscriber``.
+
+        ``checkpoint`` is the highest subscription id such that every
+        subscription up to it has already been added.
+        """
+        if error is None:
+            self.sent.append(subscriber.id)
+        else:
+            self.failures.append((subscriber.id, str(error)[:255], is_transient(error)))
+        if len(self.sent) + len(self.failures) >= self.flush_size:
+            self.flush(checkpoint)
+        elif checkpoint:
+            self.checkpoint = max(self.checkpoint, checkpoint)
+
+    def flush(self, checkpoint=None):
+        if checkpoint:
+            self.checkpoint = max(self.checkpoint, checkpoint)
+        if self.sent or self.failures:
+            self._insert()
+            self.recorded += len(self.sent)
+            self.sent = []
+            self.failures = []
+        elif self.run and self.run.checkpoint != self.checkpoint:
+            self._insert()
+
+    @transaction.commit_on_success
+    def _insert(self):
+        now = datetime.datetime.now()
+        bulk_insert(NewsletterSending,
+                    ('newsletter_id', 'subscription_id', 'date'),
+                    [(self.newsletter.id, id, now) for id in self.sent])
+        if self.run is None:
+            return
+        # the ones retried leave the retry list, and go back to it if they
+        # failed again
+        self.run.remove_retries(self.sent + [f[0] for f in self.failures])
+        bulk_insert(NewsletterSendingFailure,
+                    ('run_id', 'subscription_id', 'error', 'retryable', 'date'),
+                    [(self.run.id, id, error, retryable, now)
+                     for id, error, retryable in self.failures])
+        retryable = len([f for f in self.failures if f[2]])
+        self.run.sent += len(self.sent)
+        self.run.failed += len(self.failures) - retryable
+        self.run.retryable += retryable
+        self.run.checkpoint = self.checkpoint
+        self.run.save()
+
+
+class Sender(object):
+    """Send a newsletter to an iterable of subscribers, one batch after
+    the other, in the calling thread.
+
+    ``checkpoint`` is the highest subscription id such that every
+    subscription up to it, in the subscribers of the last call to ``send``,
+    has already been yielded.
+
+    """
+
+    def __init__(self, newsletter, batch_size, limiter=None):
+        self.newsletter = newsletter
+        self.batch_size = batch_size
+        self.template = NewsletterMessageTemplate(newsletter)
+        self.limiter = limiter or RateLimiter.from_settings()
+        self.errors = []
+        self.checkpoint = 0
+
+    def mailer(self):
+        return NewsletterMailer(self.newsletter, template=self.template,
+                                limiter=self.limiter)
+
+    def send(self, subscribers):
+        """Send the newsletter to ``subscribers``, yielding a
+        ``(subscriber, error)`` tuple for every one as soon as the server
+        replies.
+        """
+        self.checkpoint = 0
+        mailer = self.mailer()
+        for batch in batches(subscribers, self.batch_size):
+            for result in mailer.send_batch(batch):
+                yield result
+            self.checkpoint = max(self.checkpoint, batch[-1].id)
+
+
+class ThreadedSender(Sender):
+    """Base class for the senders which deliver a newsletter from several
+    threads, each one with its own SMTP connection.
+
+    Threads only talk to the SMTP server: the results are handed back
+    through a queue to the calling thread, which is the only one touching
+    the database. A subscriber is claimed before sending, so it can't be
+    delivered twice even if two threads get it.
+
+    If a thread fails it stops and the error is stored in ``errors``, but the
+    other threads go on.
+
+    """
+
+    def __init__(self, newsletter, workers, batch_size, limiter=None):
+        super(ThreadedSender, self).__init__(newsletter, batch_size, limiter)
+        self.workers = workers
+        self.running = 0
+        self._claimed = set()
+        self._lock = threading.Lock()
+        self.reset()
+
+    def claim(self, subscriber):
+        self._lock.acquire()
+        try:
+            if subscriber.id in self._claimed:
+                return False
+            self._claimed.add(subscriber.id)
+            return True
+        finally:
+            self._lock.release()
+
+    def release(self, batch):
+        """Drop the claims of a batch once it has been sent. Subscribers
+        come in id order, so only the batches being sent can share them."""
+        self._lock.acquire()
+        try:
+            self._claimed.difference_update([subscriber.id for subscriber in batch])
+        finally:
+            self._lock.release()
+
+    def reset(self):
+        """Start tracking the batches of a new iterable of subscribers."""
+        self.checkpoint = 0
+        # the batches from the first one still being sent, by number
+        self._batches = {}
+        self._tracked = 0
+        self._completed = 0
+
+    def track(self, batch):
+        """Register a batch in subscription id order, returning its number."""
+        number = self._tracked
+        self._batches[number] = [batch[-1].id, False]
+        self._tracked += 1
+        return number
+
+    def complete(self, number):
+        """Mark a batch as sent, moving the checkpoint forward over every
+        batch completed since the first one still being sent, which are
+        forgotten."""
+        self._batches[number][1] = True
+        while self._completed in self._batches and self._batches[self._completed][1]:
+            self.checkpoint = max(self.checkpoint, self._batches.pop(self._completed)[0])
+            self._completed += 1
+
+    def start(self, numbered_batches, results):
+        thread = threading.Thread(target=self.work, args=(numbered_batches, results))
+        thread.setDaemon(True)
+        self.running += 1
+        thread.start()
+
+    def finished(self):
+        """Hook called by a thread once it doesn't send anything else."""
+        pass
+
+    def work(self, numbered_batches, results):
+        mailer = self.mailer()
+        try:
+            try:
+                for number, batch in numbered_batches:
+                    batch = [s for s in batch if self.claim(s)]
+                    if batch:
+                        for result in mailer.send_batch(batch):
+                            results.put(('sent', result))
+                        self.release(batch)
+                    results.put(('batch', number))
+            except Exception, e:
+                results.put(('error', e))
+        finally:
+            self.finished()
+            results.put(('done', None))
+
+    def receive(self, results):
+        """Wait for the next message of a thread, returning the result of a
+        sending if it is one."""
+        kind, value = results.get()
+        if kind == 'sent':
+            return value
+        elif kind == 'batch':
+            self.complete(value)
+        elif kind == 'error':
+            self.errors.append(value)
+        else:
+            self.running -= 1
+
+
+class ParallelSender(ThreadedSender):
+    """Send a newsletter with a fixed number of threads.
+
+    Every thread sends a part of the subscribers, a contiguous range of ids
+    after the ones of the previous part. The calling thread reads the batches
+    of every part as its thread needs them, so parts streamed from the
+    database are never loaded in memory.
+
+    """
+
+    def reset(self):
+        super(ParallelSender, self).reset()
+        # for every part, the last ids of its batches being sent, the last
+        # id sent and whether it has been read to the end
+        self._parts = []
+
+    def complete(self, number):
+        """Mark the oldest batch being sent of a part as sent."""
+        part = self._parts[number]
+        part[1] = part[0].popleft()
+        self.advance()
+
+    def advance(self):
+        """Move the checkpoint over the parts completely sent, up to the last
+        batch sent of the first one which isn't."""
+        for pending, sent, exhausted in self._parts:
+            self.checkpoint = max(self.checkpoint, sent)
+            if pending or not exhausted:
+                break
+
+    def feed(self, number, part, queue):
+        """Put batches of a part in the queue of its thread until it's full,
+        returning True once the part has been read to the end."""
+        while not queue.full():
+            try:
+                batch = part.next()
+            except StopIteration:
+                queue.put(None)
+                self._parts[number][2] = True
+                self.advance()
+                return True
+            self._parts[number][0].append(batch[-1].id)
+            queue.put((number, batch))
+        return False
+
+    def send(self, subscribers):
+        """Sort ``subscribers`` by id and send them in ``workers`` parts.
+        They are loaded in memory, use ``send_parts`` for long streams."""
+        subscribers = sorted(subscribers, key=lambda s: s.id)
+        return self.send_parts(partition(subscribers, self.workers))
+
+    def send_parts(self, parts):
+        """Send the newsletter to ``parts``, iterables of subscribers ordered
+        by id, each one after the previous one, with a thread for every part.
+        Yields the results like ``send``."""
+        self.reset()
+        results = Queue.Queue()
+        feeds = []
+        for part in parts:
+            # a couple of batches are read ahead for each thread
+            feeds.append((len(self._parts), batches(part, self.batch_size), Queue.Queue(2)))
+            self._parts.append([collections.deque(), 0, False])
+            self.start(iter(feeds[-1][2].get, None), results)
+        while self.running:
+            feeds = [feed for feed in feeds if not self.feed(*feed)]
+            result = self.receive(results)
+            if result is not None:
+                yield result
+
+
+class StreamingSender(ThreadedSender):
+    """Send a newsletter holding up to ``workers`` concurrent SMTP sessions,
+    fed from a streaming iterator of subscribers.
+
+    Every batch is sent in its own session, and a bounded semaphore limits
+    the sessions running at the same time. Subscribers are read as they are
+    needed, so they don't have to be loaded in memory all at once, and the
+    caller can store the results while the sessions go on sending.
+
+    """
+
+    def __init__(self, newsletter, workers, batch_size, limiter=None):
+        super(StreamingSender, self).__init__(newsletter, workers, batch_size, limiter)
+        self.sessions = threading.BoundedSemaphore(workers)
+
+    def finished(self):
+        self.sessions.release()
+
+    def send(self, subscribers):
+        self.reset()
+        results = Queue.Queue()
+        for batch in batches(subscribers, self.batch_size):
+            while not self.sessions.acquire(False):
+                result = self.receive(results)
+                if result is not None:
+                    yield result
+            self.start([(self.track(batch), batch)], results)
+        while self.running:
+            result = self.receive(results)
+            if result is not None:
+                yield result
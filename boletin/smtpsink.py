@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+"""Local SMTP server which accepts and discards every message, useful to
+measure the delivery throughput of sendnewsletter without a real relay.
+
+Run it from the command line with::
+
+    python -m boletin.smtpsink [host [port]]
+
+and point ``EMAIL_HOST`` and ``EMAIL_PORT`` to it.
+"""
+import asyncore
+import smtpd
+import sys
+import threading
+
+
+class SinkServer(smtpd.SMTPServer):
+
+    def __init__(self, localaddr):
+        smtpd.SMTPServer.__init__(self, localaddr, None)
+        self.received = 0
+
+    @property
+    def port(self):
+        return self.socket.getsockname()[1]
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        self.received += 1
+
+
+def start(host='localhost', port=0):
+    """Start a SinkServer in a background thread and return it.
+
+    With ``port=0`` the operating system chooses a free port, available later
+    as ``server.port``. Call ``stop`` to shut the server down.
+    """
+    server = SinkServer((host, port))
+    server.thread = threading.Thread(target=asyncore.loop,
+                                     kwargs={'timeout': 0.1})
+    server.thread.setDaemon(True)
+    server.thread.start()
+    return server
+
+
+def stop(server):
+    server.close()
+    asyncore.close_all()
+    server.thread.join()
+
+
+if __name__ == '__main__':
+    host = len(sys.argv) > 1 and sys.argv[1] or 'localhost'
+    port = len(sys.argv) > 2 and int(sys.argv[2]) or 1025
+    server = SinkServer((host, port))
+    print "Discarding messages sent to %s:%d" % (host, port)
+    try:
+        asyncore.loop()
+    except KeyboardInterrupt:
+        print "Received %d messages" % server.received
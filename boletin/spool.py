@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+"""On-disk outbox of rendered newsletter messages.
+
+``sendnewsletter --spool`` writes the messages of a newsletter to a spool
+directory and ``drainspool`` delivers them later, so rendering and delivery
+don't have to happen in the same process. The spool of a newsletter is a
+directory with numbered segments::
+
+    00001.msg   the serialized messages, one after the other
+    00001.idx   one line per message: offset, length, subscription id, email
+    00001.done  number of messages of the segment already delivered
+    complete    exists once every pending message has been spooled
+
+Files are only appended to, except the ``.done`` counters, which are
+replaced atomically. An interrupted spooling or drain can be resumed.
+"""
+import os
+import shutil
+
+from django.conf import settings
+
+from boletin.sending import NewsletterMailer
+
+DEFAULT_SEGMENT_SIZE = 10000
+
+
+def get_spool_dir():
+    return getattr(settings, 'NEWSLETTER_SPOOL_DIR', None)
+
+
+def get_segment_size():
+    return getattr(settings, 'NEWSLETTER_SPOOL_SEGMENT_SIZE', DEFAULT_SEGMENT_SIZE)
+
+
+class SpooledMessage(object):
+    """A message read from the spool, standing in both for the subscriber
+    and for the message when it's sent."""
+
+    def __init__(self, id, email, data):
+        self.id = id
+        self.email = email
+        self.to = [email]
+        self.data = data
+
+    def recipients(self):
+        return self.to
+
+    def message(self):
+        return self
+
+    def as_string(self):
+        return self.data
+
+
+class Spool(object):
+    """The spool of a newsletter in the directory ``path``."""
+
+    def __init__(self, path, segment_size=None):
+        self.path = path
+        self.segment_size = segment_size or get_segment_size()
+
+    @classmethod
+    def for_newsletter(cls, newsletter, spool_dir=None):
+        return cls(os.path.join(spool_dir or get_spool_dir(), str(newsletter.id)))
+
+    def exists(self):
+        return os.path.isdir(self.path)
+
+    def filename(self, segment, extension):
+        return os.path.join(self.path, '%05d.%s' % (segment, extension))
+
+    def segments(self):
+        if not self.exists():
+            return []
+        return sorted([int(name[:-4]) for name in os.listdir(self.path)
+                       if name.endswith('.idx')])
+
+    def index(self, segment):
+        """Return the ``(offset, length, subscription id, email)`` entries of
+        a segment. A last line without newline was being written when the
+        process died, and is ignored."""
+        entries = []
+        for line in open(self.filename(segment, 'idx'), 'rb'):
+            if not line.endswith('\n'):
+                break
+            offset, length, id, email = line[:-1].split('\t', 3)
+            entries.append((int(offset), int(length), int(id), email.decode('utf-8')))
+        return entries
+
+    def is_complete(self):
+        return os.path.exists(os.path.join(self.path, 'complete'))
+
+    def checkpoint(self):
+        """The id of the last subscription spooled."""
+        segments = self.segments()
+        if segments:
+            entries = self.index(segments[-1])
+            if entries:
+                return entries[-1][2]
+        return 0
+
+    def write(self, template, subscribers):
+        """Append the messages of ``template`` for ``subscribers``, which
+        should be ordered by id, returning how many were written."""
+        if not self.exists():
+            os.makedirs(self.path)
+        segments = self.segments()
+        segment = segments and segments[-1] or 1
+        messages, index, count = self.open_segment(segment)
+        written = 0
+        try:
+            for subscriber in subscribers:
+                if count >= self.segment_size:
+                    messages.close()
+                    index.close()
+                    segment += 1
+                    messages, index, count = self.open_segment(segment)
+                data = template.message(subscriber.email, subscriber).message().as_string()
+                offset = messages.tell()
+                messages.write(data)
+                messages.flush()
+                index.write('%d\t%d\t%d\t%s\n' % (offset, len(data), subscriber.id,
+                                                   subscriber.email.encode('utf-8')))
+                count += 1
+                written += 1
+        finally:
+            messages.close()
+            index.close()
+        return written
+
+    def open_segment(self, segment):
+        """Open the files of a segment for appending, dropping whatever was
+        written after the last complete index entry."""
+        entries = []
+        index_end = 0
+        if os.path.exists(self.filename(segment, 'idx')):
+            entries = self.index(segment)
+            index_end = open(self.filename(segment, 'idx'), 'rb').read().rfind('\n') + 1
+        end = entries and entries[-1][0] + entries[-1][1] or 0
+        return (self.open_at(self.filename(segment, 'msg'), end),
+                self.open_at(self.filename(segment, 'idx'), index_end),
+                len(entries))
+
+    def open_at(self, filename, end):
+        if not os.path.exists(filename):
+            open(filename, 'wb').close()
+        f = open(filename, 'r+b')
+        f.truncate(end)
+        f.seek(end)
+        return f
+
+    def finish(self):
+        open(os.path.join(self.path, 'complete'), 'wb').close()
+
+    def done(self, segment):
+        try:
+            return int(open(self.filename(segment, 'done'), 'rb').read())
+        except IOError:
+            return 0
+
+    def set_done(self, segment, count):
+        filename = self.filename(segment, 'done')
+        tmp = open(filename + '.tmp', 'wb')
+        try:
+            tmp.write(str(count))
+            tmp.flush()
+            os.fsync(tmp.fileno())
+        finally:
+            tmp.close()
+        os.rename(filename + '.tmp', filename)
+
+    def progress(self):
+        """Return the number of messages delivered and spooled."""
+        done = total = 0
+        for segment in self.segments():
+            done += self.done(segment)
+            total += len(self.index(segment))
+        return done, total
+
+    def pending(self, segment):
+        """Return the messages of a segment which haven't been delivered,
+        reading them lazily."""
+        entries = self.index(segment)[self.done(segment):]
+        messages = open(self.filename(segment, 'msg'), 'rb')
+        try:
+            for offset, length, id, email in entries:
+                messages.seek(offset)
+                yield SpooledMessage(id, email, messages.read(length))
+        finally:
+            messages.close()
+
+    def remove(self):
+        shutil.rmtree(self.path)
+
+
+class SpoolMailer(NewsletterMailer):
+    """NewsletterMailer for SpooledMessage objects, which are sent as they
+    were rendered."""
+
+    def message(self, spooled):
+        return spooled
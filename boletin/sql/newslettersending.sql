@@ -0,0 +1 @@
+CREATE INDEX boletin_newslettersending_newsletter_subscription ON boletin_newslettersending (newsletter_id, subscription_id);
@@ -0,0 +1 @@
+CREATE INDEX boletin_newslettersubscription_pending ON boletin_newslettersubscription (period, confirmed, subscription_date);
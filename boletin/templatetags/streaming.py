@@ -0,0 +1,77 @@
+from django import template
+from django.template import NodeList, Variable, VariableDoesNotExist
+
+register = template.Library()
+
+
+class StreamForNode(template.Node):
+    child_nodelists = ('nodelist_loop', 'nodelist_empty')
+
+    def __init__(self, loopvar, sequence, nodelist_loop, nodelist_empty=None):
+        self.loopvar = loopvar
+        self.sequence = sequence
+        self.nodelist_loop = nodelist_loop
+        self.nodelist_empty = nodelist_empty or NodeList()
+
+    def __iter__(self):
+        for node in self.nodelist_loop:
+            yield node
+        for node in self.nodelist_empty:
+            yield node
+
+    def render(self, context):
+        if 'forloop' in context:
+            parentloop = context['forloop']
+        else:
+            parentloop = {}
+        try:
+            values = self.sequence.resolve(context)
+        except VariableDoesNotExist:
+            values = None
+        if values is None:
+            values = ()
+        chunks = []
+        context.push()
+        loop_dict = context['forloop'] = {'parentloop': parentloop}
+        for i, item in enumerate(values):
+            loop_dict['counter0'] = i
+            loop_dict['counter'] = i + 1
+            loop_dict['first'] = (i == 0)
+            context[self.loopvar] = item
+            chunks.append(self.nodelist_loop.render(context))
+        context.pop()
+        if not chunks:
+            return self.nodelist_empty.render(context)
+        return u''.join(chunks)
+
+
+@register.tag
+def streamfor(parser, token):
+    """Loop over each item of a sequence without loading all of them first,
+    unlike ``{% for %}``, which needs the length of the sequence.
+
+    Usage:
+
+        {% load streaming %}
+        {% streamfor obj in objects %}
+            {{ forloop.counter }}. {{ obj }}
+        {% empty %}
+            No objects.
+        {% endstreamfor %}
+
+    Only ``forloop.counter``, ``forloop.counter0``, ``forloop.first`` and
+    ``forloop.parentloop`` are available, and there's only one loop variable.
+
+    """
+    bits = token.contents.split()
+    if len(bits) != 4 or bits[2] != 'in':
+        raise template.TemplateSyntaxError("'streamfor' statements should use the"
+                                           " format 'streamfor x in y': %s" % token.contents)
+    nodelist_loop = parser.parse(('empty', 'endstreamfor'))
+    token = parser.next_token()
+    if token.contents == 'empty':
+        nodelist_empty = parser.parse(('endstreamfor', ))
+        parser.delete_first_token()
+    else:
+        nodelist_empty = None
+    return StreamForNode(bits[1], Variable(bits[3]), nodelist_loop, nodelist_empty)
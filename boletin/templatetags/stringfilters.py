@@ -2,6 +2,8 @@ from htmlentitydefs import name2codepoint
 import re
 
 from django import template
+from django.utils.encoding import force_unicode
+from django.utils.hashcompat import sha_constructor
 
 register = template.Library()
 
@@ -31,3 +33,106 @@ def entity2unicode(value):
         return entity_re.sub(_replace_entity, value)
     else:
         return value
+
+
+ENTITIES = dict([(name, unichr(codepoint)) for name, codepoint in name2codepoint.iteritems()])
+HTML4_SINGLETS = ('br', 'col', 'link', 'base', 'img', 'param', 'area', 'hr', 'input')
+MAX_CACHED = 10000
+
+words_re = re.compile(r'&.*?;|<.*?>|(\w[\w-]*)', re.U)
+tag_re = re.compile(r'<(/)?([^ ]+?)(?: (/)| .*?)?>')
+strip_re = re.compile(r'<[^>]*?>')
+
+_html2text_cache = {}
+
+
+def truncate(html, length):
+    """Same as ``django.utils.text.truncate_html_words``."""
+    if length <= 0:
+        return u''
+    search = words_re.search
+    pos = ellipsis_pos = words = 0
+    open_tags = []
+    while words <= length:
+        m = search(html, pos)
+        if not m:
+            return html
+        pos = m.end(0)
+        if m.group(1):
+            words += 1
+            if words == length:
+                ellipsis_pos = pos
+            continue
+        if ellipsis_pos:
+            continue
+        tag = tag_re.match(m.group(0))
+        if not tag:
+            continue
+        closing_tag, tagname, self_closing = tag.groups()
+        tagname = tagname.lower()
+        if self_closing or tagname in HTML4_SINGLETS:
+            pass
+        elif closing_tag:
+            if tagname in open_tags:
+                del open_tags[:open_tags.index(tagname) + 1]
+        else:
+            open_tags.insert(0, tagname)
+    return u'%s ...%s' % (html[:ellipsis_pos], u''.join([u'</%s>' % tag for tag in open_tags]))
+
+
+def _entity(match):
+    name = match.group('name')
+    return ENTITIES.get(name) or u'&%s;' % name
+
+
+def wrap(text, width):
+    """Same as ``django.utils.text.wrap``, without doing anything when no
+    line is longer than ``width``."""
+    if len(text) <= width or max([len(line) for line in text.split('\n')]) <= width:
+        return text
+    from django.utils.text import wrap as django_wrap
+    return django_wrap(text, width)
+
+
+def _html2text(value, length, width):
+    text = truncate(value, length)
+    if '<' in text:
+        text = strip_re.sub(u'', text)
+    if '&' in text:
+        text = entity_re.sub(_entity, text)
+    return wrap(text, width)
+
+
+@register.filter
+def html2text(value, arg='25,80'):
+    """Convert HTML to plain text, truncated after a number of words and
+    wrapped at a line length, by default 25 words and 80 characters. The
+    result is the same as
+
+        {{ html_text_var|truncatewords_html:25|striptags|entity2unicode|wordwrap:80 }}
+
+    but in a single filter, and results are cached, so the same text is
+    only converted once per process.
+
+    Usage:
+
+        {% load stringfilters %}
+        {{ html_text_var|html2text }}
+        {{ html_text_var|html2text:"50,72" }}
+
+    """
+    try:
+        length, width = [int(bit) for bit in unicode(arg).split(',')]
+    except ValueError:
+        return value # fail silently, like the builtin filters
+    value = force_unicode(value)
+    # keyed by digest so that the cache doesn't keep the bodies
+    key = (sha_constructor(value.encode('utf-8')).digest(), length, width)
+    try:
+        return _html2text_cache[key]
+    except KeyError:
+        pass
+    if len(_html2text_cache) >= MAX_CACHED:
+        _html2text_cache.clear()
+    text = _html2text_cache[key] = _html2text(value, length, width)
+    return text
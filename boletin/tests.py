@@ -1,19 +1,38 @@
 # -*- coding: utf-8 -*-
 import calendar
 from cStringIO import StringIO
-from datetime import date, timedelta
+from datetime import date, datetime, timedelta
+import email
+import os
 import random
+import shutil
+import smtplib
 import sys
+import tempfile
+import time
 
 from django.conf import settings
 from django.contrib.auth.models import User
 from django.core import mail
 from django.core.management import call_command, CommandError
+from django.template import Context, Template
 from django.template.defaultfilters import linebreaksbr
 from django.test import TestCase, Client
 
 from boletin.management.commands.createnewsletter import Command as CreateNewsletter
-from boletin.models import Newsletter, NewsletterSubscription
+from boletin.management.commands.createnewsletter import get_dates, get_due_periods
+from boletin.management.commands.sendnewsletter import Command as SendNewsletter
+from boletin.models import (Newsletter, NewsletterSubscription, NewsletterSending,
+                            NewsletterSendingRun, NewsletterSendingChunk, NewsletterSequence,
+                            QueuedEmail)
+from boletin import rendering, smtpsink
+from boletin.outbox import OutboxSender
+from boletin.personalization import unsubscribe_token
+from boletin.ratelimit import RateLimiter, TokenBucket, backoff
+from boletin.spool import Spool
+from boletin.tokens import make_token
+from boletin.sending import (NewsletterMailer, NewsletterMessageTemplate,
+                             SendingRecorder, StreamingSender, newsletter_message)
 
 
 class MangleTemplateTestCase(TestCase):
@@ -71,13 +90,16 @@ class NewsletterSubscriptionTests(MangleTemplateTestCase):
                                           'period': 'W'})
         self.assertEquals(response.status_code, 200)
         self.assertTemplateUsed(response, 'boletin/newsletter_success.html')
+        # the confirmation email is queued and sent later
+        self.assertEquals(len(mail.outbox), 0)
+        self.assertEquals(OutboxSender().run(), 1)
         self.assertEquals(len(mail.outbox), 1)
         self.assertTrue('test_user@host.net' in mail.outbox[0].recipients())
-        confirmation_url = '/subscribe/confirm/rnTP3fAbnFbmOHnKYaXRvj7uff0LYT/'
-        self.assertTrue(confirmation_url in mail.outbox[0].body)
         subscription = NewsletterSubscription.objects.get(email='test_user@host.net')
+        confirmation_url = '/subscribe/confirm/%s/' % make_token(subscription.id, 'subscribe')
+        self.assertTrue(confirmation_url in mail.outbox[0].body)
         self.assertEquals(subscription.period, 'W')
-        self.assertEquals(subscription.hashkey, 'rnTP3fAbnFbmOHnKYaXRvj7uff0LYT')
+        self.assertEquals(subscription.hashkey, 'hiWsBEHMVe8abc3KeEqcWELni9ZMoi')
         self.assertEquals(subscription.confirmed, False)
         # the user confirms the subscription
         response = c.get(confirmation_url)
@@ -86,6 +108,29 @@ class NewsletterSubscriptionTests(MangleTemplateTestCase):
         subscription = NewsletterSubscription.objects.get(email='test_user@host.net')
         self.assertEquals(subscription.confirmed, True)
 
+    def testConfirmationKeys(self):
+        """Confirmation links have signed tokens, checked before querying the
+        database, or the hash keys of the subscriptions sent before them."""
+        from django.db import connection
+        from django.http import Http404
+        from boletin.views import get_subscription_for_key
+        subscription = NewsletterSubscription.objects.create(email='test_user@host.net',
+                                                             period='W')
+        token = make_token(subscription.id, 'subscribe')
+        self.assertEquals(get_subscription_for_key(token, 'subscribe'), subscription)
+        self.assertEquals(get_subscription_for_key(subscription.hashkey, 'subscribe'),
+                          subscription)
+        old_debug, settings.DEBUG = settings.DEBUG, True
+        connection.queries = []
+        try:
+            for key in (token, token[:-1] + (token[-1] == '0' and '1' or '0'),
+                        make_token(subscription.id, 'subscribe', days=-1),
+                        'short', 'x' * 100):
+                self.assertRaises(Http404, get_subscription_for_key, key, 'unsubscribe')
+            self.assertEquals(connection.queries, [])
+        finally:
+            settings.DEBUG = old_debug
+
     def testRegisteredUserEmailAutocompletion(self):
         """Registered users have the email field automatically filled in"""
         c = Client()
@@ -106,13 +151,13 @@ class NewsletterSubscriptionTests(MangleTemplateTestCase):
                                           'unsubscribe': True})
         self.assertEquals(response.status_code, 200)
         self.assertTemplateUsed(response, 'boletin/newsletter_unsubscription_success.html')
+        self.assertEquals(OutboxSender().run(), 1)
         self.assertEquals(len(mail.outbox), 1)
         self.assertTrue('test_user@host.net' in mail.outbox[0].recipients())
-        confirmation_url = '/unsubscribe/confirm/H8xIZM1JRcoreogrNwwmq6OLkTkx9N/'
-        self.assertTrue(confirmation_url in mail.outbox[0].body)
         subscription = NewsletterSubscription.objects.get(email='test_user@host.net')
+        confirmation_url = '/unsubscribe/confirm/%s/' % make_token(subscription.id, 'unsubscribe')
+        self.assertTrue(confirmation_url in mail.outbox[0].body)
         self.assertEquals(subscription.period, 'M')
-        self.assertEquals(subscription.hashkey, 'H8xIZM1JRcoreogrNwwmq6OLkTkx9N')
         self.assertEquals(subscription.confirmed, True)
         # the user confirms the unsubscription and it's deleted from DB
         response = c.get(confirmation_url)
@@ -122,10 +167,90 @@ class NewsletterSubscriptionTests(MangleTemplateTestCase):
                           NewsletterSubscription.objects.get, email='test_user@host.net')
 
 
+    def testOneClickUnsubscription(self):
+        """The unsubscription link of the newsletters asks for confirmation,
+        and a POST to it unsubscribes."""
+        c = Client()
+        subscription = NewsletterSubscription.objects.create(email='test_user@host.net',
+                                                             period='M',
+                                                             confirmed='True')
+        token = unsubscribe_token(subscription.id, subscription.email)
+        self.assertNotEquals(token, unsubscribe_token(subscription.id, 'other@host.net'))
+        url = '/unsubscribe/%d/%s/' % (subscription.id, token)
+        response = c.get(url)
+        self.assertEquals(response.status_code, 200)
+        self.assertTemplateUsed(response, 'boletin/newsletter_unsubscribe.html')
+        self.assertTrue(NewsletterSubscription.objects.filter(email='test_user@host.net'))
+        from django.http import Http404, HttpRequest
+        from boletin.views import newsletter_unsubscribe
+        request = HttpRequest()
+        request.method = 'POST'
+        self.assertRaises(Http404, newsletter_unsubscribe, request, subscription.id, 'x' * 20)
+        response = c.post(url, {'List-Unsubscribe': 'One-Click'})
+        self.assertEquals(response.status_code, 200)
+        self.assertTemplateUsed(response, 'boletin/newsletter_unsubscription_confirm.html')
+        self.assertFalse(NewsletterSubscription.objects.filter(email='test_user@host.net'))
+
+    def testQueuedEmailRetries(self):
+        """Queued emails are retried later when the SMTP server fails, and
+        given up after too many attempts."""
+        old_connection = mail.SMTPConnection
+        mail.SMTPConnection = FlakySMTPConnection
+        FlakySMTPConnection.failures = 1
+        try:
+            response = Client().post('/subscribe/', {'email': 'test_user@host.net',
+                                                     'period': 'W'})
+            self.assertEquals(response.status_code, 200)
+            sender = OutboxSender()
+            self.assertEquals(sender.run(), 0)
+            self.assertEquals(sender.failed, 1)
+            email = QueuedEmail.objects.get()
+            self.assertEquals(email.attempts, 1)
+            self.assertTrue('Connection unexpectedly closed' in email.error)
+            QueuedEmail.objects.update(next_attempt=datetime.now())
+            self.assertEquals(OutboxSender().run(), 1)
+            self.assertEquals(len(mail.outbox), 1)
+            self.assertFalse(QueuedEmail.objects.all())
+            # too many failures
+            QueuedEmail.objects.queue(u'Subject', u'Body', 'from@host.net', ['to@host.net'])
+            FlakySMTPConnection.failures = 1
+            sender = OutboxSender(max_attempts=1)
+            sender.run()
+            self.assertEquals(sender.given_up, 1)
+            self.assertEquals(QueuedEmail.objects.get().next_attempt, None)
+            self.assertFalse(QueuedEmail.objects.get_due())
+        finally:
+            mail.SMTPConnection = old_connection
+            FlakySMTPConnection.failures = 0
+
+    def testQueuedEmailBroken(self):
+        """An email which can't be built is retried later and doesn't stop
+        the sending of the rest."""
+        QueuedEmail.objects.queue(u'Broken\nsubject', u'Body', 'from@host.net', ['to@host.net'])
+        QueuedEmail.objects.queue(u'Subject', u'Body', 'from@host.net', ['to@host.net'])
+        old_connection = mail.SMTPConnection
+        mail.SMTPConnection = EncodingSMTPConnection
+        FlakySMTPConnection.opened = 0
+        try:
+            sender = OutboxSender()
+            self.assertEquals(sender.run(), 1)
+        finally:
+            mail.SMTPConnection = old_connection
+        self.assertEquals(sender.failed, 1)
+        self.assertEquals(FlakySMTPConnection.opened, 1)
+        self.assertEquals(len(mail.outbox), 1)
+        self.assertEquals(mail.outbox[0].subject, u'Subject')
+        email = QueuedEmail.objects.get()
+        self.assertEquals(email.attempts, 1)
+        self.assertTrue(email.next_attempt > datetime.now())
+        self.assertTrue('Header values can\'t contain newlines' in email.error)
+
+
 class NewsletterCommandTestCase(MangleTemplateTestCase):
     """Base TestCase class for the testing of newsletter commands.
 
     """
+    urls = 'boletin.tests_urls'
 
     def setUp(self):
         MangleTemplateTestCase.setUp(self)
@@ -146,6 +271,22 @@ def generate_content(from_date, to_date):
     return {'objects': objects}
 
 
+generator_calls = []
+
+
+def counting_generate_content(from_date, to_date):
+    generator_calls.append((from_date, to_date))
+    return generate_content(from_date, to_date)
+
+
+def mixed_generate_content(from_date, to_date):
+    generator_calls.append((from_date, to_date))
+    content = generate_content(from_date, to_date)
+    content['title'] = u'Latest subscriptions'
+    content['streamed'] = rendering.Stream(content['objects'])
+    return content
+
+
 class CreateNewsletterCommandTests(NewsletterCommandTestCase):
     """Test the createnewsletter command for the automatic generation of
     newsletters.
@@ -184,6 +325,197 @@ class CreateNewsletterCommandTests(NewsletterCommandTestCase):
         output = self.executeCommand('createnewsletter', daily=True)
         Newsletter.objects.get(number=1, period='D')
 
+    def testCreateNewsletterPlaceholders(self):
+        """Per-subscriber content is stored as placeholders."""
+        self.obj.subscription_date = self.obj.subscription_date-timedelta(days=1)
+        self.obj.save()
+        self.executeCommand('createnewsletter', daily=True)
+        newsletter = Newsletter.objects.get(number=1, period='D')
+        for content in (newsletter.text_content, newsletter.html_content):
+            self.assertTrue('{{{unsubscribe_url}}}' in content)
+            self.assertTrue('{{{email}}}' in content)
+
+    def testDuePeriods(self):
+        """Daily newsletters are due every day, weekly ones on Mondays and
+        monthly ones on the first day of the month."""
+        old_periods = settings.NEWSLETTER_PERIODS
+        settings.NEWSLETTER_PERIODS = ['D', 'W', 'M']
+        try:
+            self.assertEquals(get_due_periods(date(2009, 6, 1)), ['D', 'W', 'M'])
+            self.assertEquals(get_due_periods(date(2009, 6, 2)), ['D'])
+            self.assertEquals(get_due_periods(date(2009, 6, 8)), ['D', 'W'])
+            self.assertEquals(get_due_periods(date(2009, 7, 1)), ['D', 'M'])
+            settings.NEWSLETTER_PERIODS = ['W', 'M']
+            self.assertEquals(get_due_periods(date(2009, 6, 1)), ['W', 'M'])
+        finally:
+            settings.NEWSLETTER_PERIODS = old_periods
+
+    def testCreateNewsletterAllDue(self):
+        """createnewsletter --all-due fetches the content once and slices it
+        for every due period."""
+        from boletin.management.commands import createnewsletter
+        old_get_due_periods = createnewsletter.get_due_periods
+        createnewsletter.get_due_periods = lambda today=None: ['D', 'W', 'M']
+        settings.NEWSLETTER_GENERATOR_FUNCTION = 'boletin.tests.counting_generate_content'
+        settings.NEWSLETTER_CONTENT_DATE_ATTRIBUTE = 'subscription_date'
+        NewsletterSubscription.objects.filter(id=self.obj.id).update(
+            subscription_date=get_dates('D')[0] + timedelta(hours=1))
+        NewsletterSubscription.objects.create(email='monthly@host.net', period='M')
+        NewsletterSubscription.objects.filter(email='monthly@host.net').update(
+            subscription_date=get_dates('M')[0] + timedelta(hours=1))
+        del generator_calls[:]
+        try:
+            output = self.executeCommand('createnewsletter', all_due=True)
+        finally:
+            createnewsletter.get_due_periods = old_get_due_periods
+            del settings.NEWSLETTER_CONTENT_DATE_ATTRIBUTE
+        self.assertEquals(len(generator_calls), 1)
+        daily = Newsletter.objects.get(period='D')
+        self.assertTrue('test_user@host.net' in daily.text_content)
+        self.assertFalse('monthly@host.net' in daily.text_content)
+        monthly = Newsletter.objects.get(period='M')
+        self.assertTrue('monthly@host.net' in monthly.text_content)
+        self.assertRaises(CommandError, CreateNewsletter().handle,
+                          all_due=True, daily=True)
+
+    def testSliceLazyContent(self):
+        """createnewsletter --all-due keeps querysets and streams lazy, and
+        other values as they are."""
+        from boletin.management.commands import createnewsletter
+        from django.db.models.query import QuerySet
+        old_get_due_periods = createnewsletter.get_due_periods
+        createnewsletter.get_due_periods = lambda today=None: ['D', 'M']
+        settings.NEWSLETTER_GENERATOR_FUNCTION = 'boletin.tests.mixed_generate_content'
+        settings.NEWSLETTER_CONTENT_DATE_ATTRIBUTE = 'subscription_date'
+        NewsletterSubscription.objects.filter(id=self.obj.id).update(
+            subscription_date=get_dates('D')[0] + timedelta(hours=1))
+        del generator_calls[:]
+        try:
+            self.executeCommand('createnewsletter', all_due=True)
+        finally:
+            createnewsletter.get_due_periods = old_get_due_periods
+            del settings.NEWSLETTER_CONTENT_DATE_ATTRIBUTE
+        self.assertEquals(len(generator_calls), 1)
+        self.assertEquals(Newsletter.objects.count(), 2)
+        from_date, to_date = get_dates('D')
+        content = mixed_generate_content(get_dates('M')[0], to_date)
+        sliced = createnewsletter.slice_content(content, from_date, to_date,
+                                                'subscription_date')
+        self.assertTrue(isinstance(sliced['objects'], QuerySet))
+        self.assertEquals([s.email for s in sliced['objects']], ['test_user@host.net'])
+        self.assertTrue(isinstance(sliced['streamed'], rendering.Stream))
+        self.assertEquals([s.email for s in sliced['streamed']], ['test_user@host.net'])
+        self.assertEquals(sliced['title'], u'Latest subscriptions')
+
+    def testTemplateCache(self):
+        """Compiled templates are cached until their file changes."""
+        template_dir = tempfile.mkdtemp()
+        old_dirs = settings.TEMPLATE_DIRS
+        settings.TEMPLATE_DIRS = (template_dir, )
+        filename = os.path.join(template_dir, 'cached.txt')
+        try:
+            open(filename, 'w').write('First {{ value }}')
+            template = rendering.get_template('cached.txt')
+            self.assertTrue(rendering.get_template('cached.txt') is template)
+            self.assertEquals(template.render(Context({'value': 1})), 'First 1')
+            open(filename, 'w').write('Second {{ value }}')
+            os.utime(filename, (0, os.stat(filename).st_mtime + 10))
+            self.assertEquals(rendering.render_to_string('cached.txt', {'value': 2}), 'Second 2')
+        finally:
+            settings.TEMPLATE_DIRS = old_dirs
+            shutil.rmtree(template_dir)
+
+    def testPreparedContent(self):
+        """Text and HTML templates share the lookups done on the content."""
+        calls = []
+        class Item(object):
+            def __unicode__(self):
+                return u'Item'
+            def get_absolute_url(self):
+                calls.append(self)
+                return '/item/'
+        context = Context(rendering.prepare_content({'objects': (i for i in [Item(), Item()]),
+                                                     'title': 'Title'}))
+        template = Template('{% for obj in objects %}{{ obj }} {{ obj.get_absolute_url }} {% endfor %}')
+        self.assertEquals(template.render(context), 'Item /item/ Item /item/ ')
+        self.assertEquals(template.render(context), 'Item /item/ Item /item/ ')
+        self.assertEquals(len(calls), 2)
+        self.assertEquals(context['title'], 'Title')
+
+    def testPreparedContentShapes(self):
+        """Dictionaries, lists and tuples in the content are rendered like
+        they are, with their objects prepared."""
+        class Item(object):
+            tags = ['a', 'b']
+            def __unicode__(self):
+                return u'Item'
+        class Empty(object):
+            def __len__(self):
+                return 0
+        context = Context(rendering.prepare_content({
+            'dicts': [{'title': u'x', 'item': Item()}],
+            'nested': [[1, 2], (3, )],
+            'items': (i for i in [Item()]),
+            'mapping': {'item': Item(), 'items': [Item()]},
+            'empty': Empty(),
+        }))
+        template = Template('{% for o in dicts %}{{ o.title }} {{ o.item }}{% endfor %}|'
+                            '{% for g in nested %}{% for x in g %}{{ x }}{% endfor %}{% endfor %}|'
+                            '{% for o in items %}{% for t in o.tags %}{{ t }}{% endfor %}'
+                            '{{ o.tags|length }}{% endfor %}|'
+                            '{{ mapping.item }} {{ mapping.items.0 }}|'
+                            '{% if empty %}full{% else %}empty{% endif %}')
+        self.assertEquals(template.render(context), 'x Item|123|ab2|Item Item|empty')
+        self.assertTrue(isinstance(context['mapping']['item'], rendering.PreparedObject))
+
+    def testStreamedContent(self):
+        """Querysets are streamed to the templates, peeking only their first
+        result to know if they are empty."""
+        objects = NewsletterSubscription.objects.all()
+        content = rendering.prepare_content({'objects': objects,
+                                             'nothing': objects.none()})
+        self.assertTrue(isinstance(content['objects'], rendering.Stream))
+        self.assertTrue(content['objects'])
+        self.assertFalse(content['nothing'])
+        template = Template('{% load streaming %}{% streamfor obj in objects %}'
+                            '{{ forloop.counter }}:{{ obj.email }}'
+                            '{% empty %}empty{% endstreamfor %}')
+        context = Context(content)
+        self.assertEquals(template.render(context), '1:test_user@host.net')
+        self.assertEquals(template.render(context), '1:test_user@host.net')
+        self.assertEquals(template.render(Context({'objects': content['nothing']})), 'empty')
+        self.assertEquals(objects._result_cache, None)
+
+    def testHtml2Text(self):
+        """html2text gives the same text as the filters it replaces."""
+        chained = Template('{% load stringfilters %}{{ body|truncatewords_html:5'
+                           '|striptags|entity2unicode|wordwrap:20 }}')
+        single = Template('{% load stringfilters %}{{ body|html2text:"5,20" }}')
+        for body in (u'', u'<p>Short &amp; sweet</p>',
+                     u'<div><p>Un <b>ñandú</b> &nbsp;corre &foo; por la pampa</p> y más</div>',
+                     u'a < b and <i>c &lt;d&gt;</i> ' + u'x' * 30 + u' e f g',
+                     u'one\ntwo  three <br/>four-five six <img src="x" /> seven'):
+            context = Context({'body': body})
+            self.assertEquals(single.render(context), chained.render(context))
+            # the second time comes from the cache
+            self.assertEquals(single.render(context), chained.render(context))
+
+    def testStreamFor(self):
+        """streamfor renders like for, without asking for the length."""
+        class Items(object):
+            def __iter__(self):
+                return iter(['a', 'b'])
+            def __len__(self):
+                raise AssertionError('len() called')
+        loop = ('{%% %(tag)s x in items %%}{%% if forloop.first %%}[{%% endif %%}'
+                '{{ forloop.counter0 }}{{ x }}{%% %(tag)s y in items %%}'
+                '{{ forloop.parentloop.counter }}{{ y }}{%% end%(tag)s %%}'
+                '{%% end%(tag)s %%}')
+        stream_template = Template('{% load streaming %}' + loop % {'tag': 'streamfor'})
+        for_template = Template(loop % {'tag': 'for'})
+        self.assertEquals(stream_template.render(Context({'items': Items()})),
+                          for_template.render(Context({'items': ['a', 'b']})))
+
     def testCreateNewsletterWeekly(self):
         """createnewsletter --weekly."""
         output = self.executeCommand('createnewsletter', weekly=True)
@@ -239,6 +571,67 @@ class CreateNewsletterCommandTests(NewsletterCommandTestCase):
         self.assertTrue('/admin/boletin/' in mail.outbox[0].body)
 
 
+class FlakySMTPConnection(object):
+    """Test SMTP connection which drops the session a number of times
+    before accepting messages."""
+    failures = 0
+    opened = 0
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def open(self):
+        FlakySMTPConnection.opened += 1
+
+    def close(self):
+        pass
+
+    def send_messages(self, messages):
+        if FlakySMTPConnection.failures:
+            FlakySMTPConnection.failures -= 1
+            raise smtplib.SMTPServerDisconnected('Connection unexpectedly closed')
+        mail.outbox.extend(messages)
+        return len(messages)
+
+
+class EncodingSMTPConnection(FlakySMTPConnection):
+    """Test SMTP connection which builds the messages, like the real one,
+    before accepting them."""
+
+    def send_messages(self, messages):
+        for message in messages:
+            message.message()
+        return FlakySMTPConnection.send_messages(self, messages)
+
+
+class RefusingSMTPConnection(FlakySMTPConnection):
+    """Test SMTP connection which refuses the messages to some recipients,
+    raising the error returned by ``error`` for each one."""
+    refused = []
+    error = staticmethod(lambda recipient: smtplib.SMTPRecipientsRefused(
+        {recipient: (550, 'No such user')}))
+
+    def send_messages(self, messages):
+        for message in messages:
+            for recipient in message.recipients():
+                if recipient in RefusingSMTPConnection.refused:
+                    raise RefusingSMTPConnection.error(recipient)
+        mail.outbox.extend(messages)
+        return len(messages)
+
+
+def once_refusing(replies):
+    """RefusingSMTPConnection subclass which only refuses recipients while
+    there are ``replies`` left."""
+    class OnceRefusingSMTPConnection(RefusingSMTPConnection):
+        def send_messages(self, messages):
+            if replies:
+                return RefusingSMTPConnection.send_messages(self, messages)
+            mail.outbox.extend(messages)
+            return len(messages)
+    return OnceRefusingSMTPConnection
+
+
 class SendNewsletterCommandTests(NewsletterCommandTestCase):
     """Test the sendnewsletter command, responsible for sending pending
     newsletters to subscribers.
@@ -288,6 +681,13 @@ class SendNewsletterCommandTests(NewsletterCommandTestCase):
                                   text_content='Test monthly',
                                   html_content='Test monthly',
                                   reviewed=True)
+        # record waits instead of sleeping
+        self.sleeps = []
+        NewsletterMailer.sleep = staticmethod(self.sleeps.append)
+
+    def tearDown(self):
+        NewsletterMailer.sleep = staticmethod(time.sleep)
+        NewsletterCommandTestCase.tearDown(self)
 
     def testSendNewsletter(self):
         """sendnewsletter without arguments, sends all pending newsletters to
@@ -326,6 +726,657 @@ class SendNewsletterCommandTests(NewsletterCommandTestCase):
         output = self.executeCommand('sendnewsletter', newsletter=3, unreviewed=True)
         self.assertTrue("This newsletter has already been sent" in output)
 
+    def testSendNewsletterMetrics(self):
+        """sendnewsletter measures the sending and flushes the metrics."""
+        from boletin import metrics
+        snapshots = []
+        def receiver(sender, snapshot, **kwargs):
+            snapshots.append(snapshot)
+        metrics.get_metrics().reset()
+        metrics.metrics_flushed.connect(receiver)
+        try:
+            self.executeCommand('sendnewsletter')
+        finally:
+            metrics.metrics_flushed.disconnect(receiver)
+        self.assertEquals(len(snapshots), 2)
+        self.assertEquals(snapshots[-1]['counters']['smtp.sent'], 2)
+        self.assertEquals(snapshots[-1]['counters']['db.inserted_rows'], 2)
+        for name in ('db.select', 'db.insert', 'mime.build', 'smtp.connect', 'smtp.send'):
+            self.assertTrue(snapshots[-1]['timings'][name]['count'] > 0, name)
+
+    def testRunSendJobs(self):
+        """runsendjobs runs the sendings queued from the admin, whose
+        progress is polled as JSON."""
+        from django.http import HttpRequest
+        from django.utils import simplejson
+        from boletin.models import NewsletterSendJob
+        from boletin.views import newsletter_send_progress
+        job = NewsletterSendJob.objects.queue(Newsletter.objects.get(id=1))
+        self.assertEquals(NewsletterSendJob.objects.queue(job.newsletter).id, job.id)
+        unreviewed = NewsletterSendJob.objects.queue(Newsletter.objects.get(id=3))
+        self.assertEquals(job.progress()['status'], 'queued')
+        output = self.executeCommand('runsendjobs')
+        self.assertTrue('Sending newsletter #1 to 1 subscribers' in output)
+        self.assertEquals(len(mail.outbox), 1)
+        self.assertTrue('user1@host' in mail.outbox[0].recipients())
+        progress = simplejson.loads(newsletter_send_progress(HttpRequest(), job.id).content)
+        self.assertEquals(progress['status'], 'finished')
+        self.assertEquals((progress['total'], progress['sent'], progress['failed'],
+                           progress['remaining'], progress['eta']), (1, 1, 0, 0, 0))
+        unreviewed = NewsletterSendJob.objects.get(id=unreviewed.id)
+        self.assertEquals(unreviewed.progress()['status'], 'failed')
+        self.assertEquals(unreviewed.error, "This newsletter hasn't been reviewed")
+        # a new job only counts its own sendings
+        job = NewsletterSendJob.objects.queue(job.newsletter)
+        self.executeCommand('runsendjobs')
+        job = NewsletterSendJob.objects.get(id=job.id)
+        self.assertEquals(job.progress()['sent'], 0)
+        self.assertEquals(job.error, "This newsletter has already been sent")
+
+    def testRequeueDuringSendJob(self):
+        """A newsletter being sent is never sent by a second job."""
+        from django.http import HttpRequest
+        from boletin.models import NewsletterSendJob
+        from boletin.views import newsletter_send
+        newsletter = Newsletter.objects.get(id=1)
+        job = NewsletterSendJob.objects.queue(newsletter)
+        self.assertTrue(NewsletterSendJob.objects.claim(job, 'worker1', 300))
+        # sending it again from the admin while the job is running
+        self.assertEquals(NewsletterSendJob.objects.queue(newsletter).id, job.id)
+        # a second job queued anyway waits for the running one
+        other = NewsletterSendJob.objects.create(newsletter=newsletter)
+        self.assertFalse(NewsletterSendJob.objects.claim(other, 'worker2', 300))
+        output = self.executeCommand('runsendjobs')
+        self.assertFalse('Sending newsletter' in output)
+        self.assertEquals(len(mail.outbox), 0)
+        self.assertEquals(NewsletterSendJob.objects.get(id=other.id).started, None)
+        # the view only queues sendings on POST
+        request = HttpRequest()
+        request.method = 'GET'
+        self.assertEquals(newsletter_send(request, newsletter.id).status_code, 405)
+
+    def testRunSendJobsErrors(self):
+        """A job whose sending fails records the error, and the next jobs
+        are run anyway."""
+        from boletin.models import NewsletterSendJob
+        first = NewsletterSendJob.objects.queue(Newsletter.objects.get(id=1))
+        second = NewsletterSendJob.objects.queue(Newsletter.objects.get(id=4))
+        self.patchSMTPConnection(1000)
+        try:
+            output = self.executeCommand('runsendjobs')
+        finally:
+            self.restoreSMTPConnection()
+            FlakySMTPConnection.failures = 0
+        self.assertTrue('Error sending newsletter!' in output)
+        for job in (first, second):
+            job = NewsletterSendJob.objects.get(id=job.id)
+            self.assertEquals(job.progress()['status'], 'failed')
+            self.assertEquals(job.error, 'Error sending newsletter!')
+        self.assertEquals(len(mail.outbox), 0)
+
+    def testStaleSendJob(self):
+        """A job whose worker died is taken for failed once its lease
+        expires, and the newsletter can be sent again."""
+        from boletin.models import NewsletterSendJob
+        newsletter = Newsletter.objects.get(id=1)
+        job = NewsletterSendJob.objects.queue(newsletter)
+        self.assertTrue(NewsletterSendJob.objects.claim(job, 'worker1', 300))
+        self.assertTrue(job.renew(300))
+        self.assertEquals(NewsletterSendJob.objects.queue(newsletter).id, job.id)
+        NewsletterSendJob.objects.filter(id=job.id).update(
+            lease_expires=datetime.now() - timedelta(seconds=1))
+        other = NewsletterSendJob.objects.queue(newsletter)
+        self.assertNotEquals(other.id, job.id)
+        job = NewsletterSendJob.objects.get(id=job.id)
+        self.assertEquals(job.progress()['status'], 'failed')
+        self.assertFalse(job.renew(300))
+        self.executeCommand('runsendjobs')
+        self.assertEquals(NewsletterSendJob.objects.get(id=other.id).progress()['status'],
+                          'finished')
+        self.assertEquals(len(mail.outbox), 1)
+
+    def patchSMTPConnection(self, failures, connection_class=FlakySMTPConnection):
+        FlakySMTPConnection.failures = failures
+        FlakySMTPConnection.opened = 0
+        self.old_smtp_connection = mail.SMTPConnection
+        mail.SMTPConnection = connection_class
+
+    def createMonthlySubscriptions(self, number):
+        for i in range(number):
+            NewsletterSubscription.objects.create(email='batch%d@host' % i,
+                                                  period='M', confirmed=True)
+        NewsletterSubscription.objects.update(subscription_date=date(2009, 1, 1))
+
+    def patchRefusingSMTPConnection(self, refused, error):
+        RefusingSMTPConnection.refused = refused
+        RefusingSMTPConnection.error = staticmethod(error)
+        self.patchSMTPConnection(0, RefusingSMTPConnection)
+
+    def restoreSMTPConnection(self):
+        mail.SMTPConnection = self.old_smtp_connection
+
+    def testSendNewsletterBatches(self):
+        """sendnewsletter --batch-size opens one connection per batch and
+        records the sendings of every batch."""
+        self.createMonthlySubscriptions(4)
+        self.patchSMTPConnection(failures=0)
+        try:
+            output = self.executeCommand('sendnewsletter', newsletter=4, batch_size=2)
+        finally:
+            self.restoreSMTPConnection()
+        self.assertTrue('Sending monthly newsletter #1 to 5 subscribers' in output)
+        self.assertEquals(len(mail.outbox), 5)
+        self.assertEquals(FlakySMTPConnection.opened, 3)
+        self.assertEquals(NewsletterSending.objects.filter(newsletter=4).count(), 5)
+
+    def testSendNewsletterReconnect(self):
+        """A dropped SMTP session is opened again and the message is retried."""
+        self.patchSMTPConnection(failures=1)
+        try:
+            output = self.executeCommand('sendnewsletter', newsletter=1)
+        finally:
+            self.restoreSMTPConnection()
+        self.assertEquals(len(mail.outbox), 1)
+        self.assertEquals(FlakySMTPConnection.opened, 2)
+        self.assertFalse(Newsletter.objects.get(id=1).pending)
+
+    def testSendNewsletterTooManyReconnects(self):
+        """When the server keeps dropping the session the newsletter is left
+        pending."""
+        self.patchSMTPConnection(failures=10)
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            self.assertRaises(CommandError, SendNewsletter().handle, newsletter=1)
+        finally:
+            self.restoreSMTPConnection()
+            sys.stdout = stdout
+        self.assertTrue(Newsletter.objects.get(id=1).pending)
+        self.assertEquals(NewsletterSending.objects.count(), 0)
+
+    def testSendNewsletterWorkers(self):
+        """sendnewsletter --workers=N sends in parallel threads, with one
+        connection each, delivering every message once."""
+        self.createMonthlySubscriptions(9)
+        self.patchSMTPConnection(failures=0)
+        try:
+            output = self.executeCommand('sendnewsletter', newsletter=4,
+                                         workers=3, batch_size=2)
+        finally:
+            self.restoreSMTPConnection()
+        self.assertEquals(len(mail.outbox), 10)
+        recipients = sorted([m.recipients()[0] for m in mail.outbox])
+        self.assertEquals(recipients, sorted(set(recipients)))
+        # ranges of 4 ids over user5 and batch0..8, with 3, 4 and 3 recipients
+        self.assertEquals(FlakySMTPConnection.opened, 6)
+        self.assertEquals(NewsletterSending.objects.filter(newsletter=4).count(), 10)
+        self.assertFalse(Newsletter.objects.get(id=4).pending)
+        last = NewsletterSubscription.objects.get(email='batch8@host')
+        self.assertEquals(NewsletterSendingRun.objects.get(newsletter=4).checkpoint, last.id)
+
+    def testSendNewsletterWorkerError(self):
+        """An error in one worker doesn't stop the others."""
+        self.createMonthlySubscriptions(5)
+        self.patchRefusingSMTPConnection(['user5@host'],
+            lambda r: smtplib.SMTPSenderRefused(554, 'Go away', 'newsletter@host'))
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            self.assertRaises(CommandError, SendNewsletter().handle,
+                              newsletter=4, workers=2)
+        finally:
+            self.restoreSMTPConnection()
+            sys.stdout = stdout
+        # user5 is the first subscriber of the first worker, which gives up
+        self.assertEquals(len(mail.outbox), 3)
+        self.assertEquals(NewsletterSending.objects.filter(newsletter=4).count(), 3)
+        self.assertTrue(Newsletter.objects.get(id=4).pending)
+
+    def testSendNewsletterRejected(self):
+        """Messages rejected by the server don't stop the sending, they are
+        stored as failures of the sending run."""
+        self.createMonthlySubscriptions(3)
+        self.patchRefusingSMTPConnection(['batch0@host', 'batch1@host'],
+            lambda r: smtplib.SMTPRecipientsRefused({r: (550, 'No such user')}))
+        try:
+            output = self.executeCommand('sendnewsletter', newsletter=4)
+        finally:
+            self.restoreSMTPConnection()
+        self.assertTrue('Error sending to &lt;batch0@host&gt;' in output)
+        self.assertTrue('2 messages failed, 0 will be retried' in output)
+        self.assertEquals(len(mail.outbox), 2)
+        run = NewsletterSendingRun.objects.get(newsletter=4)
+        self.assertEquals((run.sent, run.failed, run.retryable), (2, 2, 0))
+        self.assertTrue(run.finished)
+        self.assertEquals(run.failures.count(), 2)
+        self.assertFalse(Newsletter.objects.get(id=4).pending)
+
+    def testSendNewsletterTransientRetry(self):
+        """Temporary errors are retried in the same session after a backoff,
+        and slow down the sending."""
+        self.createMonthlySubscriptions(3)
+        replies = [451]
+        RefusingSMTPConnection.refused = ['batch1@host']
+        RefusingSMTPConnection.error = staticmethod(
+            lambda r: smtplib.SMTPRecipientsRefused({r: (replies.pop(), 'Try again later')}))
+        self.patchSMTPConnection(0, once_refusing(replies))
+        try:
+            output = self.executeCommand('sendnewsletter', newsletter=4)
+        finally:
+            self.restoreSMTPConnection()
+        self.assertTrue('Error sending' not in output)
+        self.assertEquals(len(mail.outbox), 4)
+        self.assertTrue(self.sleeps)
+        self.assertFalse(Newsletter.objects.get(id=4).pending)
+
+    def testSendNewsletterRate(self):
+        """sendnewsletter --rate paces the messages."""
+        self.createMonthlySubscriptions(3)
+        output = self.executeCommand('sendnewsletter', newsletter=4, rate=2)
+        self.assertEquals(len(mail.outbox), 4)
+        self.assertEquals(len(self.sleeps), 2)
+
+    def testTokenBucket(self):
+        """Token buckets allow bursts up to their capacity and then one
+        message every 1/rate seconds."""
+        now = [0.0]
+        bucket = TokenBucket(2, capacity=2, clock=lambda: now[0])
+        self.assertEquals([bucket.reserve() for i in range(3)], [0, 0, 0.5])
+        now[0] = 1.5
+        self.assertEquals(bucket.reserve(), 0)
+        bucket.slow_down()
+        self.assertEquals(bucket.rate, 1)
+        self.assertEquals(bucket.reserve(), 1)
+        bucket = TokenBucket(2, max_rate=2)
+        bucket.slow_down()
+        for i in range(20):
+            bucket.speed_up()
+        self.assertEquals(bucket.rate, 2)
+
+    def testRateLimiterThrottled(self):
+        """Temporary failures halve the rates, creating buckets from the
+        measured rate when there are none."""
+        now = [0.0]
+        limiter = RateLimiter(domain_rates={'slow.host': 4}, clock=lambda: now[0])
+        self.assertEquals(limiter.delay('a@fast.host'), 0)
+        for i in range(10):
+            limiter.succeeded('a@fast.host')
+        now[0] = 1.0
+        limiter.throttled('b@slow.host')
+        self.assertEquals(limiter.bucket.rate, 5)
+        self.assertEquals(limiter.domain_bucket('slow.host').rate, 2)
+        self.assertEquals(limiter.domain_bucket('fast.host'), None)
+        self.assertEquals(limiter.delay('c@fast.host'), 0.2)
+        for i in range(3):
+            self.assertTrue(0 <= backoff(i, base=1) <= 2 ** i)
+        self.assertTrue(backoff(20, base=1) <= 60)
+
+    def testSendNewsletterRetry(self):
+        """Temporary errors put subscribers in the retry list, which is sent
+        again when resuming the run."""
+        self.createMonthlySubscriptions(3)
+        self.patchRefusingSMTPConnection(['batch1@host'],
+            lambda r: smtplib.SMTPRecipientsRefused({r: (451, 'Try again later')}))
+        try:
+            output = self.executeCommand('sendnewsletter', newsletter=4)
+        finally:
+            self.restoreSMTPConnection()
+        self.assertTrue('0 messages failed, 1 will be retried' in output)
+        self.assertEquals(len(mail.outbox), 3)
+        self.assertTrue(Newsletter.objects.get(id=4).pending)
+        # reading the retry list doesn't empty it, in case the resume dies
+        run = NewsletterSendingRun.objects.get(newsletter=4)
+        self.assertEquals([s.email for s in run.get_retries()], ['batch1@host'])
+        self.assertEquals([s.email for s in run.get_retries()], ['batch1@host'])
+        self.assertEquals(NewsletterSendingRun.objects.get(id=run.id).retryable, 1)
+        output = self.executeCommand('sendnewsletter', newsletter=4, resume=True)
+        self.assertTrue('Resuming sending run' in output)
+        self.assertEquals(len(mail.outbox), 4)
+        self.assertEquals(mail.outbox[3].recipients(), ['batch1@host'])
+        run = NewsletterSendingRun.objects.get(newsletter=4)
+        self.assertEquals((run.sent, run.failed, run.retryable), (4, 0, 0))
+        self.assertFalse(run.failures.all())
+        self.assertFalse(Newsletter.objects.get(id=4).pending)
+
+    def testRetryFailsAgain(self):
+        """Subscribers which fail again stay in the retry list, and the ones
+        sent meanwhile leave it."""
+        self.createMonthlySubscriptions(3)
+        error = lambda r: smtplib.SMTPRecipientsRefused({r: (451, 'Try again later')})
+        self.patchRefusingSMTPConnection(['batch0@host', 'batch1@host'], error)
+        try:
+            self.executeCommand('sendnewsletter', newsletter=4)
+            run = NewsletterSendingRun.objects.get(newsletter=4)
+            self.assertEquals(run.retryable, 2)
+            NewsletterSending.objects.create(newsletter=Newsletter.objects.get(id=4),
+                subscription=NewsletterSubscription.objects.get(email='batch0@host'))
+            output = self.executeCommand('sendnewsletter', newsletter=4, resume=True)
+        finally:
+            self.restoreSMTPConnection()
+        self.assertTrue('0 messages failed, 1 will be retried' in output)
+        run = NewsletterSendingRun.objects.get(newsletter=4)
+        self.assertEquals(run.retryable, 1)
+        self.assertEquals([f.subscription.email for f in run.failures.all()], ['batch1@host'])
+        self.assertTrue(Newsletter.objects.get(id=4).pending)
+
+    def testResumeAbortedRetry(self):
+        """Resuming a run aborted before its checkpoint moved sends the
+        subscribers of the retry list only once."""
+        self.createMonthlySubscriptions(3)
+        def error(recipient):
+            if recipient == 'batch0@host':
+                return smtplib.SMTPRecipientsRefused({recipient: (450, 'Try again later')})
+            return smtplib.SMTPSenderRefused(550, 'Go away', 'newsletter@host')
+        self.patchRefusingSMTPConnection(['batch0@host', 'batch1@host'], error)
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            self.assertRaises(CommandError, SendNewsletter().handle, newsletter=4)
+        finally:
+            self.restoreSMTPConnection()
+            sys.stdout = stdout
+        run = NewsletterSendingRun.objects.get(newsletter=4)
+        self.assertEquals((run.sent, run.retryable, run.checkpoint), (1, 1, 0))
+        self.executeCommand('sendnewsletter', newsletter=4, resume=True)
+        self.assertEquals([m.recipients()[0] for m in mail.outbox],
+                          ['user5@host', 'batch0@host', 'batch1@host', 'batch2@host'])
+        self.assertEquals(NewsletterSending.objects.filter(newsletter=4).count(), 4)
+        run = NewsletterSendingRun.objects.get(newsletter=4)
+        self.assertEquals((run.sent, run.failed, run.retryable), (4, 0, 0))
+
+    def testSendNewsletterResume(self):
+        """--resume goes on from the checkpoint of the interrupted run."""
+        self.createMonthlySubscriptions(3)
+        newsletter = Newsletter.objects.get(id=4)
+        skipped = NewsletterSubscription.objects.get(email='batch0@host')
+        NewsletterSendingRun.objects.create(newsletter=newsletter,
+                                            checkpoint=skipped.id, sent=2)
+        output = self.executeCommand('sendnewsletter', newsletter=4, resume=True)
+        self.assertTrue('Resuming sending run from subscription #%d, 2 sent' % skipped.id in output)
+        # the pending subscribers are not counted
+        self.assertFalse('Sending monthly newsletter' in output)
+        recipients = sorted([m.recipients()[0] for m in mail.outbox])
+        self.assertEquals(recipients, ['batch1@host', 'batch2@host'])
+        run = NewsletterSendingRun.objects.get(newsletter=4)
+        self.assertEquals(run.sent, 4)
+        self.assertTrue(run.finished)
+
+    def testSendNewsletterCheckpoint(self):
+        """The checkpoint of an interrupted run only covers the subscribers
+        whose results were stored."""
+        self.createMonthlySubscriptions(4)
+        class DyingSMTPConnection(FlakySMTPConnection):
+            def open(self):
+                FlakySMTPConnection.opened += 1
+                if FlakySMTPConnection.opened > 2: # after the second batch
+                    raise smtplib.SMTPServerDisconnected('Gone')
+        self.patchSMTPConnection(0, DyingSMTPConnection)
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            self.assertRaises(CommandError, SendNewsletter().handle,
+                              newsletter=4, batch_size=2, flush_size=3)
+        finally:
+            self.restoreSMTPConnection()
+            sys.stdout = stdout
+        run = NewsletterSendingRun.objects.get(newsletter=4)
+        sent = NewsletterSubscription.objects.filter(newslettersending__newsletter=4).order_by('id')
+        self.assertEquals(run.sent, 4)
+        self.assertEquals(run.checkpoint, sent[3].id)
+        self.assertFalse(run.finished)
+
+    def testSendNewsletterSessions(self):
+        """sendnewsletter --sessions=N streams subscribers to N concurrent
+        SMTP sessions, one for each batch."""
+        self.createMonthlySubscriptions(9)
+        self.patchSMTPConnection(failures=0)
+        try:
+            output = self.executeCommand('sendnewsletter', newsletter=4,
+                                         sessions=2, batch_size=3)
+        finally:
+            self.restoreSMTPConnection()
+        self.assertEquals(len(mail.outbox), 10)
+        recipients = [m.recipients()[0] for m in mail.outbox]
+        self.assertEquals(len(recipients), len(set(recipients)))
+        self.assertEquals(FlakySMTPConnection.opened, 4)
+        self.assertEquals(NewsletterSending.objects.filter(newsletter=4).count(), 10)
+        self.assertFalse(Newsletter.objects.get(id=4).pending)
+
+    def testStreamingSenderForgetsSentBatches(self):
+        """StreamingSender drops the claims and the tracking of the batches
+        once they are sent, so its memory doesn't grow with the list."""
+        self.createMonthlySubscriptions(9)
+        newsletter = Newsletter.objects.get(id=4)
+        sender = StreamingSender(newsletter, 2, 3)
+        self.patchSMTPConnection(failures=0)
+        try:
+            subscribers = NewsletterSubscription.objects.iter_pending_sendings(newsletter)
+            results = list(sender.send(subscribers))
+        finally:
+            self.restoreSMTPConnection()
+        self.assertEquals(len(results), 10)
+        self.assertEquals(sender._claimed, set())
+        self.assertEquals(sender._batches, {})
+        self.assertEquals(sender.checkpoint, max([s.id for s, error in results]))
+
+    def testSendNewsletterClaim(self):
+        """sendnewsletter --claim sends the chunks not claimed by other
+        workers, and those whose lease expired."""
+        self.createMonthlySubscriptions(9)
+        newsletter = Newsletter.objects.get(id=4)
+        self.assertEquals(NewsletterSendingChunk.objects.create_chunks(newsletter, 3), 4)
+        other = NewsletterSendingChunk.objects.claim(newsletter, 'otherhost:1', 60)
+        self.assertEquals(other.number, 1)
+        output = self.executeCommand('sendnewsletter', newsletter=4, claim=True, chunk_size=3)
+        self.assertTrue('Split in 4 chunks' in output)
+        self.assertFalse('Claimed chunk #1' in output)
+        self.assertTrue('still being sent' in output)
+        self.assertEquals(len(mail.outbox), 7)
+        self.assertTrue(Newsletter.objects.get(id=4).pending)
+        NewsletterSendingChunk.objects.filter(id=other.id).update(
+            lease_expires=datetime.now() - timedelta(seconds=1))
+        output = self.executeCommand('sendnewsletter', newsletter=4, claim=True)
+        self.assertTrue('Claimed chunk #1' in output)
+        self.assertEquals(len(mail.outbox), 10)
+        recipients = [m.recipients()[0] for m in mail.outbox]
+        self.assertEquals(len(recipients), len(set(recipients)))
+        self.assertFalse(Newsletter.objects.get(id=4).pending)
+        self.assertFalse(other.renew(60))
+        self.assertFalse(other.finish())
+
+    def testClaimChunks(self):
+        """A chunk can only be claimed by one worker while its lease lasts."""
+        self.createMonthlySubscriptions(3)
+        newsletter = Newsletter.objects.get(id=4)
+        NewsletterSendingChunk.objects.create_chunks(newsletter, 2)
+        self.assertEquals(NewsletterSendingChunk.objects.create_chunks(newsletter, 1), 2)
+        first = NewsletterSendingChunk.objects.claim(newsletter, 'a', 60)
+        second = NewsletterSendingChunk.objects.claim(newsletter, 'b', 60)
+        self.assertEquals((first.number, second.number), (1, 2))
+        self.assertEquals(NewsletterSendingChunk.objects.claim(newsletter, 'c', 60), None)
+        self.assertEquals(first.get_pending_sendings().count(), 2)
+        self.assertEquals(len(list(second.iter_pending_sendings(0))), 2)
+        self.assertTrue(first.renew(60))
+        self.assertTrue(first.finish())
+        self.assertFalse(NewsletterSendingChunk.objects.all_done(newsletter))
+        self.assertTrue(second.finish())
+        self.assertTrue(NewsletterSendingChunk.objects.all_done(newsletter))
+
+    def testSendNewsletterSpool(self):
+        """sendnewsletter --spool writes the messages to disk, and drainspool
+        delivers them and records the sendings."""
+        self.createMonthlySubscriptions(4)
+        spool_dir = tempfile.mkdtemp()
+        try:
+            output = self.executeCommand('sendnewsletter', newsletter=4, spool=True,
+                                         spool_dir=spool_dir)
+            self.assertTrue('Spooled 5 messages' in output)
+            self.assertEquals(len(mail.outbox), 0)
+            self.assertFalse(Newsletter.objects.get(id=4).pending)
+            self.assertEquals(NewsletterSending.objects.filter(newsletter=4).count(), 0)
+            output = self.executeCommand('drainspool', spool_dir=spool_dir, status=True)
+            self.assertTrue('0 of 5 messages delivered (0.0%)' in output)
+            # unsubscriptions after spooling
+            NewsletterSubscription.objects.get(email='batch1@host').delete()
+            NewsletterSubscription.objects.filter(email='batch2@host').update(confirmed=False)
+            output = self.executeCommand('drainspool', spool_dir=spool_dir, batch_size=2)
+            self.assertTrue('Delivered 4 of 5 messages (80.0%' in output)
+            self.assertTrue('Spool delivered' in output)
+            self.assertTrue('2 messages dropped' in output)
+            self.assertEquals(len(mail.outbox), 3)
+            self.assertTrue('batch3@host' in mail.outbox[2].recipients())
+            self.assertEquals(NewsletterSending.objects.filter(newsletter=4).count(), 3)
+            self.assertFalse(NewsletterSending.objects.filter(subscription__email__in=[
+                'batch1@host', 'batch2@host']))
+            self.assertFalse(os.listdir(spool_dir))
+        finally:
+            shutil.rmtree(spool_dir)
+
+    def testSpoolResume(self):
+        """Interrupted spooling and drains go on where they were left."""
+        self.createMonthlySubscriptions(4)
+        newsletter = Newsletter.objects.get(id=4)
+        template = NewsletterMessageTemplate(newsletter)
+        subscribers = list(NewsletterSubscription.objects.get_pending_sendings(newsletter).order_by('id'))
+        spool_dir = tempfile.mkdtemp()
+        try:
+            spool = Spool.for_newsletter(newsletter, spool_dir)
+            spool.segment_size = 2
+            self.assertEquals(spool.write(template, subscribers[:3]), 3)
+            # a crash in the middle of a message
+            open(spool.filename(2, 'msg'), 'ab').write('From: half a message')
+            open(spool.filename(2, 'idx'), 'ab').write('123\t')
+            self.assertEquals(spool.checkpoint(), subscribers[2].id)
+            self.assertEquals(spool.write(template, subscribers[3:]), 2)
+            spool.finish()
+            self.assertEquals(spool.segments(), [1, 2, 3])
+            self.assertEquals([m.id for m in spool.pending(2)],
+                              [s.id for s in subscribers[2:4]])
+            self.assertTrue(list(spool.pending(2))[0].as_string().startswith('Content-Type'))
+            # a crash after delivering a message but before counting it
+            NewsletterSending.objects.create(newsletter=newsletter, subscription=subscribers[0])
+            output = self.executeCommand('drainspool', newsletter=4, spool_dir=spool_dir)
+            self.assertEquals(len(mail.outbox), 4)
+            self.assertEquals(NewsletterSending.objects.filter(newsletter=4).count(), 5)
+        finally:
+            shutil.rmtree(spool_dir)
+
+    def testIterPendingSendings(self):
+        """Pending sendings can be iterated in chunks ordered by id."""
+        self.createMonthlySubscriptions(5)
+        newsletter = Newsletter.objects.get(id=4)
+        sent = NewsletterSubscription.objects.get(email='batch2@host')
+        NewsletterSending.objects.create(newsletter=newsletter, subscription=sent)
+        expected = list(NewsletterSubscription.objects.get_pending_sendings(newsletter).order_by('id'))
+        self.assertEquals(len(expected), 5)
+        self.assertFalse(sent in expected)
+        pending = NewsletterSubscription.objects.iter_pending_sendings(newsletter, chunk_size=2)
+        self.assertEquals(list(pending), expected)
+        pending = NewsletterSubscription.objects.iter_pending_sendings(newsletter, chunk_size=2,
+                                                                       after=expected[1].id)
+        self.assertEquals(list(pending), expected[2:])
+
+    def testSplitPendingSendings(self):
+        """Pending sendings can be split in iterators over contiguous ranges
+        of ids."""
+        self.createMonthlySubscriptions(5)
+        newsletter = Newsletter.objects.get(id=4)
+        sent = NewsletterSubscription.objects.get(email='batch2@host')
+        NewsletterSending.objects.create(newsletter=newsletter, subscription=sent)
+        expected = list(NewsletterSubscription.objects.get_pending_sendings(newsletter).order_by('id'))
+        parts = NewsletterSubscription.objects.split_pending_sendings(newsletter, 3, chunk_size=1)
+        parts = [list(part) for part in parts]
+        self.assertEquals(len(parts), 3)
+        self.assertEquals(sum(parts, []), expected)
+        parts = NewsletterSubscription.objects.split_pending_sendings(newsletter, 2,
+                                                                      after=expected[2].id)
+        self.assertEquals(sum([list(part) for part in parts], []), expected[3:])
+        parts = NewsletterSubscription.objects.split_pending_sendings(newsletter, 2,
+                                                                      after=expected[-1].id)
+        self.assertEquals(parts, [])
+
+    def testSendingRecorder(self):
+        """Sendings are stored in bulk every flush_size deliveries."""
+        newsletter = Newsletter.objects.get(id=1)
+        recorder = SendingRecorder(newsletter, flush_size=2)
+        for subscription in NewsletterSubscription.objects.all()[:5]:
+            recorder.add(subscription)
+        self.assertEquals(NewsletterSending.objects.filter(newsletter=newsletter).count(), 4)
+        recorder.flush()
+        self.assertEquals(NewsletterSending.objects.filter(newsletter=newsletter).count(), 5)
+        self.assertEquals(recorder.recorded, 5)
+        self.assertFalse(NewsletterSending.objects.filter(date__isnull=True))
+        self.assertEquals(NewsletterSubscription.objects.get_pending_sendings(newsletter).count(), 0)
+
+    def testNewsletterMessageTemplate(self):
+        """Prepared messages only differ in the recipient and message id."""
+        newsletter = Newsletter(number=7, period='D', date=date(2009, 2, 2),
+                                text_content=u'Texto en español',
+                                html_content=u'<p>Texto en español</p>')
+        template = NewsletterMessageTemplate(newsletter)
+        first = email.message_from_string(template.message(u'a@host').message().as_string())
+        second = email.message_from_string(template.message(u'b@host').message().as_string())
+        expected = email.message_from_string(newsletter_message(newsletter, u'a@host').message().as_string())
+        self.assertEquals(first['To'], 'a@host')
+        self.assertEquals(second['To'], 'b@host')
+        self.assertNotEquals(first['Message-ID'], second['Message-ID'])
+        self.assertEquals(first['Subject'], expected['Subject'])
+        self.assertEquals([p.get_payload(decode=True) for p in first.get_payload()],
+                          [p.get_payload(decode=True) for p in expected.get_payload()])
+        self.assertEquals(first.get_payload()[0].get_payload(decode=True),
+                          u'Texto en español'.encode('utf-8'))
+
+    def testPersonalizedMessageTemplate(self):
+        """Placeholders are filled for every recipient, and the spliced
+        message decodes to the same contents as a message built for him."""
+        line = u'Línea larga con acentos, ' * 8
+        newsletter = Newsletter(number=7, period='W', date=date(2009, 2, 2),
+            text_content=u'%s\nHola {{{email}}} ({{{period}}})%s\n{{{unsubscribe_url}}}' % (line, line),
+            html_content=u'<p>%s</p><a href="{{{unsubscribe_url}}}">{{{email}}}</a>' % line)
+        subscriber = NewsletterSubscription.objects.create(email='a&b@host', period='W')
+        template = NewsletterMessageTemplate(newsletter)
+        message = template.message(subscriber.email, subscriber)
+        url = 'http://example.com/unsubscribe/%d/%s/' % (
+            subscriber.id, unsubscribe_token(subscriber.id, subscriber.email))
+        text = newsletter.text_content.replace('{{{email}}}', 'a&b@host').replace(
+            '{{{period}}}', 'Weekly').replace('{{{unsubscribe_url}}}', url)
+        html = newsletter.html_content.replace('{{{email}}}', 'a&amp;b@host').replace(
+            '{{{unsubscribe_url}}}', url)
+        self.assertEquals(message.body, text)
+        parsed = email.message_from_string(message.message().as_string())
+        self.assertEquals(parsed['To'], 'a&b@host')
+        self.assertEquals([p.get_payload(decode=True) for p in parsed.get_payload()],
+                          [text.encode('utf-8'), html.encode('utf-8')])
+        for body in message.message().as_string().split('\n'):
+            self.assertTrue(len(body) <= 76)
+
+    def testSendNewsletterPersonalized(self):
+        """Every subscriber gets his own unsubscription link."""
+        Newsletter.objects.filter(id=4).update(
+            text_content='Test monthly {{{unsubscribe_url}}}')
+        output = self.executeCommand('sendnewsletter', newsletter=4)
+        subscriber = NewsletterSubscription.objects.get(email='user5@host')
+        token = unsubscribe_token(subscriber.id, subscriber.email)
+        self.assertTrue(mail.outbox[0].body.endswith('/unsubscribe/%d/%s/' % (subscriber.id, token)))
+
+    def testSendNewsletterSMTPServer(self):
+        """Send through a real SMTP server running in this process."""
+        self.createMonthlySubscriptions(9)
+        server = smtpsink.start()
+        old_settings = settings.EMAIL_HOST, settings.EMAIL_PORT
+        settings.EMAIL_HOST, settings.EMAIL_PORT = 'localhost', server.port
+        self.old_smtp_connection = mail.SMTPConnection
+        mail.SMTPConnection = mail.original_SMTPConnection
+        try:
+            output = self.executeCommand('sendnewsletter', newsletter=4,
+                                         sessions=3, batch_size=2)
+        finally:
+            self.restoreSMTPConnection()
+            settings.EMAIL_HOST, settings.EMAIL_PORT = old_settings
+            smtpsink.stop(server)
+        self.assertEquals(server.received, 10)
+        self.assertEquals(NewsletterSending.objects.filter(newsletter=4).count(), 10)
+
 
 class ShowNewslettersCommandTests(NewsletterCommandTestCase):
     """Test the shownewsletters command, which shows all generated
@@ -375,3 +1426,272 @@ class ShowNewslettersCommandTests(NewsletterCommandTestCase):
         self.assertFalse('2.' in output)
         self.assertFalse('3.' in output)
         self.assertTrue('(*)   4. Newsletter #1' in output)
+
+    def testCompressedContent(self):
+        """Long contents are stored compressed and decompressed when read."""
+        from django.db import connection
+        settings.NEWSLETTER_COMPRESS_CONTENT = True
+        try:
+            html = u'<p>Ñandú</p>' * 100
+            newsletter = Newsletter.objects.create(period='W', date=date(2009, 6, 1),
+                                                   text_content=u'Short', html_content=html)
+            cursor = connection.cursor()
+            cursor.execute('SELECT text_content, html_content FROM boletin_newsletter'
+                           ' WHERE id = %s', [newsletter.id])
+            text, stored = cursor.fetchone()
+            self.assertEquals(text, u'Short')
+            self.assertTrue(stored.startswith('zlib:'))
+            self.assertTrue(len(stored) < len(html) / 10)
+            newsletter = Newsletter.objects.get(id=newsletter.id)
+            self.assertEquals(newsletter.html_content, html)
+            self.assertEquals(newsletter.text_content, u'Short')
+            self.assertEquals(Newsletter.objects.defer('text_content').get(
+                id=newsletter.id).html_content, html)
+            # only loaded texts are decompressed
+            text = u'zlib: is a library'
+            newsletter = Newsletter(period='W', date=date(2009, 6, 1), text_content=text,
+                                    html_content=html)
+            self.assertEquals(newsletter.text_content, text)
+            newsletter.html_content = u'zlib:eJyrqKA9AABAGy7h'
+            self.assertEquals(newsletter.html_content, u'zlib:eJyrqKA9AABAGy7h')
+            newsletter.save()
+            newsletter = Newsletter.objects.get(id=newsletter.id)
+            self.assertEquals(newsletter.text_content, text)
+            self.assertEquals(newsletter.html_content, u'zlib:eJyrqKA9AABAGy7h')
+        finally:
+            settings.NEWSLETTER_COMPRESS_CONTENT = False
+        newsletter = Newsletter.objects.create(period='W', date=date(2009, 6, 1),
+                                               text_content=text, html_content=html)
+        newsletter = Newsletter.objects.get(id=newsletter.id)
+        self.assertEquals((newsletter.text_content, newsletter.html_content), (text, html))
+
+    def testListingDefersContents(self):
+        """Listings don't load the contents, and use the stored summary."""
+        Newsletter.objects.filter(number=1, period='W').update(text_content=u'x' * 60)
+        newsletter = Newsletter.objects.get(number=1, period='W')
+        newsletter.save()
+        self.assertEquals(newsletter.summary, u'x' * 47 + u'...')
+        listed = Newsletter.objects.listing().get(number=1, period='W')
+        self.assertFalse('text_content' in listed.__dict__)
+        self.assertEquals(unicode(listed), u'x' * 47 + u'...')
+        self.assertFalse('text_content' in listed.__dict__)
+        listed.reviewed = True
+        listed.save()
+        newsletter = Newsletter.objects.get(number=1, period='W')
+        self.assertTrue(newsletter.reviewed)
+        self.assertEquals(newsletter.text_content, u'x' * 60)
+
+    def testShowNewslettersStats(self):
+        """shownewsletters prints the sent and pending sendings."""
+        newsletter = Newsletter.objects.get(number=1, period='M')
+        for email in ('a@host.net', 'b@host.net', 'c@host.net'):
+            NewsletterSubscription.objects.create(email=email, period='M', confirmed=True)
+        NewsletterSubscription.objects.update(subscription_date=datetime(2009, 1, 1))
+        NewsletterSendingRun.objects.create(newsletter=newsletter, sent=1, finished=datetime.now())
+        NewsletterSendingRun.objects.create(newsletter=newsletter)
+        output = self.executeCommand('shownewsletters')
+        self.assertTrue('(*)   4. Newsletter #1: sent 1, pending 2, last sent 2' in output)
+        self.assertTrue('3. Newsletter #1: sent 0, pending 0, last sent never' in output)
+
+    def testShowNewslettersJSON(self):
+        """shownewsletters --json"""
+        from django.utils import simplejson
+        output = StringIO()
+        stdout, sys.stdout = sys.stdout, output
+        try:
+            call_command('shownewsletters', json=True, only_pending=True)
+        finally:
+            sys.stdout = stdout
+        newsletters = simplejson.loads(output.getvalue())
+        self.assertEquals([(n['id'], n['period'], n['number']) for n in newsletters],
+                          [(1, 'D', 1), (4, 'M', 1)])
+        self.assertEquals(newsletters[0]['date'], '2009-02-02')
+        self.assertEquals(newsletters[0]['sent'], 0)
+        self.assertEquals(newsletters[0]['last_sent'], None)
+
+
+class NewsletterSequenceTests(TestCase):
+    """Newsletter numbers come from a sequence per period."""
+
+    def testNextNumber(self):
+        """Numbers are never repeated, and start after the existing ones."""
+        Newsletter.objects.create(number=7, period='W', date=date(2009, 6, 1),
+                                  text_content='Test', html_content='Test')
+        self.assertEquals(Newsletter.next_number('W'), 8)
+        self.assertEquals(Newsletter.next_number('W'), 9)
+        self.assertEquals(Newsletter.next_number('D'), 1)
+        newsletter = Newsletter.objects.create(period='W', date=date(2009, 6, 8),
+                                               text_content='Test', html_content='Test')
+        self.assertEquals(newsletter.number, 10)
+        self.assertEquals(NewsletterSequence.objects.get(period='W').last, 10)
+
+
+class ImportSubscribersCommandTests(NewsletterCommandTestCase):
+    """Test the importsubscribers command."""
+
+    def setUp(self):
+        NewsletterCommandTestCase.setUp(self)
+        self.old_periods = settings.NEWSLETTER_PERIODS
+        settings.NEWSLETTER_PERIODS = ['D', 'W']
+        NewsletterSubscription.objects.create(email='old@host.net', period='D')
+        fd, self.filename = tempfile.mkstemp(suffix='.csv')
+        os.write(fd, 'new1@host.net,D\n'
+                     'not an email\n'
+                     'new2@host.net\n'
+                     'new1@host.net,W\n'
+                     'old@host.net\n'
+                     'new3@host.net,M\n'
+                     '\xc3\xb1and\xc3\xba@host.net\n'
+                     'new4@host.net,D\n'
+                     '\xf1and\xfa@host.net,W\n')
+        os.close(fd)
+
+    def tearDown(self):
+        NewsletterCommandTestCase.tearDown(self)
+        settings.NEWSLETTER_PERIODS = self.old_periods
+        os.remove(self.filename)
+
+    def testImportSubscribers(self):
+        """importsubscribers skips invalid and already subscribed emails."""
+        output = self.executeCommand('importsubscribers', self.filename,
+                                     period='W', batch_size=3)
+        self.assertTrue('Imported 3 subscriptions (4 invalid, 2 already subscribed)' in output)
+        self.assertTrue('Last line read: 9.' in output)
+        imported = NewsletterSubscription.objects.exclude(email='old@host.net')
+        self.assertEquals(sorted(imported.values_list('email', 'period')),
+                          [(u'new1@host.net', u'D'), (u'new2@host.net', u'W'),
+                           (u'new4@host.net', u'D')])
+        self.assertEquals(len(set(imported.values_list('hashkey', flat=True))), 3)
+        self.assertFalse(imported.filter(confirmed=True))
+
+    def testImportSubscribersResume(self):
+        """importsubscribers --start-line"""
+        output = self.executeCommand('importsubscribers', self.filename,
+                                     period='W', start_line=6, confirmed=True)
+        self.assertTrue('Imported 1 subscriptions (2 invalid, 0 already subscribed)' in output)
+        subscription = NewsletterSubscription.objects.get(email='new4@host.net')
+        self.assertTrue(subscription.confirmed)
+        self.assertEquals(subscription.hashkey, '')
+
+
+class ExportNewsletterDataCommandTests(NewsletterCommandTestCase):
+    """Test the exportnewsletterdata command."""
+
+    def setUp(self):
+        NewsletterCommandTestCase.setUp(self)
+        for n in range(5):
+            NewsletterSubscription.objects.create(email='user%d@host.net' % n,
+                                                  period=n % 2 and 'D' or 'W',
+                                                  confirmed=n < 3)
+        newsletter = Newsletter.objects.create(period='W', date=date(2009, 6, 1),
+                                               text_content='Test', html_content='Test')
+        for subscription in NewsletterSubscription.objects.filter(period='W'):
+            NewsletterSending.objects.create(newsletter=newsletter, subscription=subscription)
+
+    def export(self, *args, **options):
+        stdout, sys.stdout = sys.stdout, StringIO()
+        try:
+            call_command('exportnewsletterdata', *args, **options)
+            return sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+
+    def testExportSubscriptions(self):
+        """exportnewsletterdata subscriptions, as CSV by chunks."""
+        lines = self.export('subscriptions', chunk_size=2, period='W').splitlines()
+        self.assertEquals(lines[0], 'id,email,period,subscription_date,confirmed')
+        self.assertEquals([line.split(',')[1] for line in lines[1:]],
+                          ['user0@host.net', 'user2@host.net', 'user4@host.net'])
+        lines = self.export('subscriptions', chunk_size=2, confirmed=False).splitlines()
+        self.assertEquals([line.split(',')[1] for line in lines[1:]],
+                          ['user3@host.net', 'user4@host.net'])
+        self.assertEquals(len(self.export('subscriptions', since='2000-01-01',
+                                          until='2000-01-02').splitlines()), 1)
+
+    def testExportSendingsJSONLinesGzip(self):
+        """exportnewsletterdata sendings --format=jsonl --gzip --output"""
+        import gzip
+        from django.utils import simplejson
+        fd, filename = tempfile.mkstemp(suffix='.jsonl.gz')
+        os.close(fd)
+        try:
+            output = self.export('sendings', format='jsonl', gzip=True, output=filename,
+                                 confirmed=True)
+            self.assertTrue('Exported 2 sendings' in output)
+            rows = [simplejson.loads(line) for line in gzip.open(filename)]
+        finally:
+            os.remove(filename)
+        self.assertEquals([row['email'] for row in rows], ['user0@host.net', 'user2@host.net'])
+        self.assertEquals(rows[0]['period'], 'W')
+        self.assertEquals(rows[0]['number'], 1)
+
+
+class BenchmarkDatasetTests(TestCase):
+    """Test the dataset and measuring tools of benchmarknewsletters."""
+
+    def testPhases(self):
+        """Synthetic subscriptions and history, measured by Phases."""
+        from boletin import benchmarks
+        phases = benchmarks.Phases()
+        try:
+            phases.run('subscriptions', benchmarks.create_subscriptions, 7, 'W', batch_size=3)
+            phases.run('history', benchmarks.create_history, 2, 'W', batch_size=3)
+            phases.run('count', lambda: NewsletterSending.objects.count() and None)
+        finally:
+            phases.close()
+        self.assertFalse(settings.DEBUG)
+        self.assertEquals(NewsletterSubscription.objects.filter(confirmed=True).count(), 7)
+        self.assertEquals(NewsletterSending.objects.count(), 14)
+        results = phases.results
+        self.assertEquals(results['subscriptions']['count'], 7)
+        self.assertEquals(results['subscriptions']['queries'], 4)
+        self.assertEquals(results['history']['count'], 14)
+        self.assertEquals(results['count']['queries'], 1)
+        self.assertFalse('count' in results['count'])
+        self.assertTrue(results['count']['peak_memory_kb'] > 0)
+
+
+class MetricsTests(TestCase):
+    """Test the metrics registry and its file sink."""
+
+    def testMetrics(self):
+        """Counters and histograms, flushed to the sink every interval."""
+        from boletin.metrics import FileSink, Metrics
+        now = [0]
+        directory = tempfile.mkdtemp()
+        try:
+            sink = FileSink(os.path.join(directory, 'stats-%(pid)s.json'))
+            registry = Metrics(sink, interval=10, clock=lambda: now[0])
+            registry.incr('smtp.sent')
+            registry.incr('smtp.sent', 2)
+            registry.timing('smtp.send', 0.002)
+            registry.timing('smtp.send', 0.3)
+            self.assertEquals(os.listdir(directory), [])
+            now[0] = 10
+            registry.timer('mime.build').stop()
+            path = os.path.join(directory, 'stats-%d.json' % os.getpid())
+            self.assertEquals(os.listdir(directory), [os.path.basename(path)])
+            from django.utils import simplejson
+            snapshot = simplejson.load(open(path))
+        finally:
+            shutil.rmtree(directory)
+        self.assertEquals(snapshot['counters'], {'smtp.sent': 3})
+        timing = snapshot['timings']['smtp.send']
+        self.assertEquals(timing['count'], 2)
+        self.assertEquals(timing['max'], 0.3)
+        self.assertEquals(sum([count for bound, count in timing['buckets']]), 2)
+        self.assertEquals(snapshot['timings']['mime.build']['count'], 1)
+
+    def testMetricsSinkErrors(self):
+        """Errors writing the metrics never stop the commands."""
+        from boletin.metrics import FileSink, Metrics
+        directory = tempfile.mkdtemp()
+        try:
+            registry = Metrics(FileSink(os.path.join(directory, 'missing', 'stats.json')))
+            registry.incr('smtp.sent')
+            self.assertEquals(registry.flush()['counters'], {'smtp.sent': 1})
+            self.assertEquals(os.listdir(directory), [])
+            # without a path there is nothing to write
+            Metrics(FileSink()).flush()
+        finally:
+            shutil.rmtree(directory)
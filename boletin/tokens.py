@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""Signed tokens for the confirmation links of subscriptions.
+
+A token carries the id of the subscription and the day it expires, signed
+with an HMAC of ``SECRET_KEY`` which also covers the action it confirms
+(``subscribe`` or ``unsubscribe``)::
+
+    <id in base 36>-<expiration day in base 36>-<signature>
+
+Tampered, expired or made up tokens are rejected without any query, and
+valid ones find their subscription by primary key.
+"""
+import datetime
+import hmac
+import re
+
+from django.conf import settings
+from django.utils.hashcompat import sha_constructor
+from django.utils.http import base36_to_int, int_to_base36
+
+DEFAULT_TOKEN_DAYS = 7
+EPOCH = datetime.date(2001, 1, 1)
+
+token_re = re.compile(r'^([0-9a-z]{1,13})-([0-9a-z]{1,6})-([0-9a-f]{20})$')
+
+
+def get_token_days():
+    return getattr(settings, 'NEWSLETTER_TOKEN_DAYS', DEFAULT_TOKEN_DAYS)
+
+
+def today():
+    return (datetime.date.today() - EPOCH).days
+
+
+def signature(subscription_id, action, expires):
+    message = 'boletin-%s-%d-%d' % (action, subscription_id, expires)
+    return hmac.new(settings.SECRET_KEY, message, sha_constructor).hexdigest()[:20]
+
+
+def constant_time_compare(a, b):
+    """Compare two strings taking the same time whatever they have in
+    common, so signatures can't be guessed by timing."""
+    if len(a) != len(b):
+        return False
+    result = 0
+    for x, y in zip(a, b):
+        result |= ord(x) ^ ord(y)
+    return result == 0
+
+
+def make_token(subscription_id, action, days=None):
+    """Token to confirm ``action`` on a subscription for the next ``days``
+    days."""
+    expires = today() + (days is None and get_token_days() or days)
+    return '%s-%s-%s' % (int_to_base36(subscription_id), int_to_base36(expires),
+                         signature(subscription_id, action, expires))
+
+
+def is_token(value):
+    return token_re.match(value) is not None
+
+
+def check_token(token, action):
+    """Return the subscription id of a valid token for ``action``, or
+    ``None``.
+
+    >>> token = make_token(42, 'subscribe')
+    >>> check_token(token, 'subscribe')
+    42
+    >>> check_token(token, 'unsubscribe') is None
+    True
+    >>> check_token(make_token(42, 'subscribe', days=-1), 'subscribe') is None
+    True
+
+    """
+    match = token_re.match(token)
+    if match is None:
+        return None
+    subscription_id, expires, sent_signature = match.groups()
+    subscription_id, expires = base36_to_int(subscription_id), base36_to_int(expires)
+    if expires < today():
+        return None
+    if not constant_time_compare(sent_signature, signature(subscription_id, action, expires)):
+        return None
+    return subscription_id
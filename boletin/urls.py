@@ -2,6 +2,7 @@ from django.conf.urls.defaults import *
 
 urlpatterns = patterns('boletin.views',
     (r'^subscribe/$', 'newsletter_subscription'),
-    (r'^subscribe/confirm/(?P<key>\w+)/$', 'newsletter_subscription_confirm'),
-    (r'^unsubscribe/confirm/(?P<key>\w+)/$', 'newsletter_unsubscription_confirm'),
+    (r'^subscribe/confirm/(?P<key>[\w-]+)/$', 'newsletter_subscription_confirm'),
+    (r'^unsubscribe/confirm/(?P<key>[\w-]+)/$', 'newsletter_unsubscription_confirm'),
+    (r'^unsubscribe/(?P<subscription_id>\d+)/(?P<token>\w+)/$', 'newsletter_unsubscribe'),
 )
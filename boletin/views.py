@@ -1,21 +1,30 @@
 # -*- coding: utf-8 -*-
-import sys
-from cStringIO import StringIO
+import re
 
 from django.conf import settings
+from django.contrib.csrf.middleware import csrf_exempt
 from django.contrib.sites.models import Site
-from django.core.mail import send_mail
-from django.core import management
+from django.db import transaction
 from django.forms.util import ErrorList
+from django.http import Http404, HttpResponse
 from django.shortcuts import render_to_response, get_object_or_404
-from django.template import loader, Context, RequestContext
+from django.template import Context, RequestContext
 from django.template.defaultfilters import linebreaks
+from django.utils import simplejson
 from django.utils.translation import ugettext as _
+from django.views.decorators.http import require_POST
 
 from boletin.forms import NewsletterSubscriptionForm
-from boletin.models import Newsletter, NewsletterSubscription
+from boletin.models import Newsletter, NewsletterSendJob, NewsletterSubscription
+from boletin.outbox import send_mail
+from boletin.personalization import unsubscribe_token
+from boletin.rendering import get_template
+from boletin.tokens import check_token, constant_time_compare, is_token
 
+hashkey_re = re.compile(r'^[A-Za-z0-9]{30}$')
 
+
+@transaction.commit_on_success
 def newsletter_subscription(request):
     if request.method == 'POST':
         form = NewsletterSubscriptionForm(data=request.POST.copy())
@@ -26,21 +35,21 @@ def newsletter_subscription(request):
             current_site = Site.objects.get_current()
             if unsubscribe:
                 subscription = get_object_or_404(NewsletterSubscription, email=email)
-                subscription.hashkey = subscription.random_key()
-                subscription.save()
-                t = loader.get_template('boletin/newsletter_unsubscription_confirm_email.txt')
-                c = Context({'key': subscription.hashkey, 'site': current_site})
+                t = get_template('boletin/newsletter_unsubscription_confirm_email.txt')
+                c = Context({'key': subscription.confirmation_token('unsubscribe'),
+                             'site': current_site})
                 send_mail(u'[%s] %s' % (current_site.name, _(u'Newsletter unsubscription confirmation')),
-                          t.render(c), settings.NEWSLETTER_EMAIL, [email], fail_silently=False)
+                          t.render(c), settings.NEWSLETTER_EMAIL, [email])
                 return render_to_response('boletin/newsletter_unsubscription_success.html',
                                           {'email': email},
                                           context_instance=RequestContext(request))
             else:
                 subscription = NewsletterSubscription.objects.create(email=email, period=period)
-                t = loader.get_template('boletin/newsletter_confirm_email.txt')
-                c = Context({'key': subscription.hashkey, 'site': current_site})
+                t = get_template('boletin/newsletter_confirm_email.txt')
+                c = Context({'key': subscription.confirmation_token('subscribe'),
+                             'site': current_site})
                 send_mail(u'[%s] %s' % (current_site.name, _(u'Newsletter subscription confirmation')),
-                          t.render(c), settings.NEWSLETTER_EMAIL, [email], fail_silently=False)
+                          t.render(c), settings.NEWSLETTER_EMAIL, [email])
                 return render_to_response('boletin/newsletter_success.html',
                                         {'email': email},
                                         context_instance=RequestContext(request))
@@ -55,8 +64,22 @@ def newsletter_subscription(request):
                               context_instance=RequestContext(request))
 
 
+def get_subscription_for_key(key, action):
+    """Find the subscription of a confirmation link, whose key is a signed
+    token or, in links sent before tokens existed, the hash key of the
+    subscription. Invalid tokens and keys don't reach the database."""
+    if is_token(key):
+        subscription_id = check_token(key, action)
+        if subscription_id is None:
+            raise Http404
+        return get_object_or_404(NewsletterSubscription, id=subscription_id)
+    if not hashkey_re.match(key):
+        raise Http404
+    return get_object_or_404(NewsletterSubscription, hashkey=key)
+
+
 def newsletter_subscription_confirm(request, key):
-    subscription = get_object_or_404(NewsletterSubscription, hashkey=key)
+    subscription = get_subscription_for_key(key, 'subscribe')
     error = ''
     if subscription.confirmed:
         error = ErrorList([_('This subscription has already been confirmed.')])
@@ -70,7 +93,7 @@ def newsletter_subscription_confirm(request, key):
 
 
 def newsletter_unsubscription_confirm(request, key):
-    subscription = get_object_or_404(NewsletterSubscription, hashkey=key)
+    subscription = get_subscription_for_key(key, 'unsubscribe')
     email = subscription.email
     subscription.delete()
     return render_to_response('boletin/newsletter_unsubscription_confirm.html',
@@ -78,22 +101,60 @@ def newsletter_unsubscription_confirm(request, key):
                               context_instance=RequestContext(request))
 
 
+@csrf_exempt
+def newsletter_unsubscribe(request, subscription_id, token):
+    """Unsubscription from the link in every newsletter.
+
+    Opening the link only asks for confirmation, since mail scanners and
+    prefetchers open links too: the subscription is deleted by a POST to
+    it, from the confirmation page or from the mail client (RFC 8058). The
+    token of the link is enough, so there's no CSRF check.
+    """
+    subscription = get_object_or_404(NewsletterSubscription, id=subscription_id)
+    if not constant_time_compare(token, unsubscribe_token(subscription.id, subscription.email)):
+        raise Http404
+    email = subscription.email
+    if request.method != 'POST':
+        return render_to_response('boletin/newsletter_unsubscribe.html',
+                                  {'email': email},
+                                  context_instance=RequestContext(request))
+    subscription.delete()
+    return render_to_response('boletin/newsletter_unsubscription_confirm.html',
+                              {'email': email},
+                              context_instance=RequestContext(request))
+
+
+@require_POST
 def newsletter_send(request, newsletter_id):
+    """Queue the sending of a newsletter, to be run in the background by the
+    ``runsendjobs`` command. Only POST requests queue it, so prefetching or
+    reloading the page never does."""
     newsletter = get_object_or_404(Newsletter, id=newsletter_id)
-    stdout = sys.stdout
-    sys.stdout = output = StringIO()
-    management.call_command('sendnewsletter', newsletter=newsletter.id)
-    sys.stdout = stdout
+    job = NewsletterSendJob.objects.queue(newsletter)
 
     title_data = {'number': newsletter.number,
                   'period': newsletter.get_period_display()}
-    title = u'%(period)s newsletter #%(number)s sending results' % title_data
+    title = u'%(period)s newsletter #%(number)s sending' % title_data
+    content = _(u'The sending has been queued, it will start in a moment.')
 
     return render_to_response('admin/boletin/newsletter/newsletter_send.html',
-                              {'content': linebreaks(output.getvalue()),
+                              {'content': linebreaks(content),
                                'title': title,
                                'newsletter': newsletter,
+                               'job': job,
+                               'progress': job.progress(),
                                'app_label': Newsletter._meta.app_label,
                                'model_name': Newsletter._meta.verbose_name_plural,
                               },
                               context_instance=RequestContext(request))
+
+
+def newsletter_send_progress(request, job_id):
+    """Progress of a send job as JSON, to be polled by the admin."""
+    job = get_object_or_404(NewsletterSendJob, id=job_id)
+    progress = job.progress()
+    for name in ('created', 'started', 'finished'):
+        value = getattr(job, name)
+        progress[name] = value and value.strftime('%Y-%m-%d %H:%M:%S')
+    progress['error'] = job.error
+    return HttpResponse(simplejson.dumps(progress), mimetype='application/json')